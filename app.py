@@ -1,32 +1,40 @@
 import os
-import sqlite3
-import psycopg2
+import secrets
+import threading
 from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash, session, Response
+from flask import Flask, Blueprint, current_app, render_template, request, redirect, url_for, flash, session, Response, stream_with_context, abort, jsonify
 from flask_login import LoginManager, UserMixin, login_user, login_required, logout_user, current_user
 from werkzeug.security import generate_password_hash, check_password_hash
 from werkzeug.utils import secure_filename
 from dotenv import load_dotenv
-import requests
-from oauthlib.oauth2 import WebApplicationClient
 from config import Config
+from db import get_db_connection
+import db
+import archive
+import rollups
+import reports
+import report_jobs
+import importer
+import dashboard
+import money
+import search
+import response_cache
+import metrics
+import google_oauth
+import receipt_queue
+import receipt_store
+from cache import LRUCache
+import click
 
 # Load environment variables
 load_dotenv()
 
-# Create the Flask application
-app = Flask(__name__)
-app.config.from_object(Config)
-app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=31)
-app.config['SESSION_PERMANENT'] = True
+# Every page, API and CLI command of the app; create_app() registers it
+main = Blueprint('main', __name__, cli_group=None)
 
-# OAuth 2 client setup
-client = WebApplicationClient(Config.GOOGLE_CLIENT_ID)
-
-# Initialize Flask-Login
+# Initialize Flask-Login; create_app() binds it to the application
 login_manager = LoginManager()
-login_manager.init_app(app)
-login_manager.login_view = 'login'  # type: ignore
+login_manager.login_view = 'main.login'  # type: ignore
 
 # User class for Flask-Login
 class User(UserMixin):
@@ -38,312 +46,414 @@ class User(UserMixin):
     def get_id(self):
         return str(self.id)
 
+# Users loaded by Flask-Login, keyed by the id string it passes in. Entries
+# expire after USER_CACHE_TTL so changes made in other workers are picked up.
+user_cache = LRUCache(Config.USER_CACHE_SIZE, Config.USER_CACHE_TTL)
+user_loader_counts = {'session': 0, 'database': 0}
+
+def remember_user_identity(user):
+    """Keep the minimal user identity in the signed session"""
+    session['_user_identity'] = [str(user.id), user.username]
+
+def invalidate_user(user_id):
+    """Drop a cached user after their record changes"""
+    user_cache.delete(str(user_id))
+
+def user_cache_stats():
+    stats = user_cache.stats()
+    stats.update({f'{source}_loads': count for source, count in user_loader_counts.items()})
+    return stats
+
 @login_manager.user_loader
 def load_user(user_id):
-    conn = get_db_connection()
-    user = conn.execute('SELECT * FROM users WHERE id = ?', (user_id,)).fetchone()
-    conn.close()
-    if user:
-        return User(user['id'], user['username'], user['password'])
-
-# Database connection function
-def get_db_connection():
-    database_url = os.getenv('DATABASE_URL', 'sqlite:///database.db')
-    
-    # Handle PostgreSQL connection strings (for Heroku)
-    if database_url.startswith('postgres://'):
-        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+    user = user_cache.get(user_id)
+    if user is not None:
+        return user
     
-    if database_url.startswith('sqlite:///'):
-        # SQLite connection
-        db_path = database_url.replace('sqlite:///', '')
-        conn = psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
-        conn.row_factory = sqlite3.Row
-        return conn
+    # Rebuild the user from the signed session when it carries their identity
+    identity = session.get('_user_identity')
+    if identity and identity[0] == user_id:
+        user = User(int(user_id), identity[1], None)
+        user_loader_counts['session'] += 1
     else:
-        # For PostgreSQL or other database types
-        try:
-            from sqlalchemy import create_engine
-            from sqlalchemy.pool import NullPool
-            engine = create_engine(database_url, poolclass=NullPool)
-            conn = engine.connect()
-            return conn
-        except ImportError:
-            # Fallback to SQLite if SQLAlchemy is not available
-            app.logger.warning("SQLAlchemy not available, falling back to SQLite")
-            conn = psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
-            conn.row_factory = sqlite3.Row
-            return conn
-
-# Initialize database
-def init_db():
-    connection = psycopg2.connect(os.environ['DATABASE_URL'], sslmode='require')
-    cursor = connection.cursor()
-    
-    # Drop existing tables if they exist
-    cursor.execute('DROP TABLE IF EXISTS expenses')
-    cursor.execute('DROP TABLE IF EXISTS users')
-    cursor.execute('DROP TABLE IF EXISTS budgets')
-    
-    # Create users table with Google OAuth support
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS users (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        username TEXT UNIQUE NOT NULL,
-        password TEXT,
-        email TEXT UNIQUE,
-        google_id TEXT UNIQUE
-    )
-    ''')
-    
-    # Create expenses table with user_id and receipt support
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS expenses (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        date TEXT,
-        category TEXT,
-        amount REAL,
-        description TEXT,
-        receipt_path TEXT,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
-    
-    # Create budgets table
-    cursor.execute('''
-    CREATE TABLE IF NOT EXISTS budgets (
-        id INTEGER PRIMARY KEY AUTOINCREMENT,
-        user_id INTEGER NOT NULL,
-        category TEXT NOT NULL,
-        amount REAL NOT NULL,
-        period TEXT NOT NULL,
-        start_date TEXT NOT NULL,
-        FOREIGN KEY (user_id) REFERENCES users (id)
-    )
-    ''')
+        conn = get_db_connection()
+        row = conn.query('user_by_id', (user_id,)).fetchone()
+        if not row:
+            return None
+        user = User(row['id'], row['username'], row['password'])
+        user_loader_counts['database'] += 1
+        remember_user_identity(user)
     
-    connection.commit()
-    connection.close()
-    print("Database setup complete!")
+    user_cache.set(user_id, user)
+    return user
+
+# Length of each budget period in days
+BUDGET_PERIOD_DAYS = {
+    'monthly': 30,
+    'quarterly': 90,
+    'yearly': 365,
+}
+
+main.add_app_template_filter(dashboard.receipt_url, 'receipt_url')
+main.add_app_template_filter(money.format_money, 'money')
+
+metrics.register_stats('db_pool', lambda: db.get_pool().stats())
+if Config.DATABASE_REPLICA_URLS:
+    metrics.register_stats('db_replicas', db.replica_stats)
+metrics.register_stats('user_cache', user_cache_stats)
+metrics.register_stats('response_cache', response_cache.stats)
+metrics.register_stats('archive_cache', archive.cache_stats)
+
+@main.cli.command('migrate')
+def migrate_command():
+    """Apply pending database schema migrations"""
+    import migrations
+    with db.connection() as conn:
+        applied = migrations.upgrade(conn)
+    print(f"Applied migrations: {applied}" if applied else "Database schema is up to date")
+
+@main.before_app_first_request
+def resume_receipt_uploads():
+    # Pick up receipts left pending by a previous worker; done in the
+    # background so the first request does not wait for it
+    logger = current_app.logger
+    def resume():
+        try:
+            receipt_queue.resume_pending()
+        except Exception as e:
+            logger.error(f'Error resuming receipt uploads: {e}')
+    threading.Thread(target=resume, name='receipt-resume', daemon=True).start()
+
+@main.before_app_first_request
+def resume_report_jobs():
+    # Restart report jobs queued before a restart and clear out old reports
+    logger = current_app.logger
+    def resume():
+        try:
+            report_jobs.resume_pending()
+            report_jobs.purge_expired()
+        except Exception as e:
+            logger.error(f'Error resuming report jobs: {e}')
+    threading.Thread(target=resume, name='report-resume', daemon=True).start()
+
+@main.cli.command('rebuild-rollups')
+@click.option('--user-id', type=int, default=None, help='Only rebuild this user\'s rollups')
+def rebuild_rollups_command(user_id):
+    """Recompute expense rollups from the expenses table and archives"""
+    with db.connection() as conn:
+        count = rollups.rebuild_rollups(conn, user_id)
+        conn.commit()
+    print(f"Rebuilt {count} rollup rows")
+
+@main.cli.command('archive-expenses')
+@click.option('--user-id', type=int, default=None, help='Only archive this user\'s expenses')
+@click.option('--before', default=None, help='Archive expenses dated before this YYYY-MM-DD instead of the horizon')
+def archive_expenses_command(user_id, before):
+    """Move expenses older than ARCHIVE_AFTER_MONTHS into per-year archives"""
+    before = datetime.strptime(before, '%Y-%m-%d').date() if before else archive.horizon()
+    with db.connection() as conn:
+        years, count = archive.archive_expenses(conn, user_id, before)
+    print(f"Archived {count} expenses dated before {before} into {years} yearly archives")
+
+@main.cli.command('restore-archive')
+@click.option('--user-id', type=int, required=True, help='Whose archive to restore')
+@click.option('--year', type=int, required=True, help='The archived year to restore')
+def restore_archive_command(user_id, year):
+    """Move a user's archived year back into the expenses table"""
+    with db.connection() as conn:
+        count = archive.restore_year(conn, user_id, year)
+    print(f"Restored {count} expenses")
 
 # Route: Home Page (View Expenses)
-@app.route('/')
+@main.route('/')
 @login_required
+@db.read_only
+@response_cache.cached()
 def index():
-    connection = get_db_connection()
-    cursor = connection.cursor()
-
-    try:
-        # Fetch user's expenses from the database
-        cursor.execute("SELECT date, category, amount, description, id FROM expenses WHERE user_id = ? ORDER BY date DESC", (current_user.id,))
-        expenses = cursor.fetchall()
-
-        # Calculate summary statistics
-        total_amount = 0
-        monthly_amount = 0
-        categories = set()
-        category_amounts = {}
-        monthly_data = {}
-        current_month = datetime.now().strftime('%Y-%m')
-
-        if expenses:
-            for expense in expenses:
-                date = expense[0]
-                category = expense[1]
-                amount = expense[2]
-
-                # Total amount
-                total_amount += amount
-
-                # Monthly amount
-                if date.startswith(current_month):
-                    monthly_amount += amount
-
-                # Category distribution
-                categories.add(category)
-                category_amounts[category] = category_amounts.get(category, 0) + amount
+    # The summary cards and charts are loaded by the page from the
+    # dashboard API; only the expense table is rendered here. Expenses are
+    # paged newest first, continuing after the (date, id) cursor of the
+    # previous page when one is given.
+    cursor = dashboard.parse_expense_cursor(request.args.get('after'))
+    expenses, next_cursor = dashboard.expense_page(
+        get_db_connection(), current_user.id, cursor, Config.EXPENSES_PAGE_SIZE
+    )
+    return render_template('index.html',
+                         expenses=expenses,
+                         next_cursor=next_cursor,
+                         is_first_page=cursor is None)
 
-                # Monthly trends
-                month = date[:7]  # Get YYYY-MM
-                monthly_data[month] = monthly_data.get(month, 0) + amount
+# Dashboard API. Responses carry an ETag from the user's data version and
+# are answered with 304 while it is unchanged.
+@main.route('/api/dashboard/summary')
+@login_required
+@db.read_only
+def api_dashboard_summary():
+    conn = get_db_connection()
+    month = dashboard.current_month()
+    return dashboard.versioned_json(
+        conn, current_user.id,
+        lambda: dashboard.summary(conn, current_user.id, month),
+        month
+    )
 
-        # Prepare data for charts
-        categories_list = list(categories)
-        category_amounts_list = [category_amounts.get(cat, 0) for cat in categories_list]
+@main.route('/api/dashboard/categories')
+@login_required
+@db.read_only
+def api_dashboard_categories():
+    conn = get_db_connection()
+    return dashboard.versioned_json(
+        conn, current_user.id,
+        lambda: dashboard.category_totals(conn, current_user.id)
+    )
 
-        # Sort monthly data by date
-        sorted_months = sorted(monthly_data.keys())
-        monthly_amounts_list = [monthly_data[month] for month in sorted_months]
+@main.route('/api/dashboard/monthly')
+@login_required
+@db.read_only
+def api_dashboard_monthly():
+    conn = get_db_connection()
+    return dashboard.versioned_json(
+        conn, current_user.id,
+        lambda: dashboard.monthly_totals(conn, current_user.id)
+    )
 
+@main.route('/api/expenses')
+@login_required
+@db.read_only
+def api_expenses():
+    conn = get_db_connection()
+    after = request.args.get('after')
+    cursor = dashboard.parse_expense_cursor(after)
+    page_size = min(request.args.get('limit', Config.EXPENSES_PAGE_SIZE, type=int), Config.API_MAX_PAGE_SIZE)
+    page_size = max(page_size, 1)
 
+    def build():
+        rows, next_cursor = dashboard.expense_page(conn, current_user.id, cursor, page_size)
+        return {'expenses': [dashboard.expense_json(row) for row in rows], 'next_cursor': next_cursor}
 
-    finally:
-        cursor.close()
-        connection.close()
+    return dashboard.versioned_json(conn, current_user.id, build, cursor and after, page_size)
 
-    # Pass all necessary data to the template
-    return render_template('index.html',
-                         expenses=expenses,
-                         total_amount=total_amount,
-                         monthly_amount=monthly_amount,
-                         categories_count=len(categories),
-                         categories=categories_list,
-                         category_amounts=category_amounts_list,
-                         monthly_labels=sorted_months,
-                         monthly_amounts=monthly_amounts_list)
+# Expense search. Results depend only on the user's data and the query
+# string, so both the API and the page are versioned like the dashboard.
+@main.route('/api/search')
+@login_required
+@db.read_only
+def api_search():
+    conn = get_db_connection()
+    try:
+        query = search.parse_search(request.args)
+    except search.SearchError as e:
+        return jsonify({'error': str(e)}), 400
+
+    def build():
+        result = search.search(conn, current_user.id, query)
+        return {
+            'expenses': [dashboard.expense_json(row) for row in result.rows],
+            'facets': [{'category': category, 'count': count} for category, count in result.facets],
+            'total': result.total,
+            'page': query.page,
+            'has_next': result.has_next,
+        }
+
+    return dashboard.versioned_json(conn, current_user.id, build, query.digest())
+
+@main.route('/search')
+@login_required
+@db.read_only
+@response_cache.cached()
+def search_page():
+    try:
+        query = search.parse_search(request.args)
+    except search.SearchError as e:
+        return render_template('search.html', error=str(e), result=None, args=request.args), 400
+    result = search.search(get_db_connection(), current_user.id, query)
+    return render_template('search.html', error=None, result=result, args=request.args)
 
 # Route: Add Expense Page
-@app.route('/add_expense', methods=['GET', 'POST'])
+@main.route('/add_expense', methods=['GET', 'POST'])
 @login_required
 def add_expense():
     if request.method == 'POST':
         try:
-            date = request.form['date']
+            date = datetime.strptime(request.form['date'], '%Y-%m-%d').date()
             category = request.form['category']
-            amount = float(request.form['amount'])
+            amount_cents = money.to_cents(request.form['amount'])
             description = request.form['description']
             receipt = request.files.get('receipt')
 
-            if not all([date, category, amount]):
+            if not all([date, category, amount_cents]):
                 flash('Date, category and amount are required')
-                return redirect(url_for('add_expense'))
+                return redirect(url_for('main.add_expense'))
 
-            receipt_path = None
+            # Spool the receipt locally; it is uploaded to storage in the
+            # background once the expense is committed
+            receipt_spool = None
+            receipt_status = None
             if receipt and receipt.filename:
-                try:
-                    # Import cloud storage module
-                    from cloud_storage import save_file
-                    
-                    # Generate secure filename
-                    filename = secure_filename(f'{current_user.id}_{datetime.now().strftime("%Y%m%d%H%M%S")}_{receipt.filename}')
-                    
-                    # Save file using cloud storage module
-                    receipt_path = save_file(receipt, filename, 'receipts')
-                except ImportError:
-                    # Fallback to local storage if cloud_storage module is not available
-                    app.logger.warning("cloud_storage module not available, using local storage")
-                    filename = secure_filename(f'{current_user.id}_{datetime.now().strftime("%Y%m%d%H%M%S")}_{receipt.filename}')
-                    receipt_path = os.path.join('static', 'receipts', filename)
-                    os.makedirs(os.path.dirname(receipt_path), exist_ok=True)
-                    receipt.save(receipt_path)
+                # Generate secure filename; the random part keeps concurrent
+                # uploads of the same file name from sharing a spool file
+                filename = secure_filename(
+                    f'{current_user.id}_{datetime.now().strftime("%Y%m%d%H%M%S")}_{secrets.token_hex(4)}_{receipt.filename}'
+                )
+                receipt_spool = receipt_queue.spool(receipt, filename)
+                receipt_status = receipt_queue.STATUS_PENDING
 
             conn = get_db_connection()
-            conn.execute("INSERT INTO expenses (user_id, date, category, amount, description, receipt_path) VALUES (?, ?, ?, ?, ?, ?)",
-                        (current_user.id, date, category, amount, description, receipt_path))
-            conn.commit()
-            conn.close()
+            try:
+                expense_id = conn.query(
+                    'insert_expense',
+                    (current_user.id, date, category, amount_cents, description, None, receipt_status, receipt_spool)
+                ).fetchone()[0]
+                rollups.add_expense(conn, current_user.id, date, category, amount_cents)
+                dashboard.bump_data_version(conn, current_user.id)
+                conn.commit()
+            except Exception:
+                # No expense points at the spooled receipt
+                if receipt_spool:
+                    receipt_queue.discard(receipt_spool)
+                raise
+
+            if receipt_spool:
+                # An inline upload takes connections of its own; under gevent
+                # workers holding this one meanwhile can drain the pool
+                db.release_request_connections()
+                receipt_queue.enqueue(expense_id, receipt_spool)
             flash('Expense added successfully')
             return redirect('/')
         except ValueError:
-            flash('Invalid amount value')
-            return redirect(url_for('add_expense'))
+            flash('Invalid date or amount')
+            return redirect(url_for('main.add_expense'))
         except Exception as e:
-            app.logger.error(f'Error adding expense: {e}')
+            current_app.logger.error(f'Error adding expense: {e}')
             flash('An error occurred while adding the expense')
-            return redirect(url_for('add_expense'))
+            return redirect(url_for('main.add_expense'))
     
     return render_template('add_expense.html')
 
 
 
+# Route: Import a bank statement
+@main.route('/import', methods=['GET', 'POST'])
+@login_required
+def import_statement():
+    result = None
+    if request.method == 'POST':
+        statement = request.files.get('statement')
+        if not statement or not statement.filename:
+            flash('Please choose a statement file')
+            return redirect(url_for('main.import_statement'))
+
+        file_format = request.form.get('format') or importer.detect_format(statement.filename)
+        mapping = {field: request.form.get(f'{field}_column') for field in importer.CSV_COLUMNS}
+        try:
+            result = importer.import_statement(
+                get_db_connection(),
+                current_user.id,
+                statement,
+                file_format=file_format,
+                sign=request.form.get('sign', importer.SIGN_POSITIVE),
+                default_category=request.form.get('category') or importer.DEFAULT_CATEGORY,
+                date_format=request.form.get('date_format') or None,
+                mapping=mapping,
+            )
+        except importer.StatementError as e:
+            flash(str(e))
+            return redirect(url_for('main.import_statement'))
+        except Exception as e:
+            current_app.logger.error(f'Error importing statement: {e}')
+            flash('An error occurred while importing the statement')
+            return redirect(url_for('main.import_statement'))
+
+    return render_template('import.html', formats=importer.FORMATS, result=result)
+
 # Google OAuth routes
-@app.route('/google_login')
+@main.route('/google_login')
 def google_login():
     # Find out what URL to hit for Google login
-    google_provider_cfg = requests.get(Config.GOOGLE_DISCOVERY_URL).json()
+    google_provider_cfg = google_oauth.get_provider_config()
     authorization_endpoint = google_provider_cfg["authorization_endpoint"]
 
     # Use library to construct the request for Google login and provide
     # scopes that let you retrieve user's profile from Google
-    request_uri = client.prepare_request_uri(
+    request_uri = google_oauth.web_client().prepare_request_uri(
         authorization_endpoint,
         redirect_uri=request.base_url + "/callback",
         scope=["openid", "email", "profile"],
     )
     return redirect(request_uri)
 
-@app.route('/google_login/callback')
+@main.route('/google_login/callback')
 def google_callback():
     # Get authorization code Google sent back
     code = request.args.get("code")
 
     # Find out what URL to hit to get tokens that allow you to ask for
     # things on behalf of a user
-    google_provider_cfg = requests.get(Config.GOOGLE_DISCOVERY_URL).json()
+    google_provider_cfg = google_oauth.get_provider_config()
     token_endpoint = google_provider_cfg["token_endpoint"]
 
+    # The client holds the access token once parsed, so use one per request
+    callback_client = google_oauth.web_client()
+
     # Prepare and send request to get tokens
-    token_url, headers, body = client.prepare_token_request(
+    token_url, headers, body = callback_client.prepare_token_request(
         token_endpoint,
         authorization_response=request.url,
         redirect_url=request.base_url,
         code=code,
     )
-    token_response = requests.post(
-        token_url,
-        headers=headers,
-        data=body,
-        auth=(Config.GOOGLE_CLIENT_ID, Config.GOOGLE_CLIENT_SECRET),
-    )
+    token_response = google_oauth.fetch_token(token_url, headers, body)
 
     # Parse the tokens
-    client.parse_request_body_response(token_response.text)
+    callback_client.parse_request_body_response(token_response)
 
     # Get user info from Google
     userinfo_endpoint = google_provider_cfg["userinfo_endpoint"]
-    uri, headers, body = client.add_token(userinfo_endpoint)
-    userinfo_response = requests.get(uri, headers=headers, data=body)
+    uri, headers, body = callback_client.add_token(userinfo_endpoint)
+    userinfo = google_oauth.fetch_userinfo(uri, headers, body)
 
-    if userinfo_response.json().get("email_verified"):
-        google_id = userinfo_response.json()["sub"]
-        email = userinfo_response.json()["email"]
-        name = userinfo_response.json()["given_name"]
+    if userinfo.get("email_verified"):
+        google_id = userinfo["sub"]
+        email = userinfo["email"]
+        name = userinfo["given_name"]
 
         # Check if user exists
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE google_id = ?', (google_id,)).fetchone()
+        user = conn.query('user_by_google_id', (google_id,)).fetchone()
 
         if not user:
             # Create new user
-            conn.execute(
-                'INSERT INTO users (username, email, google_id) VALUES (?, ?, ?)',
-                (name, email, google_id)
-            )
+            conn.query('insert_google_user', (name, email, google_id))
             conn.commit()
-            user = conn.execute('SELECT * FROM users WHERE google_id = ?', (google_id,)).fetchone()
+            user = conn.query('user_by_google_id', (google_id,)).fetchone()
+            invalidate_user(user['id'])
 
-        conn.close()
-        user_obj = User(user['id'], user['username'], user.get('password', ''))
+        user_obj = User(user['id'], user['username'], user['password'])
         login_user(user_obj)
-        return redirect(url_for('index'))
+        remember_user_identity(user_obj)
+        return redirect(url_for('main.index'))
     else:
         flash("Google authentication failed")
-        return redirect(url_for('login'))
-
-# Initialize the database when the application starts
-init_db()
+        return redirect(url_for('main.login'))
 
-@app.route('/register', methods=['GET', 'POST'])
+@main.route('/register', methods=['GET', 'POST'])
 def register():
     if request.method == 'POST':
         username = request.form['username']
         password = request.form['password']
         
         conn = get_db_connection()
-        if conn.execute('SELECT id FROM users WHERE username = ?', (username,)).fetchone():
+        if conn.query('user_id_by_username', (username,)).fetchone():
             flash('Username already exists')
-            return redirect(url_for('register'))
+            return redirect(url_for('main.register'))
             
-        conn.execute('INSERT INTO users (username, password) VALUES (?, ?)',
-                    (username, generate_password_hash(password)))
+        conn.query('insert_user', (username, generate_password_hash(password)))
         conn.commit()
-        conn.close()
         flash('Registration successful')
-        return redirect(url_for('login'))
+        return redirect(url_for('main.login'))
     return render_template('register.html')
 
-@app.route('/login', methods=['GET', 'POST'])
+@main.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
         username = request.form['username']
@@ -351,82 +461,82 @@ def login():
         remember = 'remember' in request.form
         
         conn = get_db_connection()
-        user = conn.execute('SELECT * FROM users WHERE username = ?', (username,)).fetchone()
-        conn.close()
+        user = conn.query('user_by_username', (username,)).fetchone()
         
         if user and check_password_hash(user['password'], password):
             user_obj = User(user['id'], user['username'], user['password'])
             login_user(user_obj, remember=remember)
-            return redirect(url_for('index'))
+            remember_user_identity(user_obj)
+            return redirect(url_for('main.index'))
         flash('Invalid username or password')
     return render_template('login.html')
 
-@app.route('/delete_expense', methods=['POST'])
+@main.route('/delete_expense', methods=['POST'])
 @login_required
 def delete_expense():
     expense_id = request.form.get('expense_id')
     if expense_id:
         conn = get_db_connection()
         # Verify the expense belongs to the current user before deleting
-        conn.execute('DELETE FROM expenses WHERE id = ? AND user_id = ?', (expense_id, current_user.id))
-        conn.commit()
-        conn.close()
-        flash('Expense deleted successfully')
-    return redirect(url_for('index'))
-
-@app.route('/logout')
+        expense = conn.query('expense_for_user', (expense_id, current_user.id)).fetchone()
+        if expense:
+            conn.query('delete_expense', (expense_id, current_user.id))
+            rollups.remove_expense(conn, current_user.id, expense[0], expense[1], expense[2])
+            released = receipt_store.release(conn, expense[3])
+            dashboard.bump_data_version(conn, current_user.id)
+            conn.commit()
+            # Files go only after no committed row points at them
+            receipt_store.delete_files(released)
+            if expense[5] and expense[4] != receipt_queue.STATUS_UPLOADING:
+                # A receipt still uploading has its spool file removed by
+                # the upload worker
+                receipt_queue.discard(expense[5])
+            flash('Expense deleted successfully')
+        elif expense_id.isdigit() and archive.find_expense(conn, current_user.id, int(expense_id)):
+            flash('Archived expenses are read-only and cannot be deleted')
+        else:
+            flash('Expense not found')
+    return redirect(url_for('main.index'))
+
+# Route: Serve a stored receipt by its content digest
+@main.route('/receipts/<digest>', defaults={'thumbnail': False})
+@main.route('/receipts/<digest>/thumb', defaults={'thumbnail': True})
+@login_required
+@db.read_only
+def receipt(digest, thumbnail):
+    blob = get_db_connection().query('receipt_blob_for_user', (digest, current_user.id, current_user.id)).fetchone()
+    response = receipt_store.serve(blob, thumbnail) if blob else None
+    if response is None:
+        abort(404)
+    return response
+
+@main.route('/logout')
 @login_required
 def logout():
     logout_user()
-    return redirect(url_for('login'))
+    session.pop('_user_identity', None)
+    return redirect(url_for('main.login'))
 
-@app.route('/budget', methods=['GET'])
+@main.route('/budget', methods=['GET'])
 @login_required
+@db.read_only
+@response_cache.cached(lambda: datetime.now().strftime('%Y-%m-%d'))
 def budget():
     conn = get_db_connection()
     
-    # Get user's budgets
-    budgets = conn.execute(
-        'SELECT id, category, amount, period, start_date FROM budgets WHERE user_id = ?',
-        (current_user.id,)
-    ).fetchall()
+    # Get user's budgets with the spending in each budget's window, which
+    # runs from its start date to its stored end date or today, whichever
+    # comes first
+    today = datetime.now().date()
+    budgets = conn.query('budgets_with_spent', (today, today, current_user.id)).fetchall()
+    # Spending on expenses that have since been archived
+    archived = archive.budget_spending(conn, current_user.id, budgets, today)
     
-    # Calculate spent and remaining amounts for each budget
+    # Calculate remaining amounts for each budget, in cents
     budgets_with_spending = []
     for budget in budgets:
-        budget_id, category, amount, period, start_date = budget
-        
-        # Calculate date range based on period
-        start = datetime.strptime(start_date, '%Y-%m-%d')
-        today = datetime.now()
-        
-        if period == 'monthly':
-            # For monthly budgets, get expenses from the start date to 30 days later
-            end = start + timedelta(days=30)
-            if today < end:
-                end = today
-        elif period == 'quarterly':
-            # For quarterly budgets, get expenses from the start date to 90 days later
-            end = start + timedelta(days=90)
-            if today < end:
-                end = today
-        elif period == 'yearly':
-            # For yearly budgets, get expenses from the start date to 365 days later
-            end = start + timedelta(days=365)
-            if today < end:
-                end = today
-        
-        # Format dates for SQL query
-        start_str = start.strftime('%Y-%m-%d')
-        end_str = end.strftime('%Y-%m-%d')
-        
-        # Get total spending for this category in the date range
-        spent_result = conn.execute(
-            'SELECT SUM(amount) FROM expenses WHERE user_id = ? AND category = ? AND date BETWEEN ? AND ?',
-            (current_user.id, category, start_str, end_str)
-        ).fetchone()
-        
-        spent = spent_result[0] if spent_result[0] else 0
+        budget_id, category, amount, period, start_date, end_date, spent = budget
+        spent += archived.get(budget_id, 0)
         remaining = amount - spent
         
         # Add to the list with spent and remaining values
@@ -440,126 +550,162 @@ def budget():
             'remaining': remaining
         })
     
-    conn.close()
-    return render_template('budget.html', budgets=budgets_with_spending)
+    return render_template('budget.html', budgets=budgets_with_spending, report_formats=reports.available_formats())
 
-@app.route('/add_budget', methods=['POST'])
+@main.route('/add_budget', methods=['POST'])
 @login_required
 def add_budget():
     if request.method == 'POST':
         category = request.form['category']
-        amount = float(request.form['amount'])
         period = request.form['period']
         start_date = request.form['start_date']
+        try:
+            amount_cents = money.to_cents(request.form['amount'])
+            start = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+        except ValueError:
+            flash('Invalid date or amount')
+            return redirect(url_for('main.budget'))
         
-        if not all([category, amount, period, start_date]):
+        if not all([category, amount_cents, period, start]):
             flash('All fields are required')
-            return redirect(url_for('budget'))
+            return redirect(url_for('main.budget'))
+        
+        if period not in BUDGET_PERIOD_DAYS:
+            flash('Invalid budget period')
+            return redirect(url_for('main.budget'))
+        
+        # Store the end of the budget window so /budget needs no date maths
+        end = start + timedelta(days=BUDGET_PERIOD_DAYS[period])
         
         conn = get_db_connection()
-        conn.execute(
-            'INSERT INTO budgets (user_id, category, amount, period, start_date) VALUES (?, ?, ?, ?, ?)',
-            (current_user.id, category, amount, period, start_date)
+        conn.query(
+            'insert_budget',
+            (current_user.id, category, amount_cents, period, start, end)
         )
+        dashboard.bump_data_version(conn, current_user.id)
         conn.commit()
-        conn.close()
         
         flash('Budget added successfully')
-        return redirect(url_for('budget'))
+        return redirect(url_for('main.budget'))
 
-@app.route('/delete_budget', methods=['POST'])
+@main.route('/delete_budget', methods=['POST'])
 @login_required
 def delete_budget():
     budget_id = request.form.get('budget_id')
     if budget_id:
         conn = get_db_connection()
         # Verify the budget belongs to the current user before deleting
-        conn.execute('DELETE FROM budgets WHERE id = ? AND user_id = ?', (budget_id, current_user.id))
+        if conn.query('delete_budget', (budget_id, current_user.id)).rowcount:
+            dashboard.bump_data_version(conn, current_user.id)
         conn.commit()
-        conn.close()
         flash('Budget deleted successfully')
-    return redirect(url_for('budget'))
+    return redirect(url_for('main.budget'))
 
-@app.route('/download_report', methods=['GET'])
+@main.route('/download_report', methods=['GET'])
 @login_required
+@db.read_only
+@response_cache.cached(lambda: datetime.now().strftime('%Y-%m-%d'))
 def download_report():
-    month = request.args.get('month', datetime.now().strftime('%Y-%m'))
+    # Accepts ?month=YYYY-MM, or an inclusive ?from=YYYY-MM-DD&to=YYYY-MM-DD
+    # range where either side may be left open, or ?all=1, and ?format=
+    try:
+        report_range = reports.parse_report_range(request.args)
+    except reports.ReportRangeError as e:
+        flash(str(e))
+        return redirect(url_for('main.budget'))
     
-    # Get start and end date for the selected month
-    start_date = f"{month}-01"
-    # Calculate the end date (last day of the month)
-    year, month_num = map(int, month.split('-'))
-    if month_num == 12:
-        next_month = 1
-        next_year = year + 1
-    else:
-        next_month = month_num + 1
-        next_year = year
-    end_date = f"{next_year}-{next_month:02d}-01"
+    # Long ranges and other formats are generated in the background
+    report_format = request.args.get('format', 'csv')
+    if report_format != 'csv' or report_range.days() > Config.REPORT_SYNC_MAX_DAYS:
+        try:
+            report_jobs.enqueue(db.get_primary_connection(), current_user.id, report_range, report_format)
+        except report_jobs.ReportJobError as e:
+            flash(str(e))
+            return redirect(url_for('main.budget'))
+        flash('Your report is being prepared and will be ready to download here shortly')
+        return redirect(url_for('main.report_list'))
     
-    # Get expenses for the selected month
+    # Stream the CSV as it is generated instead of building it in memory
     conn = get_db_connection()
-    expenses = conn.execute(
-        'SELECT date, category, amount, description FROM expenses WHERE user_id = ? AND date >= ? AND date < ? ORDER BY date',
-        (current_user.id, start_date, end_date)
-    ).fetchall()
-    
-    # Calculate total by category
-    category_totals = {}
-    total_amount = 0
-    for expense in expenses:
-        category = expense[1]
-        amount = expense[2]
-        category_totals[category] = category_totals.get(category, 0) + amount
-        total_amount += amount
-    
-    # Get budgets for comparison
-    budgets = conn.execute(
-        'SELECT category, amount FROM budgets WHERE user_id = ? AND period = "monthly"',
-        (current_user.id,)
-    ).fetchall()
-    budget_dict = {budget[0]: budget[1] for budget in budgets}
-    
-    conn.close()
-    
-    # Create CSV content
-    import csv
-    import io
-    
-    output = io.StringIO()
-    writer = csv.writer(output)
-    
-    # Write header
-    writer.writerow(['Monthly Expense Report', month])
-    writer.writerow([])
-    writer.writerow(['Date', 'Category', 'Amount', 'Description'])
-    
-    # Write expense data
-    for expense in expenses:
-        writer.writerow([expense[0], expense[1], f"Rs. {expense[2]:.2f}", expense[3]])
-    
-    # Write summary
-    writer.writerow([])
-    writer.writerow(['Category Summary'])
-    writer.writerow(['Category', 'Spent', 'Budget', 'Remaining'])
-    
-    for category, spent in category_totals.items():
-        budget = budget_dict.get(category, 0)
-        remaining = budget - spent if budget > 0 else 0
-        writer.writerow([category, f"Rs. {spent:.2f}", f"Rs. {budget:.2f}", f"Rs. {remaining:.2f}"])
-    
-    writer.writerow([])
-    writer.writerow(['Total Expenses', f"Rs. {total_amount:.2f}"])
-    
-    # Prepare response
-    output.seek(0)
-    month_name = datetime.strptime(month, '%Y-%m').strftime('%B_%Y')
+    user_id = current_user.id
     return Response(
-        output.getvalue(),
+        stream_with_context(reports.iter_csv(conn, user_id, report_range)),
         mimetype="text/csv",
-        headers={"Content-disposition": f"attachment; filename=expense_report_{month_name}.csv"}
+        headers={"Content-disposition": f"attachment; filename={report_range.filename}"}
     )
 
+# Route: Reports generated in the background
+@main.route('/reports')
+@login_required
+@db.read_only
+def report_list():
+    jobs = get_db_connection().query('report_jobs_for_user', (current_user.id, 50)).fetchall()
+    return render_template('reports.html', jobs=jobs, active=(report_jobs.STATUS_QUEUED, report_jobs.STATUS_RUNNING))
+
+@main.route('/api/reports', methods=['POST'])
+@login_required
+def api_create_report():
+    # Same parameters as download_report, as form fields; always queued
+    try:
+        report_range = reports.parse_report_range(request.form)
+        conn = get_db_connection()
+        job_id = report_jobs.enqueue(conn, current_user.id, report_range, request.form.get('format', 'csv'))
+    except (reports.ReportRangeError, report_jobs.ReportJobError) as e:
+        return jsonify({'error': str(e)}), 400
+    job = conn.query('report_job', (job_id,)).fetchone()
+    return jsonify(report_jobs.job_json(job)), 202, {'Location': url_for('main.api_report_status', job_id=job_id)}
+
+@main.route('/api/reports/<int:job_id>')
+@login_required
+@db.read_only
+def api_report_status(job_id):
+    job = get_db_connection().query('report_job_for_user', (job_id, current_user.id)).fetchone()
+    if job is None:
+        abort(404)
+    return jsonify(report_jobs.job_json(job))
+
+@main.route('/reports/<int:job_id>/download')
+@login_required
+@db.read_only
+def download_report_job(job_id):
+    job = get_db_connection().query('report_job_for_user', (job_id, current_user.id)).fetchone()
+    response = None
+    if job is not None and job['status'] == report_jobs.STATUS_DONE:
+        response = report_jobs.serve(job)
+    if response is None:
+        abort(404)
+    return response
+
+def create_app(config=Config):
+    """
+    Create and configure the application
+
+    Nothing here connects to anything: the database pool, the storage
+    backend and the Google sign-in client are created on first use, so a
+    cold start (a serverless invocation or a respawned gunicorn worker)
+    only pays for importing the app.
+
+    Args:
+        config: The settings object to load
+    """
+    app = Flask(__name__)
+    app.config.from_object(config)
+    app.config['PERMANENT_SESSION_LIFETIME'] = timedelta(days=31)
+    app.config['SESSION_PERMANENT'] = True
+
+    # Return pooled database connections at the end of each request
+    db.init_app(app)
+
+    # Time requests, SQL and external calls, served at /metrics
+    metrics.init_app(app)
+
+    login_manager.init_app(app)
+    app.register_blueprint(main)
+    return app
+
+# The WSGI application for gunicorn (app:app) and Vercel
+app = create_app()
+
 if __name__ == '__main__':
     @app.route("/")
     def home():
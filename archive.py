@@ -0,0 +1,468 @@
+"""
+Cold storage for old expenses
+
+Users mostly look at recent months, so expenses dated before the archive
+horizon, the start of the month ARCHIVE_AFTER_MONTHS ago, are moved out of
+the ``expenses`` table by ``flask archive-expenses``, run from cron like the
+other maintenance commands. A user's archived expenses of one year become
+one gzip-compressed file holding the expenses column by column, stored
+privately through cloud_storage under ``archive/``; ``expense_archives``
+records where each file is and the dates it covers. The table and its
+indexes are left with recent expenses only.
+
+Archived expenses still count towards the rollups, so dashboard totals and
+charts do not change. The expense list, search, reports, budgets and
+statement imports look up the archives whose dates overlap what they read
+and merge their rows with the table's. Decoded files are kept in a
+per-process LRU cache, with an index of their description words built on the
+first search; a file is never rewritten in place (a year that gains expenses
+is stored again under a new name), so cached copies never go stale.
+
+Archived expenses are read-only. ``flask restore-archive`` moves a year back
+into the table.
+"""
+import io
+import re
+import gzip
+import json
+import heapq
+import secrets
+import logging
+import unicodedata
+from bisect import bisect_left
+from collections import Counter, defaultdict
+from datetime import date, datetime, timedelta
+from itertools import chain, islice
+from werkzeug.datastructures import FileStorage
+import cloud_storage
+import metrics
+import receipt_queue
+import rollups
+from cache import LRUCache
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+DIRECTORY = 'archive'
+
+# Bump when the file layout changes
+FORMAT_VERSION = 1
+
+# Columns of an archived expense, in the order of the expense_page query
+COLUMNS = (
+    'date', 'category', 'amount_cents', 'description', 'id',
+    'receipt_path', 'receipt_status', 'receipt_thumb_path', 'receipt_digest',
+)
+_COLUMN_INDEX = {name: index for index, name in enumerate(COLUMNS)}
+
+# Rows per DELETE when moving expenses out of the table, well under
+# SQLite's limit on bound parameters
+DELETE_BATCH_SIZE = 500
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+_cache = LRUCache(Config.ARCHIVE_CACHE_SIZE, maxbytes=Config.ARCHIVE_CACHE_MAX_ROWS, weigh=len)
+
+
+class ArchiveError(Exception):
+    """Raised when an archive cannot be read or changed"""
+
+
+class ArchivedExpense(tuple):
+    """An archived expense, indexed by position or column name like a database row"""
+
+    archived = True
+
+    def __getitem__(self, key):
+        if isinstance(key, str):
+            key = _COLUMN_INDEX[key]
+        return tuple.__getitem__(self, key)
+
+    def keys(self):
+        return COLUMNS
+
+
+class _ArchiveFile:
+    """A decoded archive, with an index of its description words built on first search"""
+
+    def __init__(self, rows):
+        self.rows = rows
+        self._words = None
+
+    def __len__(self):
+        return len(self.rows)
+
+    def _index(self):
+        postings = defaultdict(set)
+        for position, row in enumerate(self.rows):
+            for word in WORD.findall(fold(row[3] or '')):
+                postings[word].add(position)
+        return sorted(postings), postings
+
+    def matching(self, terms):
+        """Positions of the rows with a description word starting with each of ``terms``, in order"""
+        if self._words is None:
+            self._words = self._index()
+        vocabulary, postings = self._words
+        found = None
+        for term in terms:
+            positions = set()
+            i = bisect_left(vocabulary, term)
+            while i < len(vocabulary) and vocabulary[i].startswith(term):
+                positions |= postings[vocabulary[i]]
+                i += 1
+            found = positions if found is None else found & positions
+            if not found:
+                return []
+        return sorted(found)
+
+
+def _order(row):
+    return row[0], row[4]
+
+
+def fold(text):
+    """Lowercase and strip diacritics, as the SQLite full-text index does"""
+    decomposed = unicodedata.normalize('NFKD', text.lower())
+    return ''.join(ch for ch in decomposed if not unicodedata.combining(ch))
+
+
+def horizon(today=None):
+    """Return the first date that is not archived: the start of the month ARCHIVE_AFTER_MONTHS ago"""
+    today = today or date.today()
+    months = today.year * 12 + today.month - 1 - Config.ARCHIVE_AFTER_MONTHS
+    return date(months // 12, months % 12 + 1, 1)
+
+
+def encode(rows):
+    """Serialise archived expenses, oldest first, as gzip-compressed JSON columns"""
+    columns = {name: [] for name in COLUMNS}
+    for row in rows:
+        for name, value in zip(COLUMNS, row):
+            columns[name].append(value)
+    columns['date'] = [day.isoformat() for day in columns['date']]
+    body = {'version': FORMAT_VERSION, 'rows': len(rows), 'columns': columns}
+    return gzip.compress(json.dumps(body, separators=(',', ':')).encode('utf-8'))
+
+
+def decode(content):
+    """Return the ArchivedExpense rows of an encoded archive"""
+    body = json.loads(gzip.decompress(content))
+    if body.get('version') != FORMAT_VERSION:
+        raise ArchiveError(f"Unsupported archive format {body.get('version')}")
+    columns = body['columns']
+    dates = [date.fromisoformat(day) for day in columns['date']]
+    return [ArchivedExpense(values) for values in zip(dates, *(columns[name] for name in COLUMNS[1:]))]
+
+
+def _read_file(backend, filename):
+    try:
+        return backend.read(filename, DIRECTORY, private=True)
+    except FileNotFoundError:
+        if not isinstance(backend, cloud_storage.LocalStorage):
+            raise
+        # Written before archives were private, under the served root
+        logger.warning(f"Archive {filename} is still under {backend.root}; "
+                       f"move it to {backend.private_root}")
+        return backend.read(filename, DIRECTORY)
+
+
+def _load(archive):
+    loaded = _cache.get(archive['filename'])
+    if loaded is None:
+        backend = cloud_storage.backend_for(archive['storage'])
+        if backend is None:
+            raise ArchiveError(f"Archive {archive['filename']} is in {archive['storage']} storage, "
+                               f"which is not configured")
+        with metrics.timed(backend.name, 'read'):
+            content = _read_file(backend, archive['filename'])
+        loaded = _ArchiveFile(decode(content))
+        _cache.set(archive['filename'], loaded)
+    return loaded
+
+
+def read(archive):
+    """Return the expenses of an ``expense_archives`` row, oldest first"""
+    return _load(archive).rows
+
+
+def cache_stats():
+    return _cache.stats()
+
+
+def archives_between(conn, user_id, start=None, end=None):
+    """The user's archives holding expenses dated within [start, end], oldest first"""
+    return conn.query('expense_archives_between', (user_id, end or date.max, start or date.min)).fetchall()
+
+
+def iter_expenses(archives, start=None, end=None, newest_first=False, terms=()):
+    """
+    Yield the archived expenses of ``archives`` dated within [start, end] in (date, id) order
+
+    With ``terms`` (folded words), only expenses whose description has a
+    word starting with each of them.
+    """
+    for archive in (reversed(archives) if newest_first else archives):
+        loaded = _load(archive)
+        rows = [loaded.rows[i] for i in loaded.matching(terms)] if terms else loaded.rows
+        for row in (reversed(rows) if newest_first else rows):
+            if (start and row[0] < start) or (end and row[0] > end):
+                continue
+            yield row
+
+
+def expenses_between(conn, user_id, start=None, end=None):
+    """Yield the user's archived expenses dated within [start, end], oldest first"""
+    return iter_expenses(archives_between(conn, user_id, start, end), start, end)
+
+
+def find_expense(conn, user_id, expense_id):
+    """The user's archived expense with ``expense_id``, or None; reads every archive of the user"""
+    for row in iter_expenses(conn.query('expense_archives_for_user', (user_id,)).fetchall()):
+        if row[4] == expense_id:
+            return row
+    return None
+
+
+def merge_page(conn, user_id, rows, cursor, limit):
+    """
+    Merge archived expenses into a newest-first page of table rows
+
+    Args:
+        rows: Up to ``limit`` rows from the table, newest first
+        cursor: ``(date, id)`` the page continues after, or None
+
+    Returns:
+        The newest ``limit`` rows of both, newest first
+    """
+    end = cursor[0] if cursor else None
+    # A full page from the table only needs archived rows at least as new as its last one
+    start = rows[-1]['date'] if len(rows) >= limit else None
+    archives = archives_between(conn, user_id, start, end)
+    if not archives:
+        return rows
+    archived = iter_expenses(archives, start, end, newest_first=True)
+    if cursor:
+        archived = (row for row in archived if _order(row) < cursor)
+    return list(islice(heapq.merge(rows, islice(archived, limit), key=_order, reverse=True), limit))
+
+
+def stream_expenses(conn, user_id, start, end, batch_size):
+    """
+    Yield lists of report rows within [start, end], oldest first
+
+    Like ``conn.stream('report_expenses', ...)``, with archived expenses
+    merged in; rows are ``(date, category, amount_cents, description, id)``
+    and anything after.
+    """
+    archives = archives_between(conn, user_id, start, end)
+    batches = conn.stream('report_expenses', (user_id, start, end), batch_size)
+    if not archives:
+        yield from batches
+        return
+    rows = heapq.merge(chain.from_iterable(batches), iter_expenses(archives, start, end), key=_order)
+    while True:
+        batch = list(islice(rows, batch_size))
+        if not batch:
+            break
+        yield batch
+
+
+def category_totals(conn, user_id, start, end):
+    """Return a Counter of archived spending per category within [start, end], in cents"""
+    totals = Counter()
+    for row in expenses_between(conn, user_id, start, end):
+        totals[row[1]] += row[2]
+    return totals
+
+
+def budget_spending(conn, user_id, budgets, today):
+    """
+    Return ``{budget_id: cents}`` spent on archived expenses within each budget's window
+
+    Args:
+        budgets: ``budgets_with_spent`` rows; a window runs from the start
+            date to the end date or ``today``, whichever comes first
+    """
+    windows = [(row['id'], row['category'], row['start_date'], min(row['end_date'], today)) for row in budgets]
+    if not windows:
+        return {}
+    spent = Counter()
+    start = min(window[2] for window in windows)
+    end = max(window[3] for window in windows)
+    for row in expenses_between(conn, user_id, start, end):
+        for budget_id, category, window_start, window_end in windows:
+            if row[1] == category and window_start <= row[0] <= window_end:
+                spent[budget_id] += row[2]
+    return spent
+
+
+def add_rollups(conn, user_id=None):
+    """Add archived expenses to rollups rebuilt from the expenses table; the caller commits"""
+    if user_id is None:
+        archives = conn.query('all_expense_archives').fetchall()
+    else:
+        archives = conn.query('expense_archives_for_user', (user_id,)).fetchall()
+    for archive in archives:
+        totals = Counter()
+        counts = Counter()
+        for row in read(archive):
+            key = (rollups.expense_month(row[0]), row[1])
+            totals[key] += row[2]
+            counts[key] += 1
+        for (month, category), total in totals.items():
+            rollups.add_expenses(conn, archive['user_id'], month, category, total, counts[(month, category)])
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _store(user_id, year, content):
+    """Store an encoded archive; returns ``(storage, filename)``"""
+    filename = f"{user_id}-{year}-{secrets.token_hex(16)}.json.gz"
+    backend = cloud_storage.get_backend()
+    upload = FileStorage(stream=io.BytesIO(content), filename=filename, content_type='application/gzip')
+    try:
+        with metrics.timed(backend.name, 'save'):
+            backend.save(upload, filename, DIRECTORY, private=True)
+    except Exception as e:
+        if isinstance(backend, cloud_storage.LocalStorage):
+            raise
+        logger.error(f"Error uploading archive to {backend.name}: {e}, falling back to local storage")
+        backend = cloud_storage.LocalStorage()
+        backend.save(upload, filename, DIRECTORY, private=True)
+    return backend.name, filename
+
+
+def _delete_file(storage, filename):
+    backend = cloud_storage.backend_for(storage)
+    if backend is None:
+        return
+    try:
+        with metrics.timed(backend.name, 'delete'):
+            backend.delete(filename, DIRECTORY, private=True)
+            if isinstance(backend, cloud_storage.LocalStorage):
+                backend.delete(filename, DIRECTORY)
+    except Exception as e:
+        logger.error(f"Error deleting archive {filename}: {e}")
+
+
+def _delete_expenses(conn, user_id, ids):
+    deleted = 0
+    for offset in range(0, len(ids), DELETE_BATCH_SIZE):
+        batch = ids[offset:offset + DELETE_BATCH_SIZE]
+        deleted += conn.execute(
+            f"DELETE FROM expenses WHERE user_id = ? AND id IN ({', '.join('?' * len(batch))})",
+            [user_id] + batch,
+        ).rowcount
+    return deleted
+
+
+def archive_year(conn, user_id, year, before):
+    """
+    Move one user's expenses of ``year`` dated before ``before`` into its archive
+
+    Expenses already archived for the year are merged with the new ones into
+    a new file, which replaces the old one. If the expenses change while
+    they are being archived nothing is moved.
+
+    Returns:
+        The number of expenses moved
+    """
+    start = date(year, 1, 1)
+    end = min(date(year, 12, 31), before - timedelta(days=1))
+    rows = [ArchivedExpense(row) for row in conn.query(
+        'archivable_expenses',
+        (user_id, start, end, receipt_queue.STATUS_PENDING, receipt_queue.STATUS_UPLOADING)
+    ).fetchall()]
+    if not rows:
+        conn.rollback()
+        return 0
+
+    existing = conn.query('expense_archive', (user_id, year)).fetchone()
+    merged = sorted(list(read(existing)) + rows, key=_order) if existing else rows
+    storage, filename = _store(user_id, year, encode(merged))
+    try:
+        details = (storage, filename, len(merged), merged[0][0], merged[-1][0], _now())
+        if existing:
+            saved = conn.query('replace_expense_archive', details + (user_id, year, existing['filename'])).rowcount
+        else:
+            saved = conn.query('insert_expense_archive', (user_id, year) + details).rowcount
+        moved = _delete_expenses(conn, user_id, [row[4] for row in rows])
+        if not saved or moved != len(rows):
+            raise ArchiveError(f"Expenses of user {user_id} in {year} changed while being archived")
+        for digest in {row[8] for row in rows if row[8]}:
+            conn.query('insert_archived_receipt', (user_id, digest, year))
+        conn.query('bump_data_version', (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        _delete_file(storage, filename)
+        raise
+    if existing:
+        _delete_file(existing['storage'], existing['filename'])
+    logger.info(f"Archived {len(rows)} expenses of user {user_id} in {year} ({len(merged)} in the archive)")
+    return len(rows)
+
+
+def archive_expenses(conn, user_id=None, before=None):
+    """
+    Archive every expense dated before ``before`` (default: the horizon)
+
+    Args:
+        conn: A pooled connection; each year is committed on its own
+        user_id: Only archive this user's expenses when given
+        before: First date to keep in the table
+
+    Returns:
+        ``(years, expenses)``: archives written and expenses moved
+    """
+    before = before or horizon()
+    if user_id is None:
+        user_ids = [row[0] for row in conn.query('archive_users', (before,)).fetchall()]
+    else:
+        user_ids = [user_id]
+
+    years = moved = 0
+    for uid in user_ids:
+        oldest = conn.query('oldest_expense_date', (uid,)).fetchone()
+        if oldest is None or oldest[0] >= before:
+            continue
+        for year in range(oldest[0].year, (before - timedelta(days=1)).year + 1):
+            try:
+                count = archive_year(conn, uid, year, before)
+            except ArchiveError as e:
+                logger.error(f"{e}; it will be archived on the next run")
+                continue
+            if count:
+                years += 1
+                moved += count
+    return years, moved
+
+
+def restore_year(conn, user_id, year):
+    """
+    Move one user's archived expenses of ``year`` back into the expenses table
+
+    Returns:
+        The number of expenses restored
+    """
+    archive = conn.query('expense_archive', (user_id, year)).fetchone()
+    if archive is None:
+        conn.rollback()
+        return 0
+    rows = read(archive)
+    try:
+        conn.copy_rows('expenses', ('user_id',) + COLUMNS, [(user_id,) + tuple(row) for row in rows])
+        if not conn.query('delete_expense_archive', (user_id, year, archive['filename'])).rowcount:
+            raise ArchiveError(f"The {year} archive of user {user_id} changed while being restored")
+        conn.query('delete_archived_receipts', (user_id, year))
+        conn.query('bump_data_version', (user_id,))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    _delete_file(archive['storage'], archive['filename'])
+    logger.info(f"Restored {len(rows)} archived expenses of user {user_id} in {year}")
+    return len(rows)
@@ -0,0 +1 @@
+"""Benchmarks for the SpendiZO routes; see benchmarks/README.md"""
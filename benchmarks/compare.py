@@ -0,0 +1,55 @@
+"""
+Compare two benchmark result files
+
+    python -m benchmarks.compare benchmarks/results/<old>.json benchmarks/results/<new>.json
+
+Prints p50 and p95 latency and queries per request for every route the two
+runs share, with the relative change in latency. Changes beyond
+--threshold percent are marked.
+"""
+import sys
+import json
+import argparse
+
+
+def _scenarios(results):
+    return {scenario['expenses']: scenario['routes'] for scenario in results['scenarios']}
+
+
+def _change(old, new):
+    return (new - old) / old * 100 if old else 0.0
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare two benchmark result files')
+    parser.add_argument('old')
+    parser.add_argument('new')
+    parser.add_argument('--threshold', type=float, default=10, help='Percent change worth marking')
+    args = parser.parse_args(argv)
+
+    with open(args.old) as f:
+        old = json.load(f)
+    with open(args.new) as f:
+        new = json.load(f)
+    print(f"{(old['meta']['commit'] or 'unknown')[:12]} -> {(new['meta']['commit'] or 'unknown')[:12]}")
+
+    old_scenarios, new_scenarios = _scenarios(old), _scenarios(new)
+    for expenses in sorted(set(old_scenarios) & set(new_scenarios)):
+        print(f"\n{expenses:,} expenses")
+        old_routes, new_routes = old_scenarios[expenses], new_scenarios[expenses]
+        for name in [name for name in new_routes if name in old_routes]:
+            a, b = old_routes[name], new_routes[name]
+            p50, p95 = _change(a['p50_ms'], b['p50_ms']), _change(a['p95_ms'], b['p95_ms'])
+            mark = ''
+            if max(p50, p95) > args.threshold:
+                mark = '  slower'
+            elif min(p50, p95) < -args.threshold:
+                mark = '  faster'
+            print(f"  {name:<24} p50 {a['p50_ms']:>9.2f} -> {b['p50_ms']:>9.2f} ms ({p50:+6.1f}%)  "
+                  f"p95 {a['p95_ms']:>9.2f} -> {b['p95_ms']:>9.2f} ms ({p95:+6.1f}%)  "
+                  f"queries {a['queries']:g} -> {b['queries']:g}{mark}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
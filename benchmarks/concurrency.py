@@ -0,0 +1,358 @@
+"""
+Concurrency benchmark
+
+Runs the app in a single gunicorn worker of each worker class and sends it
+a fixed number of simultaneous clients, each repeating one request for
+--duration seconds. Google and S3 are replaced by a local stand-in that
+answers after --delay seconds, so every request spends most of its time
+waiting on an external service:
+
+    login    the Google sign-in callback, which makes a token and a
+             userinfo request (two delays) and then signs the user in
+    upload   add_expense with a receipt. The upload queue is sized so that
+             receipts are uploaded inside the request, as happens when the
+             queue is full (one delay)
+
+For every worker class, scenario and client count the run reports
+completed requests per second, p50/p95 latency in milliseconds and failed
+requests (errors, or no response within --timeout). A sync worker answers
+one request at a time, so its throughput stays at about one request per
+delay (per two delays for logins) however many clients wait. A gevent
+worker overlaps the waits:
+
+    python -m benchmarks.concurrency --clients 1 10 50 --delay 0.5
+    DATABASE_URL=postgresql://localhost/bench python -m benchmarks.concurrency
+
+Without DATABASE_URL a temporary SQLite database is used. Results are
+written as JSON together with the git commit.
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import socket
+import logging
+import platform
+import argparse
+import tempfile
+import threading
+import subprocess
+from datetime import datetime
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+from werkzeug.security import generate_password_hash
+
+from benchmarks.routes import ROOT, git_commit
+from benchmarks.ledger import PASSWORD
+
+WORKER_CLASSES = ('sync', 'gevent')
+SCENARIOS = ('login', 'upload')
+BUCKET = 'bench'
+
+
+class StandIn(BaseHTTPRequestHandler):
+    """Google's OpenID endpoints and S3 object uploads, answered after ``server.delay``"""
+
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def _reply(self, status, document=None, headers=()):
+        body = json.dumps(document).encode() if document is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for name, value in headers:
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _read_body(self):
+        if 'chunked' not in self.headers.get('Transfer-Encoding', ''):
+            return self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        body = b''
+        while True:
+            size = int(self.rfile.readline().split(b';')[0], 16)
+            body += self.rfile.read(size + 2)[:size]
+            if size == 0:
+                # Trailers, if any, end with an empty line
+                while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                    pass
+                return body
+
+    def do_GET(self):
+        base = f"http://{self.headers['Host']}"
+        if self.path.startswith('/.well-known/openid-configuration'):
+            return self._reply(200, {
+                'authorization_endpoint': f"{base}/auth",
+                'token_endpoint': f"{base}/token",
+                'userinfo_endpoint': f"{base}/userinfo",
+            }, [('Cache-Control', 'max-age=3600')])
+        if self.path.startswith('/userinfo'):
+            time.sleep(self.server.delay)
+            subject = self.headers.get('Authorization', '').split()[-1]
+            return self._reply(200, {
+                'sub': subject, 'email': f"{subject}@example.com", 'email_verified': True, 'given_name': subject,
+            })
+        self._reply(404)
+
+    def do_POST(self):
+        form = parse_qs(self._read_body().decode())
+        if self.path.startswith('/token'):
+            time.sleep(self.server.delay)
+            # The code doubles as the access token, which names the user
+            code = form.get('code', ['bench'])[0]
+            return self._reply(200, {'access_token': code, 'token_type': 'Bearer', 'expires_in': 3600})
+        self._reply(404)
+
+    def do_PUT(self):
+        self._read_body()
+        time.sleep(self.server.delay)
+        self._reply(200, headers=[('ETag', f'"{uuid.uuid4().hex}"')])
+
+
+class StandInServer(ThreadingHTTPServer):
+    daemon_threads = True
+    # The default backlog of 5 resets connections when every client calls at once
+    request_queue_size = 256
+
+
+def start_stand_in(delay):
+    server = StandInServer(('127.0.0.1', 0), StandIn)
+    server.delay = delay
+    threading.Thread(target=server.serve_forever, name='stand-in', daemon=True).start()
+    return server
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def start_gunicorn(worker_class, env, timeout=30):
+    """Start one gunicorn worker of ``worker_class``; returns ``(process, base_url)``"""
+    port = free_port()
+    process = subprocess.Popen(
+        [sys.executable, '-m', 'gunicorn', '-c', os.path.join(ROOT, 'gunicorn.conf.py'), '--workers', '1',
+         '--worker-class', worker_class, '--bind', f"127.0.0.1:{port}", '--timeout', '300', 'app:app'],
+        cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+    )
+    base_url = f"http://127.0.0.1:{port}"
+    if not wait_until_idle(base_url, timeout):
+        process.terminate()
+        raise RuntimeError(f"gunicorn ({worker_class}) did not start within {timeout}s")
+    return process, base_url
+
+
+def wait_until_idle(base_url, timeout):
+    """
+    Wait until the app answers; a sync worker first works off the requests
+    that clients gave up on, so the next run does not queue behind them
+    """
+    import requests
+
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            requests.get(f"{base_url}/login", timeout=max(deadline - time.monotonic(), 1))
+            return True
+        except requests.RequestException:
+            time.sleep(0.1)
+    return False
+
+
+def signed_in_sessions(base_url, usernames, timeout):
+    import requests
+
+    sessions = []
+    for username in usernames:
+        session = requests.Session()
+        session.post(f"{base_url}/login", data={'username': username, 'password': PASSWORD}, timeout=timeout)
+        sessions.append(session)
+    return sessions
+
+
+def _login(session, base_url, client, timeout):
+    # The stand-in names the user after the code, so each client signs in as its own user
+    return session.get(
+        f"{base_url}/google_login/callback", params={'code': f"bench-{client}"},
+        allow_redirects=False, timeout=timeout,
+    )
+
+
+def _upload(session, base_url, client, timeout):
+    return session.post(
+        f"{base_url}/add_expense",
+        data={'date': '2024-01-01', 'category': 'Food', 'amount': '1.00', 'description': 'benchmark'},
+        # Distinct content, since receipts already in the store are not uploaded again
+        files={'receipt': ('receipt.pdf', os.urandom(4096), 'application/pdf')},
+        allow_redirects=False, timeout=timeout,
+    )
+
+
+def run_clients(scenario, base_url, sessions, duration, timeout):
+    """Have one client per session repeat ``scenario`` for ``duration`` seconds"""
+    import requests
+
+    request = {'login': _login, 'upload': _upload}[scenario]
+    clients = len(sessions)
+    latencies, failures = [], []
+    lock = threading.Lock()
+    start = threading.Barrier(clients + 1)
+
+    def client(index):
+        session = sessions[index]
+        start.wait()
+        while time.monotonic() < stop_at:
+            started = time.perf_counter()
+            try:
+                response = request(session, base_url, index, timeout)
+                # Both succeed with a redirect to the dashboard and fail back to their form
+                ok = response.status_code == 302 and urlparse(response.headers['Location']).path == '/'
+            except requests.RequestException:
+                ok = False
+            elapsed = time.perf_counter() - started
+            with lock:
+                (latencies if ok else failures).append(elapsed)
+
+    threads = [threading.Thread(target=client, args=(i,), daemon=True) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    stop_at = time.monotonic() + duration
+    start.wait()
+    began = time.monotonic()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - began
+
+    latencies.sort()
+
+    def percentile(p):
+        return latencies[min(int(len(latencies) * p), len(latencies) - 1)] * 1000 if latencies else 0.0
+
+    return {
+        'clients': clients,
+        'completed': len(latencies),
+        'failed': len(failures),
+        'throughput': len(latencies) / elapsed,
+        'p50_ms': percentile(0.50),
+        'p95_ms': percentile(0.95),
+    }
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark concurrent slow logins and uploads on one worker')
+    parser.add_argument('--clients', type=int, nargs='+', default=[1, 10, 50], help='Simultaneous clients')
+    parser.add_argument('--delay', type=float, default=0.5, help='Seconds the stand-in Google and S3 take to answer')
+    parser.add_argument('--duration', type=float, default=10, help='Seconds each client count runs for')
+    parser.add_argument('--timeout', type=float, default=30, help='Seconds before a request counts as failed')
+    parser.add_argument('--worker-classes', nargs='+', default=list(WORKER_CLASSES), choices=WORKER_CLASSES)
+    parser.add_argument('--scenarios', nargs='+', default=list(SCENARIOS), choices=SCENARIOS)
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/concurrency-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    logging.basicConfig(level=logging.WARNING)
+    workdir = tempfile.mkdtemp(prefix='spendizo-bench-')
+    if not os.getenv('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{workdir}/bench.db"
+
+    import requests
+    import db
+    import migrations
+
+    # One user per upload client, as the expenses of one user contend for
+    # the same rollup and data version rows
+    prefix = f"concurrency-{time.time_ns()}"
+    usernames = [f"{prefix}-{index}" for index in range(max(args.clients))]
+    password_hash = generate_password_hash(PASSWORD)
+    with db.connection() as conn:
+        migrations.upgrade(conn)
+        for username in usernames:
+            conn.query('insert_user', (username, password_hash))
+        conn.commit()
+    dialect = db.get_pool().dialect
+    db.get_pool().dispose()
+
+    stand_in = start_stand_in(args.delay)
+    stand_in_url = f"http://127.0.0.1:{stand_in.server_address[1]}"
+    env = dict(
+        os.environ,
+        GOOGLE_CLIENT_ID='benchmark',
+        GOOGLE_CLIENT_SECRET='benchmark',
+        GOOGLE_DISCOVERY_URL=f"{stand_in_url}/.well-known/openid-configuration",
+        # The stand-in speaks plain HTTP
+        OAUTHLIB_INSECURE_TRANSPORT='1',
+        STORAGE_TYPE='s3',
+        S3_BUCKET=BUCKET,
+        S3_ACCESS_KEY='benchmark',
+        S3_SECRET_KEY='benchmark',
+        S3_REGION='us-east-1',
+        S3_ENDPOINT_URL=stand_in_url,
+        RECEIPT_SPOOL_DIR=os.path.join(workdir, 'spool'),
+        # No queue: every receipt but the one in flight is uploaded by its request
+        RECEIPT_UPLOAD_WORKERS='1',
+        RECEIPT_UPLOAD_QUEUE_SIZE='0',
+        RECEIPT_UPLOAD_QUEUE_TIMEOUT='0',
+        RECEIPT_UPLOAD_RETRIES='1',
+        # Room for most clients' connections, within PostgreSQL's default
+        # limit of 100; requests beyond it wait for a pooled connection
+        DB_POOL_SIZE=str(min(max(args.clients), 50) + 5),
+        DB_MAX_OVERFLOW='0',
+        OAUTH_HTTP_POOL_SIZE=str(max(args.clients)),
+        S3_POOL_SIZE=str(max(args.clients)),
+    )
+
+    commit, dirty = git_commit()
+    print(f"Benchmarking concurrency of commit {commit or 'unknown'}{' (modified)' if dirty else ''} on {dialect}, "
+          f"{args.delay:g}s per external call, one worker")
+
+    results = []
+    for worker_class in args.worker_classes:
+        process, base_url = start_gunicorn(worker_class, env)
+        try:
+            uploaders = signed_in_sessions(base_url, usernames, args.timeout)
+            for scenario in args.scenarios:
+                print(f"\n{worker_class} worker, {scenario}")
+                for clients in args.clients:
+                    if scenario == 'upload':
+                        sessions = uploaders[:clients]
+                    else:
+                        sessions = [requests.Session() for _ in range(clients)]
+                    result = run_clients(scenario, base_url, sessions, args.duration, args.timeout)
+                    wait_until_idle(base_url, 600)
+                    result.update(worker_class=worker_class, scenario=scenario)
+                    results.append(result)
+                    print(f"  {clients:>4} clients  {result['throughput']:>8.1f}/s  p50 {result['p50_ms']:>9.1f}"
+                          f"  p95 {result['p95_ms']:>9.1f} ms  {result['failed']} failed")
+        finally:
+            process.terminate()
+            process.wait()
+    stand_in.shutdown()
+
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"concurrency-{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'meta': {
+                'commit': commit,
+                'dirty': dirty,
+                'created': datetime.now().isoformat(timespec='seconds'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'dialect': dialect,
+                'delay': args.delay,
+                'duration': args.duration,
+            },
+            'results': results,
+        }, f, indent=2)
+    print(f"\nResults written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
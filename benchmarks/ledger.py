@@ -0,0 +1,119 @@
+"""
+Synthetic users for the benchmarks
+
+Each user gets ``expenses`` expenses spread evenly over the last ``years``
+years, in the app's categories, and ``budgets`` budgets starting within the
+last year. Expenses are bulk-inserted with ``Connection.copy_rows`` and the
+rollups rebuilt afterwards, so a million-row history loads in seconds.
+
+Used by ``benchmarks.routes``, or on its own to fill a database for manual
+testing:
+
+    DATABASE_URL=sqlite:///bench.db python -m benchmarks.ledger --expenses 100000
+"""
+import sys
+import random
+import argparse
+from datetime import date, timedelta
+from werkzeug.security import generate_password_hash
+import db
+import rollups
+import importer
+import migrations
+
+PASSWORD = 'benchmark'
+
+CATEGORIES = ('Food', 'Transportation', 'Entertainment', 'Shopping', 'Bills', 'Other')
+
+MERCHANTS = {
+    'Food': ('Grocery Mart', 'Corner Cafe', 'Pizza Place', 'Bakery', 'Sushi Bar'),
+    'Transportation': ('Metro Card', 'Fuel Station', 'Taxi', 'Parking', 'Train Ticket'),
+    'Entertainment': ('Cinema', 'Streaming', 'Concert Hall', 'Bowling', 'Bookstore'),
+    'Shopping': ('Department Store', 'Online Order', 'Shoe Shop', 'Electronics', 'Pharmacy'),
+    'Bills': ('Electricity', 'Water', 'Internet', 'Phone', 'Rent'),
+    'Other': ('Gift', 'Donation', 'Haircut', 'Laundry', 'Post Office'),
+}
+
+BATCH_SIZE = 10000
+
+
+def _expense_rows(user_id, count, years, rng):
+    today = date.today()
+    days = max(int(365 * years), 1)
+    for i in range(count):
+        # Spread evenly over the window, oldest first
+        day = today - timedelta(days=days - 1 - (i * days) // count)
+        category = rng.choice(CATEGORIES)
+        amount_cents = round(rng.lognormvariate(3, 1) * 100)
+        description = f"{rng.choice(MERCHANTS[category])} #{rng.randrange(1000)}"
+        yield user_id, day, category, amount_cents, description
+
+
+def create_user(conn, username, expenses, budgets, years=5, seed=0):
+    """
+    Create a user with a synthetic history and commit it
+
+    Args:
+        conn: A pooled connection
+        username: Must not exist yet; the password is PASSWORD
+        expenses: Number of expenses to generate
+        budgets: Number of budgets to generate
+        years: Length of the expense history
+        seed: Seed for the generated values
+
+    Returns:
+        The new user's id
+    """
+    from app import BUDGET_PERIOD_DAYS
+
+    rng = random.Random(seed)
+    conn.query('insert_user', (username, generate_password_hash(PASSWORD)))
+    user_id = conn.query('user_id_by_username', (username,)).fetchone()[0]
+
+    batch = []
+    for row in _expense_rows(user_id, expenses, years, rng):
+        batch.append(row)
+        if len(batch) >= BATCH_SIZE:
+            conn.copy_rows('expenses', importer.EXPENSE_COLUMNS, batch)
+            batch = []
+    if batch:
+        conn.copy_rows('expenses', importer.EXPENSE_COLUMNS, batch)
+    rollups.rebuild_rollups(conn, user_id)
+
+    today = date.today()
+    for _ in range(budgets):
+        period = rng.choice(tuple(BUDGET_PERIOD_DAYS))
+        start = today - timedelta(days=rng.randrange(365))
+        conn.query('insert_budget', (
+            user_id, rng.choice(CATEGORIES), rng.randrange(100, 5000, 50) * 100, period,
+            start, start + timedelta(days=BUDGET_PERIOD_DAYS[period]),
+        ))
+    conn.commit()
+    if conn.dialect == 'postgresql':
+        # Autovacuum would get to it eventually; plan against fresh statistics now
+        conn.execute('ANALYZE expenses')
+        conn.execute('ANALYZE budgets')
+        conn.commit()
+    return user_id
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Create synthetic SpendiZO users in DATABASE_URL')
+    parser.add_argument('--users', type=int, default=1)
+    parser.add_argument('--expenses', type=int, default=10000, help='Expenses per user')
+    parser.add_argument('--budgets', type=int, default=24, help='Budgets per user')
+    parser.add_argument('--years', type=float, default=5, help='Length of each expense history')
+    parser.add_argument('--prefix', default='bench', help='Username prefix')
+    args = parser.parse_args(argv)
+
+    with db.connection() as conn:
+        migrations.upgrade(conn)
+        for i in range(args.users):
+            username = f"{args.prefix}-{args.expenses}-{i}"
+            user_id = create_user(conn, username, args.expenses, args.budgets, args.years, seed=i)
+            print(f"Created {username} (id {user_id}, password '{PASSWORD}')")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,372 @@
+"""
+Route benchmarks
+
+Creates a synthetic user per history size (see ledger.py), logs in through
+the Flask test client and requests every route in turn, recording per
+route:
+
+    throughput      requests per second, one request at a time
+    p50/p95/p99     latency in milliseconds, including reading the body
+    queries         statements run per request (see db.add_query_listener)
+    query_ms        time spent in those statements per request
+    peak_memory_kb  peak Python allocations during one extra request, traced
+                    separately with tracemalloc so it does not skew latency
+
+Read routes run before write routes so the writes do not change what the
+reads see. The results are printed and written as JSON together with the
+git commit, for comparing runs with ``benchmarks.compare``:
+
+    python -m benchmarks.routes --expenses 1000 100000 --requests 50
+    DATABASE_URL=postgresql://localhost/bench python -m benchmarks.routes
+
+Without DATABASE_URL a temporary SQLite database is used. The response
+cache is off unless --response-cache is given, so the numbers measure the
+work behind each route. With --archive-after-months each user's expenses
+older than that are archived (see archive.py) before the routes run.
+
+Reports longer than REPORT_SYNC_MAX_DAYS (report_year, report_all) are
+background jobs, so those routes time queueing the job rather than writing
+the report. The user's unfinished jobs are deleted after every request,
+untimed, so REPORT_MAX_ACTIVE_JOBS never turns the next one away; most are
+deleted before a report worker picks them up.
+
+Google login and receipt serving need external services and are not
+covered.
+"""
+import io
+import os
+import sys
+import json
+import time
+import logging
+import uuid
+import platform
+import argparse
+import tempfile
+import subprocess
+import tracemalloc
+from datetime import date, datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class Route:
+    """
+    A benchmarked request
+
+    Args:
+        name: Key in the results
+        method: HTTP method
+        build: Called with the run's Context before each request; returns
+            ``(path, form_data)``
+        write: Whether the request changes the user's data
+        after: Called with the Context after each request, untimed
+    """
+
+    def __init__(self, name, method, build, write=False, after=None):
+        self.name = name
+        self.method = method
+        self.build = build
+        self.write = write
+        self.after = after
+
+
+class Context:
+    """Per-scenario state the routes build their requests from"""
+
+    def __init__(self, conn, user_id):
+        self.conn = conn
+        self.user_id = user_id
+        self.counter = 0
+        today = date.today()
+        self.month = today.strftime('%Y-%m')
+        self.year_start = today.replace(year=today.year - 1).isoformat()
+        self.date = today
+        self.today = today.isoformat()
+        count = conn.execute('SELECT COUNT(*) FROM expenses WHERE user_id = ?', (user_id,)).fetchone()[0]
+        middle = conn.execute(
+            'SELECT date, id FROM expenses WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT 1 OFFSET ?',
+            (user_id, count // 2),
+        ).fetchone()
+        self.cursor = f"{middle[0]}_{middle[1]}" if middle else ''
+        self.etag = None
+
+    def next(self):
+        self.counter += 1
+        return self.counter
+
+    def latest(self, table, column='description', value='benchmark'):
+        # Ids of rows created by the write routes, newest first
+        row = self.conn.execute(
+            f'SELECT id FROM {table} WHERE user_id = ? AND {column} = ? ORDER BY id DESC LIMIT 1',
+            (self.user_id, value),
+        ).fetchone()
+        self.conn.commit()
+        return row[0] if row else 0
+
+    def clear_report_jobs(self):
+        import report_jobs
+
+        self.conn.execute(
+            'DELETE FROM report_jobs WHERE user_id = ? AND status IN (?, ?)',
+            (self.user_id, report_jobs.STATUS_QUEUED, report_jobs.STATUS_RUNNING),
+        )
+        self.conn.commit()
+
+
+def _statement_csv(ctx):
+    n = ctx.next()
+    lines = ['Date,Amount,Description']
+    lines.extend(f"{ctx.today},{i + 1}.25,benchmark import {n}-{i}" for i in range(100))
+    return io.BytesIO('\n'.join(lines).encode())
+
+
+ROUTES = [
+    Route('login_page', 'GET', lambda ctx: ('/login', None)),
+    Route('index', 'GET', lambda ctx: ('/', None)),
+    Route('index_deep_page', 'GET', lambda ctx: (f'/?after={ctx.cursor}', None)),
+    Route('api_summary', 'GET', lambda ctx: ('/api/dashboard/summary', None)),
+    Route('api_categories', 'GET', lambda ctx: ('/api/dashboard/categories', None)),
+    Route('api_monthly', 'GET', lambda ctx: ('/api/dashboard/monthly', None)),
+    Route('api_expenses', 'GET', lambda ctx: ('/api/expenses', None)),
+    Route('api_expenses_deep_page', 'GET', lambda ctx: (f'/api/expenses?after={ctx.cursor}', None)),
+    Route('api_search_text', 'GET', lambda ctx: ('/api/search?q=grocery', None)),
+    Route('api_search_filtered', 'GET', lambda ctx: (
+        f'/api/search?q=mart&category=Food&min_amount=100&from={ctx.year_start}&to={ctx.today}', None)),
+    Route('api_search_amounts', 'GET', lambda ctx: ('/api/search?min_amount=100&max_amount=200', None)),
+    Route('search_page', 'GET', lambda ctx: ('/search?q=grocery&page=2', None)),
+    Route('budget', 'GET', lambda ctx: ('/budget', None)),
+    Route('report_month', 'GET', lambda ctx: (f'/download_report?month={ctx.month}', None)),
+    Route('report_year', 'GET', lambda ctx: (f'/download_report?from={ctx.year_start}&to={ctx.today}', None),
+          after=Context.clear_report_jobs),
+    Route('report_all', 'GET', lambda ctx: ('/download_report?all=1', None), after=Context.clear_report_jobs),
+    Route('add_expense_page', 'GET', lambda ctx: ('/add_expense', None)),
+    Route('import_page', 'GET', lambda ctx: ('/import', None)),
+    Route('login', 'POST', lambda ctx: ('/login', {'username': ctx.username, 'password': ctx.password})),
+    Route('register', 'POST', lambda ctx: ('/register', {
+        'username': f'bench-register-{uuid.uuid4().hex}', 'password': 'benchmark',
+    }), write=True),
+    Route('add_expense', 'POST', lambda ctx: ('/add_expense', {
+        'date': ctx.today, 'category': 'Food', 'amount': '12.50', 'description': 'benchmark',
+    }), write=True),
+    Route('delete_expense', 'POST', lambda ctx: ('/delete_expense', {
+        'expense_id': ctx.latest('expenses'),
+    }), write=True),
+    Route('add_budget', 'POST', lambda ctx: ('/add_budget', {
+        'category': 'Food', 'amount': '1000', 'period': 'monthly', 'start_date': ctx.today,
+    }), write=True),
+    Route('delete_budget', 'POST', lambda ctx: ('/delete_budget', {
+        'budget_id': ctx.latest('budgets', 'start_date', ctx.date),
+    }), write=True),
+    Route('import', 'POST', lambda ctx: ('/import', {
+        'statement': (_statement_csv(ctx), 'statement.csv'), 'format': 'csv', 'sign': 'positive',
+    }), write=True),
+]
+
+
+def percentile(values, pct):
+    """Nearest-rank percentile of a sorted list"""
+    if not values:
+        return 0.0
+    index = max(int(round(pct / 100 * len(values) + 0.5)) - 1, 0)
+    return values[min(index, len(values) - 1)]
+
+
+class QueryCounter:
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, statement, seconds):
+        self.count += 1
+        self.seconds += seconds
+
+    def reset(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+def _request(route, ctx):
+    path, data = route.build(ctx)
+    return route.method, path, data
+
+
+def _after(route, ctx):
+    if route.after is not None:
+        route.after(ctx)
+
+
+def _send(client, method, path, data):
+    response = client.open(path, method=method, data=data)
+    # Drain streamed bodies such as the CSV reports
+    response.get_data()
+    response.close()
+    return response.status_code
+
+
+def bench_route(client, route, ctx, counter, requests, warmup):
+    for _ in range(warmup):
+        _send(client, *_request(route, ctx))
+        _after(route, ctx)
+
+    latencies = []
+    queries = 0
+    query_seconds = 0.0
+    statuses = {}
+    for _ in range(requests):
+        request = _request(route, ctx)
+        counter.reset()
+        started = time.perf_counter()
+        status = _send(client, *request)
+        latencies.append(time.perf_counter() - started)
+        queries += counter.count
+        query_seconds += counter.seconds
+        statuses[str(status)] = statuses.get(str(status), 0) + 1
+        _after(route, ctx)
+
+    request = _request(route, ctx)
+    tracemalloc.start()
+    try:
+        _send(client, *request)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    _after(route, ctx)
+
+    total = sum(latencies)
+    latencies.sort()
+    return {
+        'requests': requests,
+        'statuses': statuses,
+        'throughput': round(requests / total, 2) if total else 0.0,
+        'mean_ms': round(total / requests * 1000, 3),
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'queries': round(queries / requests, 2),
+        'query_ms': round(query_seconds / requests * 1000, 3),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_scenario(app, expenses, budgets, args):
+    import db
+    from benchmarks import ledger
+
+    started = time.perf_counter()
+    username = f"bench-{expenses}-{uuid.uuid4().hex[:8]}"
+    with db.connection() as conn:
+        user_id = ledger.create_user(conn, username, expenses, budgets, args.years, seed=expenses)
+        if args.archive_after_months is not None:
+            import archive
+            archive.archive_expenses(conn, user_id)
+    setup_seconds = time.perf_counter() - started
+    print(f"\n{expenses:,} expenses, {budgets} budgets (generated in {setup_seconds:.1f}s)")
+
+    counter = QueryCounter()
+    db.add_query_listener(counter)
+    results = {}
+    try:
+        with db.connection() as conn:
+            ctx = Context(conn, user_id)
+            ctx.username, ctx.password = username, ledger.PASSWORD
+            client = app.test_client()
+            client.post('/login', data={'username': username, 'password': ledger.PASSWORD})
+
+            routes = [route for route in ROUTES if not args.routes or route.name in args.routes]
+            if not args.writes:
+                routes = [route for route in routes if not route.write]
+            # Reads first, so writes do not change what the reads see
+            for route in sorted(routes, key=lambda route: route.write):
+                result = bench_route(client, route, ctx, counter, args.requests, args.warmup)
+                results[route.name] = result
+                print(f"  {route.name:<24} {result['throughput']:>9.1f}/s  p50 {result['p50_ms']:>9.2f}  "
+                      f"p95 {result['p95_ms']:>9.2f}  p99 {result['p99_ms']:>9.2f} ms  "
+                      f"{result['queries']:>5.1f} queries  {result['peak_memory_kb']:>9.1f} KB")
+    finally:
+        db.remove_query_listener(counter)
+
+    return {
+        'expenses': expenses,
+        'budgets': budgets,
+        'setup_seconds': round(setup_seconds, 2),
+        'routes': results,
+    }
+
+
+def git_commit():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT, capture_output=True, text=True,
+                                check=True).stdout.strip()
+        dirty = bool(subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=ROOT,
+                                    capture_output=True, text=True).stdout.strip())
+    except (OSError, subprocess.CalledProcessError):
+        return None, None
+    return commit, dirty
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the SpendiZO routes')
+    parser.add_argument('--expenses', type=int, nargs='+', default=[1000, 10000, 100000],
+                        help='History sizes to benchmark, one synthetic user each')
+    parser.add_argument('--budgets', type=int, default=24, help='Budgets per user')
+    parser.add_argument('--years', type=float, default=5, help='Length of each expense history')
+    parser.add_argument('--requests', type=int, default=50, help='Timed requests per route')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed requests per route')
+    parser.add_argument('--routes', nargs='+', help='Only run these routes')
+    parser.add_argument('--no-writes', dest='writes', action='store_false', help='Skip routes that write')
+    parser.add_argument('--response-cache', default='none', choices=('none', 'memory', 'redis'))
+    parser.add_argument('--archive-after-months', type=int, default=None,
+                        help='Archive expenses older than this many months before running the routes')
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/<commit>.json)')
+    args = parser.parse_args(argv)
+
+    # Receipt spool and local storage paths are relative to the repository
+    os.chdir(ROOT)
+    # Keep per-request INFO logging out of the results table
+    logging.basicConfig(level=logging.WARNING)
+    if not os.getenv('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp(prefix='spendizo-bench-')}/bench.db"
+    if args.archive_after_months is not None:
+        os.environ['ARCHIVE_AFTER_MONTHS'] = str(args.archive_after_months)
+
+    import db
+    import migrations
+    import response_cache
+    from app import app
+
+    with db.connection() as conn:
+        migrations.upgrade(conn)
+    response_cache.set_backend(response_cache.create_backend(args.response_cache))
+
+    dialect = db.get_pool().dialect
+    commit, dirty = git_commit()
+    print(f"Benchmarking commit {commit or 'unknown'}{' (modified)' if dirty else ''} on {dialect}")
+
+    scenarios = [run_scenario(app, expenses, args.budgets, args) for expenses in args.expenses]
+
+    results = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'dialect': dialect,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'response_cache': args.response_cache,
+            'archive_after_months': args.archive_after_months,
+        },
+        'scenarios': scenarios,
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
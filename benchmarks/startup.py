@@ -0,0 +1,157 @@
+"""
+Startup benchmark
+
+Measures what a fresh process pays before it can answer, as on a serverless
+cold start or a gunicorn worker respawn. Every run starts a new interpreter
+that imports the app and sends its first requests through the Flask test
+client, recording:
+
+    import_ms          importing the ``app`` module
+    first_response_ms  the first request, the login page (no database)
+    first_query_ms     the first request that reads the database, the
+                       signed-in dashboard (opens the connection pool)
+    process_ms         wall time from starting the interpreter until both
+                       responses are done, as seen by the parent process
+    modules            modules loaded by then
+
+The report lists the median and the slowest run of each, and which of the
+heavier optional libraries importing the app loaded before any request
+needed them:
+
+    python -m benchmarks.startup --runs 20
+    DATABASE_URL=postgresql://localhost/bench python -m benchmarks.startup
+
+Without DATABASE_URL a temporary SQLite database is used. Results are
+written as JSON together with the git commit.
+"""
+import os
+import sys
+import json
+import time
+import logging
+import platform
+import argparse
+import tempfile
+import subprocess
+from datetime import datetime
+from statistics import median
+
+from benchmarks.routes import ROOT, git_commit
+
+# Libraries only some requests need; a cold start should not load them
+DEFERRED_MODULES = ('requests', 'oauthlib', 'psycopg2', 'boto3', 'google.cloud', 'PIL', 'openpyxl', 'reportlab')
+
+PROBE = f'''
+import os, sys, json, time
+started = time.perf_counter()
+preloaded = set(sys.modules)
+import app as module
+imported = time.perf_counter()
+loaded = [name for name in {DEFERRED_MODULES!r} if name in sys.modules and name not in preloaded]
+client = module.app.test_client()
+client.get('/login').get_data()
+first_response = time.perf_counter()
+with client.session_transaction() as session:
+    session['_user_id'] = os.environ['BENCH_USER_ID']
+    session['_fresh'] = True
+    session['_user_identity'] = [os.environ['BENCH_USER_ID'], os.environ['BENCH_USERNAME']]
+response = client.get('/')
+response.get_data()
+first_query = time.perf_counter()
+print(json.dumps({{
+    'status': response.status_code,
+    'import_ms': (imported - started) * 1000,
+    'first_response_ms': (first_response - imported) * 1000,
+    'first_query_ms': (first_query - first_response) * 1000,
+    'modules': len(sys.modules),
+    'loaded': loaded,
+}}))
+'''
+
+MEASURES = ('import_ms', 'first_response_ms', 'first_query_ms', 'process_ms', 'modules')
+
+
+def probe(env):
+    """Start one cold process and return its measurements"""
+    started = time.perf_counter()
+    completed = subprocess.run(
+        [sys.executable, '-c', PROBE], cwd=ROOT, env=env, capture_output=True, text=True, check=True
+    )
+    process_ms = (time.perf_counter() - started) * 1000
+    result = json.loads(completed.stdout.strip().splitlines()[-1])
+    if result['status'] != 200:
+        raise RuntimeError(f"Dashboard returned {result['status']} in the startup probe")
+    result['process_ms'] = process_ms
+    return result
+
+
+def summarize(runs):
+    summary = {}
+    for measure in MEASURES:
+        values = sorted(run[measure] for run in runs)
+        summary[measure] = {'median': median(values), 'max': values[-1]}
+    summary['loaded'] = sorted({name for run in runs for name in run['loaded']})
+    return summary
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark app import and time to first response')
+    parser.add_argument('--runs', type=int, default=10, help='Cold processes to start')
+    parser.add_argument('--expenses', type=int, default=1000, help='Expenses of the signed-in user')
+    parser.add_argument('--output', help='JSON results file (default benchmarks/results/startup-<commit>.json)')
+    args = parser.parse_args(argv)
+
+    os.chdir(ROOT)
+    logging.basicConfig(level=logging.WARNING)
+    if not os.getenv('DATABASE_URL'):
+        os.environ['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp(prefix='spendizo-bench-')}/bench.db"
+
+    import db
+    import migrations
+    from benchmarks import ledger
+
+    username = f"startup-{time.time_ns()}"
+    with db.connection() as conn:
+        migrations.upgrade(conn)
+        user_id = ledger.create_user(conn, username, args.expenses, budgets=0)
+    dialect = db.get_pool().dialect
+    db.get_pool().dispose()
+
+    commit, dirty = git_commit()
+    print(f"Benchmarking startup of commit {commit or 'unknown'}{' (modified)' if dirty else ''} on {dialect}")
+
+    env = dict(os.environ, BENCH_USER_ID=str(user_id), BENCH_USERNAME=username)
+    # One untimed run so every later run finds compiled bytecode, as a deployed app would
+    probe(env)
+    runs = [probe(env) for _ in range(args.runs)]
+    summary = summarize(runs)
+
+    for measure in MEASURES:
+        unit = '' if measure == 'modules' else ' ms'
+        print(f"  {measure:<20} median {summary[measure]['median']:>9.1f}{unit}  max {summary[measure]['max']:>9.1f}{unit}")
+    print(f"  optional libraries loaded on import: {', '.join(summary['loaded']) or 'none'}")
+
+    results = {
+        'meta': {
+            'commit': commit,
+            'dirty': dirty,
+            'created': datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'dialect': dialect,
+            'runs': args.runs,
+            'expenses': args.expenses,
+        },
+        'startup': summary,
+        'runs': runs,
+    }
+    output = args.output or os.path.join(ROOT, 'benchmarks', 'results', f"startup-{(commit or 'unknown')[:12]}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump(results, f, indent=2)
+    print(f"\nResults written to {output}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,97 @@
+"""
+In-process caching helpers
+"""
+import threading
+import time
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    A thread-safe LRU cache whose entries also expire after ``ttl`` seconds
+
+    With ``maxbytes`` set, entries are also evicted to keep the total
+    ``weigh(value)`` of the cache under that many bytes, and values larger
+    than the whole budget are not stored.
+
+    Hit, miss, eviction and expiry counts are kept for monitoring and are
+    returned by ``stats()``.
+    """
+
+    def __init__(self, maxsize=1024, ttl=None, maxbytes=None, weigh=len):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.maxbytes = maxbytes
+        self.weigh = weigh
+        self.bytes = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def _pop(self, key):
+        value, expires, weight = self._data.pop(key)
+        self.bytes -= weight
+        return value
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires, _ = entry
+            if expires is not None and time.monotonic() >= expires:
+                self._pop(key)
+                self.expirations += 1
+                self.misses += 1
+                return default
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = time.monotonic() + ttl if ttl else None
+        weight = self.weigh(value) if self.maxbytes else 0
+        with self._lock:
+            if key in self._data:
+                self._pop(key)
+            if self.maxbytes and weight > self.maxbytes:
+                return
+            self._data[key] = (value, expires, weight)
+            self.bytes += weight
+            while len(self._data) > self.maxsize or (self.maxbytes and self.bytes > self.maxbytes):
+                _, (_, _, evicted_weight) = self._data.popitem(last=False)
+                self.bytes -= evicted_weight
+                self.evictions += 1
+
+    def delete(self, key):
+        with self._lock:
+            if key not in self._data:
+                return False
+            self._pop(key)
+            return True
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.bytes = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'size': len(self._data),
+                'maxsize': self.maxsize,
+                'bytes': self.bytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'expirations': self.expirations,
+            }
@@ -1,6 +1,11 @@
 import os
+import threading
 import logging
+from datetime import timedelta
 from dotenv import load_dotenv
+import receipt_images
+import receipt_store
+import metrics
 
 load_dotenv()
 
@@ -11,128 +16,404 @@ logger = logging.getLogger(__name__)
 # Get storage configuration from environment variables
 STORAGE_TYPE = os.getenv('STORAGE_TYPE', 'local')
 
+# Root directory for local storage; receipts are served from static/ by default
+LOCAL_STORAGE_ROOT = os.getenv('LOCAL_STORAGE_ROOT', 'static')
 
-def save_file(file, filename, directory='receipts'):
+# Root directory for private files, such as generated reports; it must not
+# be under LOCAL_STORAGE_ROOT or anything else the web server serves
+LOCAL_PRIVATE_STORAGE_ROOT = os.getenv('LOCAL_PRIVATE_STORAGE_ROOT', 'private')
+
+# Uploads larger than this are sent to S3 in parts / to GCS in resumable chunks
+MULTIPART_THRESHOLD = int(os.getenv('STORAGE_MULTIPART_THRESHOLD', str(8 * 1024 * 1024)))
+# Must be a multiple of 256 KiB for GCS resumable uploads
+MULTIPART_CHUNK_SIZE = int(os.getenv('STORAGE_MULTIPART_CHUNK_SIZE', str(8 * 1024 * 1024)))
+
+# Kept-alive connections to S3 per process; raise it for gevent workers,
+# which upload many receipts at once
+S3_POOL_SIZE = int(os.getenv('S3_POOL_SIZE', '10'))
+
+# Receipts are stored under their content digest, so a stored object never
+# changes and may be cached indefinitely
+IMMUTABLE_CACHE_CONTROL = 'public, max-age=31536000, immutable'
+
+# Private files must not be kept by shared caches
+PRIVATE_CACHE_CONTROL = 'private, no-store'
+
+
+def _stream(file):
+    """Return a readable binary stream for a werkzeug FileStorage or file object"""
+    stream = getattr(file, 'stream', file)
+    try:
+        stream.seek(0)
+    except (AttributeError, OSError):
+        pass
+    return stream
+
+
+def _content_type(file):
+    return getattr(file, 'mimetype', None) or 'application/octet-stream'
+
+
+class StorageBackend:
     """
-    Save a file using the configured storage method
-    
-    Args:
-        file: The file object to save
-        filename: The name to save the file as
-        directory: The directory to save the file in
-        
-    Returns:
-        The path or URL where the file was saved
+    Base class for receipt storage backends
+
+    Backends are created once per process by ``get_backend`` and hold any
+    clients they need for the life of the process; they must be safe to use
+    from several threads at once.
+
+    Files saved with ``private=True`` belong to one user and are only handed
+    out by views that check who is asking: locally they are kept under
+    LOCAL_PRIVATE_STORAGE_ROOT instead of the served root, and in the cloud
+    they are stored with PRIVATE_CACHE_CONTROL and downloaded through
+    ``signed_url``. Read and delete them with ``private=True`` as well.
     """
-    if STORAGE_TYPE == 'local':
-        return save_local(file, filename, directory)
-    elif STORAGE_TYPE == 's3':
-        return save_to_s3(file, filename, directory)
-    elif STORAGE_TYPE == 'gcs':
-        return save_to_gcs(file, filename, directory)
-    else:
-        logger.warning(f"Unknown storage type: {STORAGE_TYPE}, falling back to local storage")
-        return save_local(file, filename, directory)
+    name = None
 
+    def save(self, file, filename, directory='receipts', private=False):
+        """
+        Store a file and return the path or URL to keep in the database
 
-def save_local(file, filename, directory='receipts'):
+        Args:
+            file: A werkzeug FileStorage or binary file object
+            filename: The name to save the file as
+            directory: The directory or key prefix to save the file under
+            private: Whether the file is private (see above)
+        """
+        raise NotImplementedError
+
+    def read(self, filename, directory='receipts', private=False):
+        """Return the contents of a file stored by ``save`` as bytes"""
+        raise NotImplementedError
+
+    def delete(self, filename, directory='receipts', private=False):
+        """Delete a file stored by ``save``; missing files are ignored"""
+        raise NotImplementedError
+
+    def signed_url(self, filename, directory, expires, download_name=None, content_type=None):
+        """
+        Return a URL that grants access to a stored file for ``expires``
+        seconds, or None if the backend cannot make one
+        """
+        return None
+
+
+class LocalStorage(StorageBackend):
     """
-    Save a file to the local filesystem
+    Stores files under a directory on the local filesystem
+
+    With a temporary ``root`` this also serves as a filesystem-backed fake
+    of the cloud backends in tests.
     """
-    try:
+    name = 'local'
+
+    def __init__(self, root=LOCAL_STORAGE_ROOT, private_root=LOCAL_PRIVATE_STORAGE_ROOT):
+        self.root = root
+        self.private_root = private_root
+
+    def file_path(self, path, private=False):
+        """Return where a path returned by ``save`` is on disk"""
+        return os.path.abspath(os.path.join(self.private_root if private else self.root, path))
+
+    def save(self, file, filename, directory='receipts', private=False):
         # Create directory if it doesn't exist
-        path = os.path.join('static', directory)
+        path = os.path.join(self.private_root if private else self.root, directory)
         os.makedirs(path, exist_ok=True)
-        
+
         # Save the file
         file_path = os.path.join(path, filename)
-        file.save(file_path)
-        
+        with open(file_path, 'wb') as out:
+            stream = _stream(file)
+            while True:
+                chunk = stream.read(MULTIPART_CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+
         # Return the relative path for database storage
         return os.path.join(directory, filename)
-    except Exception as e:
-        logger.error(f"Error saving file locally: {e}")
-        return None
 
+    def read(self, filename, directory='receipts', private=False):
+        with open(self.file_path(os.path.join(directory, filename), private), 'rb') as f:
+            return f.read()
 
-def save_to_s3(file, filename, directory='receipts'):
+    def delete(self, filename, directory='receipts', private=False):
+        try:
+            os.remove(self.file_path(os.path.join(directory, filename), private))
+        except FileNotFoundError:
+            pass
+
+
+class S3Storage(StorageBackend):
     """
-    Save a file to Amazon S3
+    Streams uploads to Amazon S3 or any S3-compatible store
+
+    Set S3_ENDPOINT_URL to use a local stand-in such as MinIO or moto.
     """
-    try:
+    name = 's3'
+
+    def __init__(self, bucket_name, access_key, secret_key, endpoint_url=None, region=None):
         import boto3
-        from botocore.exceptions import ClientError
-        
-        # Get S3 configuration
-        bucket_name = os.getenv('S3_BUCKET')
-        aws_access_key = os.getenv('S3_ACCESS_KEY')
-        aws_secret_key = os.getenv('S3_SECRET_KEY')
-        
-        if not all([bucket_name, aws_access_key, aws_secret_key]):
-            logger.error("Missing S3 configuration, falling back to local storage")
-            return save_local(file, filename, directory)
-        
-        # Create S3 client
-        s3_client = boto3.client(
+        from boto3.s3.transfer import TransferConfig
+        from botocore.config import Config as BotoConfig
+
+        self.bucket_name = bucket_name
+        self.endpoint_url = endpoint_url
+        # boto3 clients are thread-safe, so one is shared by all requests
+        self.client = boto3.client(
             's3',
-            aws_access_key_id=aws_access_key,
-            aws_secret_access_key=aws_secret_key
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key,
+            endpoint_url=endpoint_url,
+            region_name=region,
+            config=BotoConfig(max_pool_connections=S3_POOL_SIZE),
         )
-        
-        # Upload file
+        self.transfer_config = TransferConfig(
+            multipart_threshold=MULTIPART_THRESHOLD,
+            multipart_chunksize=MULTIPART_CHUNK_SIZE,
+        )
+
+    def save(self, file, filename, directory='receipts', private=False):
         object_name = f"{directory}/{filename}"
-        s3_client.upload_fileobj(file, bucket_name, object_name)
-        
-        # Return the S3 URL
-        return f"https://{bucket_name}.s3.amazonaws.com/{object_name}"
-    except ImportError:
-        logger.error("boto3 not installed, falling back to local storage")
-        return save_local(file, filename, directory)
-    except ClientError as e:
-        logger.error(f"Error uploading to S3: {e}")
-        return save_local(file, filename, directory)
+        cache_control = PRIVATE_CACHE_CONTROL if private else IMMUTABLE_CACHE_CONTROL
+        self.client.upload_fileobj(
+            _stream(file),
+            self.bucket_name,
+            object_name,
+            ExtraArgs={'ContentType': _content_type(file), 'CacheControl': cache_control},
+            Config=self.transfer_config,
+        )
+        if self.endpoint_url:
+            return f"{self.endpoint_url.rstrip('/')}/{self.bucket_name}/{object_name}"
+        return f"https://{self.bucket_name}.s3.amazonaws.com/{object_name}"
+
+    def read(self, filename, directory='receipts', private=False):
+        response = self.client.get_object(Bucket=self.bucket_name, Key=f"{directory}/{filename}")
+        return response['Body'].read()
+
+    def delete(self, filename, directory='receipts', private=False):
+        self.client.delete_object(Bucket=self.bucket_name, Key=f"{directory}/{filename}")
+
+    def signed_url(self, filename, directory, expires, download_name=None, content_type=None):
+        params = {'Bucket': self.bucket_name, 'Key': f"{directory}/{filename}"}
+        if download_name:
+            params['ResponseContentDisposition'] = f'attachment; filename="{download_name}"'
+        if content_type:
+            params['ResponseContentType'] = content_type
+        return self.client.generate_presigned_url('get_object', Params=params, ExpiresIn=expires)
+
+
+class GCSStorage(StorageBackend):
+    """Streams uploads to Google Cloud Storage, resumably for large files"""
+    name = 'gcs'
+
+    def __init__(self, bucket_name):
+        from google.cloud import storage
+
+        self.bucket_name = bucket_name
+        self.client = storage.Client()
+        self.bucket = self.client.bucket(bucket_name)
+
+    def save(self, file, filename, directory='receipts', private=False):
+        blob_name = f"{directory}/{filename}"
+        # Setting a chunk size makes the client use a resumable upload that
+        # reads the stream one chunk at a time
+        blob = self.bucket.blob(blob_name, chunk_size=MULTIPART_CHUNK_SIZE)
+        blob.cache_control = PRIVATE_CACHE_CONTROL if private else IMMUTABLE_CACHE_CONTROL
+        blob.upload_from_file(_stream(file), content_type=_content_type(file))
+        return f"https://storage.googleapis.com/{self.bucket_name}/{blob_name}"
+
+    def read(self, filename, directory='receipts', private=False):
+        return self.bucket.blob(f"{directory}/{filename}").download_as_bytes()
+
+    def delete(self, filename, directory='receipts', private=False):
+        from google.cloud.exceptions import NotFound
+
+        try:
+            self.bucket.blob(f"{directory}/{filename}").delete()
+        except NotFound:
+            pass
+
+    def signed_url(self, filename, directory, expires, download_name=None, content_type=None):
+        # Needs credentials that can sign, such as a service account key
+        return self.bucket.blob(f"{directory}/{filename}").generate_signed_url(
+            version='v4',
+            expiration=timedelta(seconds=expires),
+            response_disposition=f'attachment; filename="{download_name}"' if download_name else None,
+            response_type=content_type,
+        )
+
+
+def create_backend(storage_type=STORAGE_TYPE):
+    """
+    Build the backend for ``storage_type``, falling back to local storage
+    when it is unknown, misconfigured or its client library is missing
+    """
+    try:
+        if storage_type == 'local':
+            return LocalStorage()
+        elif storage_type == 's3':
+            bucket_name = os.getenv('S3_BUCKET')
+            aws_access_key = os.getenv('S3_ACCESS_KEY')
+            aws_secret_key = os.getenv('S3_SECRET_KEY')
+            if not all([bucket_name, aws_access_key, aws_secret_key]):
+                logger.error("Missing S3 configuration, falling back to local storage")
+                return LocalStorage()
+            return S3Storage(
+                bucket_name,
+                aws_access_key,
+                aws_secret_key,
+                endpoint_url=os.getenv('S3_ENDPOINT_URL'),
+                region=os.getenv('S3_REGION'),
+            )
+        elif storage_type == 'gcs':
+            bucket_name = os.getenv('GCS_BUCKET')
+            if not bucket_name:
+                logger.error("Missing GCS configuration, falling back to local storage")
+                return LocalStorage()
+            return GCSStorage(bucket_name)
+        else:
+            logger.warning(f"Unknown storage type: {storage_type}, falling back to local storage")
+            return LocalStorage()
+    except ImportError as e:
+        logger.error(f"Storage client library not installed ({e}), falling back to local storage")
+        return LocalStorage()
     except Exception as e:
-        logger.error(f"Unexpected error uploading to S3: {e}")
-        return save_local(file, filename, directory)
+        logger.error(f"Error creating {storage_type} storage client: {e}, falling back to local storage")
+        return LocalStorage()
+
 
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
 
-def save_to_gcs(file, filename, directory='receipts'):
+
+def get_backend():
     """
-    Save a file to Google Cloud Storage
+    Return this process's storage backend, creating it on first use
+
+    Like the database pool it is rebuilt after a fork, since client
+    connection pools must not be shared between gunicorn workers.
     """
+    global _backend, _backend_pid
+    pid = os.getpid()
+    if _backend is None or _backend_pid != pid:
+        with _backend_lock:
+            if _backend is None or _backend_pid != pid:
+                _backend = create_backend()
+                _backend_pid = pid
+    return _backend
+
+
+def backend_for(storage):
+    """Return the backend for files stored by ``storage``, or None if it is not configured"""
+    backend = get_backend()
+    if backend.name == storage:
+        return backend
+    if storage == 'local':
+        # Files kept locally after a cloud upload failed
+        return LocalStorage()
+    return None
+
+
+def set_backend(backend):
+    """Replace the process's backend, e.g. with a LocalStorage fake in tests"""
+    global _backend, _backend_pid
+    with _backend_lock:
+        _backend = backend
+        _backend_pid = os.getpid()
+
+
+def store_receipt(backend, file, filename, processed=None, directory='receipts'):
+    """
+    Store a receipt, and the thumbnail of a processed receipt image
+
+    Receipts are private files, only handed out by ``receipt_store.serve``.
+    Errors are raised rather than handled, so callers can retry.
+
+    Args:
+        backend: The StorageBackend to store the files with
+        file: The original file object
+        filename: The name to save the file as
+        processed: The ProcessedReceipt for ``file``, if it was processed
+        directory: The directory to save the file in; thumbnails are saved
+            under its ``thumbs`` subdirectory
+
+    Returns:
+        ``(path, thumbnail_path)``, where ``thumbnail_path`` is None for
+        receipts that were not processed
+    """
+    thumbnail_path = None
+    if processed is not None:
+        file, filename = processed.image, processed.filename
+        with metrics.timed(backend.name, 'save'):
+            thumbnail_path = backend.save(processed.thumbnail, filename, f"{directory}/thumbs", private=True)
+    with metrics.timed(backend.name, 'save'):
+        return backend.save(file, filename, directory, private=True), thumbnail_path
+
+
+def save_receipt(file, filename, directory='receipts'):
+    """
+    Process a receipt image and save it with its thumbnail
+
+    The file is named by its content digest (see receipt_store.py), so
+    saving the same receipt twice stores it once.
+
+    Returns:
+        ``(path, thumbnail_path)``, or ``(None, None)`` if it could not be saved
+    """
+    filename = receipt_store.content_filename(receipt_store.content_digest(file), filename)
+    processed = receipt_images.process_receipt(file, filename)
+    backend = get_backend()
     try:
-        from google.cloud import storage
-        
-        # Get GCS configuration
-        bucket_name = os.getenv('GCS_BUCKET')
-        
-        if not bucket_name:
-            logger.error("Missing GCS configuration, falling back to local storage")
-            return save_local(file, filename, directory)
-        
-        # Create GCS client
-        storage_client = storage.Client()
-        bucket = storage_client.bucket(bucket_name)
-        
-        # Upload file
-        blob_name = f"{directory}/{filename}"
-        blob = bucket.blob(blob_name)
-        
-        # Save to a temporary file first
-        temp_path = f"/tmp/{filename}"
-        file.save(temp_path)
-        
-        # Upload the file
-        blob.upload_from_filename(temp_path)
-        
-        # Clean up temporary file
-        os.remove(temp_path)
-        
-        # Return the GCS URL
-        return f"https://storage.googleapis.com/{bucket_name}/{blob_name}"
-    except ImportError:
-        logger.error("google-cloud-storage not installed, falling back to local storage")
+        return store_receipt(backend, file, filename, processed, directory)
+    except Exception as e:
+        if isinstance(backend, LocalStorage):
+            logger.error(f"Error saving file locally: {e}")
+            return None, None
+        logger.error(f"Error uploading to {backend.name}: {e}, falling back to local storage")
+    try:
+        return store_receipt(LocalStorage(), file, filename, processed, directory)
+    except Exception as e:
+        logger.error(f"Error saving file locally: {e}")
+        return None, None
+
+
+def save_file(file, filename, directory='receipts'):
+    """
+    Save a file using the configured storage method
+
+    Receipts are processed first; see ``save_receipt``.
+
+    Args:
+        file: The file object to save
+        filename: The name to save the file as
+        directory: The directory to save the file in
+
+    Returns:
+        The path or URL where the file was saved
+    """
+    if directory == 'receipts':
+        return save_receipt(file, filename, directory)[0]
+
+    backend = get_backend()
+    try:
+        with metrics.timed(backend.name, 'save'):
+            return backend.save(file, filename, directory)
+    except Exception as e:
+        if isinstance(backend, LocalStorage):
+            logger.error(f"Error saving file locally: {e}")
+            return None
+        logger.error(f"Error uploading to {backend.name}: {e}, falling back to local storage")
         return save_local(file, filename, directory)
+
+
+def save_local(file, filename, directory='receipts'):
+    """
+    Save a file to the local filesystem
+    """
+    try:
+        return LocalStorage().save(file, filename, directory)
     except Exception as e:
-        logger.error(f"Error uploading to GCS: {e}")
-        return save_local(file, filename, directory)
\ No newline at end of file
+        logger.error(f"Error saving file locally: {e}")
+        return None
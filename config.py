@@ -7,8 +7,110 @@ class Config:
     # Flask Configuration
     SECRET_KEY = os.getenv('SECRET_KEY', 'default-secret-key')
     DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///database.db')
+
+    # Database Connection Pool Configuration
+    DB_POOL_SIZE = int(os.getenv('DB_POOL_SIZE', '5'))
+    DB_MAX_OVERFLOW = int(os.getenv('DB_MAX_OVERFLOW', '10'))
+    DB_POOL_RECYCLE = int(os.getenv('DB_POOL_RECYCLE', '1800'))
+    DB_POOL_TIMEOUT = int(os.getenv('DB_POOL_TIMEOUT', '30'))
+    DB_STATEMENT_CACHE_SIZE = int(os.getenv('DB_STATEMENT_CACHE_SIZE', '128'))
+    # PostgreSQL sslmode for URLs that do not give one; empty leaves it to libpq
+    DB_SSLMODE = os.getenv('DB_SSLMODE', 'require')
+
+    # Read replicas for read-only views, comma separated (see db.py)
+    DATABASE_REPLICA_URLS = [url.strip() for url in os.getenv('DATABASE_REPLICA_URLS', '').split(',') if url.strip()]
+    # Seconds a user's reads stay on the primary after they write
+    REPLICA_STICKY_SECONDS = float(os.getenv('REPLICA_STICKY_SECONDS', '10'))
+    # Seconds an unreachable replica is skipped before it is tried again
+    REPLICA_RETRY_SECONDS = float(os.getenv('REPLICA_RETRY_SECONDS', '30'))
+
+    # Users cached per worker by the Flask-Login user loader
+    USER_CACHE_SIZE = int(os.getenv('USER_CACHE_SIZE', '1024'))
+    USER_CACHE_TTL = int(os.getenv('USER_CACHE_TTL', '300'))
+
+    # Number of expenses shown per dashboard page
+    EXPENSES_PAGE_SIZE = int(os.getenv('EXPENSES_PAGE_SIZE', '50'))
+    # Largest page the expenses API returns
+    API_MAX_PAGE_SIZE = int(os.getenv('API_MAX_PAGE_SIZE', '500'))
+
+    # Background receipt uploads
+    RECEIPT_SPOOL_DIR = os.getenv('RECEIPT_SPOOL_DIR', os.path.join('spool', 'receipts'))
+    RECEIPT_UPLOAD_WORKERS = int(os.getenv('RECEIPT_UPLOAD_WORKERS', '4'))
+    RECEIPT_UPLOAD_QUEUE_SIZE = int(os.getenv('RECEIPT_UPLOAD_QUEUE_SIZE', '32'))
+    RECEIPT_UPLOAD_QUEUE_TIMEOUT = float(os.getenv('RECEIPT_UPLOAD_QUEUE_TIMEOUT', '2'))
+    RECEIPT_UPLOAD_RETRIES = int(os.getenv('RECEIPT_UPLOAD_RETRIES', '3'))
+    RECEIPT_UPLOAD_BACKOFF = float(os.getenv('RECEIPT_UPLOAD_BACKOFF', '1'))
+    # Uploads claimed longer ago than this are assumed lost with their worker and requeued
+    RECEIPT_UPLOAD_TIMEOUT = int(os.getenv('RECEIPT_UPLOAD_TIMEOUT', '900'))
+
+    # Receipt image processing (see receipt_images.py)
+    RECEIPT_IMAGE_PROCESSING = os.getenv('RECEIPT_IMAGE_PROCESSING', 'true').lower() in ('1', 'true', 'yes')
+    RECEIPT_IMAGE_WORKERS = int(os.getenv('RECEIPT_IMAGE_WORKERS', '2'))
+    RECEIPT_IMAGE_FORMAT = os.getenv('RECEIPT_IMAGE_FORMAT', 'JPEG').upper()
+    RECEIPT_IMAGE_MAX_DIMENSION = int(os.getenv('RECEIPT_IMAGE_MAX_DIMENSION', '2000'))
+    RECEIPT_IMAGE_QUALITY = int(os.getenv('RECEIPT_IMAGE_QUALITY', '80'))
+    RECEIPT_IMAGE_MAX_BYTES = int(os.getenv('RECEIPT_IMAGE_MAX_BYTES', str(25 * 1024 * 1024)))
+    RECEIPT_IMAGE_TIMEOUT = float(os.getenv('RECEIPT_IMAGE_TIMEOUT', '30'))
+    RECEIPT_THUMBNAIL_SIZE = int(os.getenv('RECEIPT_THUMBNAIL_SIZE', '320'))
+
+    # Serving receipts (see receipt_store.py). Receipt URLs are named by
+    # content digest, so their bytes never change.
+    RECEIPT_CACHE_CONTROL = os.getenv('RECEIPT_CACHE_CONTROL', 'private, max-age=31536000, immutable')
+    RECEIPT_URL_EXPIRY = int(os.getenv('RECEIPT_URL_EXPIRY', '300'))
+    USE_X_SENDFILE = os.getenv('USE_X_SENDFILE', 'false').lower() in ('1', 'true', 'yes')
+    RECEIPT_ACCEL_REDIRECT_PREFIX = os.getenv('RECEIPT_ACCEL_REDIRECT_PREFIX')
+
+    # Per-user response cache (see response_cache.py)
+    RESPONSE_CACHE_BACKEND = os.getenv('RESPONSE_CACHE_BACKEND', 'memory')
+    RESPONSE_CACHE_MAX_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_BYTES', str(64 * 1024 * 1024)))
+    RESPONSE_CACHE_MAX_ITEM_BYTES = int(os.getenv('RESPONSE_CACHE_MAX_ITEM_BYTES', str(2 * 1024 * 1024)))
+    RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv('RESPONSE_CACHE_MAX_ENTRIES', '10000'))
+    RESPONSE_CACHE_TTL = int(os.getenv('RESPONSE_CACHE_TTL', '3600'))
+    REDIS_URL = os.getenv('REDIS_URL')
+
+    # Instrumentation and the /metrics endpoint (see metrics.py)
+    METRICS_ENABLED = os.getenv('METRICS_ENABLED', 'true').lower() in ('1', 'true', 'yes')
+    # When set, /metrics requires "Authorization: Bearer <token>"; when not,
+    # it only answers requests from loopback addresses
+    METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+    # Directory shared by the workers of a multi-process server
+    METRICS_DIR = os.getenv('METRICS_DIR')
+    METRICS_FLUSH_INTERVAL = float(os.getenv('METRICS_FLUSH_INTERVAL', '5'))
+    # Requests slower than this are logged with their SQL and external call timings; 0 disables
+    SLOW_REQUEST_SECONDS = float(os.getenv('SLOW_REQUEST_SECONDS', '1'))
+
+    # Rows inserted and committed together by statement imports
+    IMPORT_BATCH_SIZE = int(os.getenv('IMPORT_BATCH_SIZE', '2000'))
+
+    # Number of expense rows fetched per batch while streaming reports
+    REPORT_BATCH_SIZE = int(os.getenv('REPORT_BATCH_SIZE', '1000'))
+
+    # Background report jobs (see report_jobs.py). CSV reports spanning at
+    # most REPORT_SYNC_MAX_DAYS are still streamed in the request.
+    REPORT_WORKERS = int(os.getenv('REPORT_WORKERS', '2'))
+    REPORT_WORKER_NICE = int(os.getenv('REPORT_WORKER_NICE', '10'))
+    REPORT_SYNC_MAX_DAYS = int(os.getenv('REPORT_SYNC_MAX_DAYS', '31'))
+    REPORT_MAX_ACTIVE_JOBS = int(os.getenv('REPORT_MAX_ACTIVE_JOBS', '3'))
+    # Running jobs older than this are assumed lost with their worker and rerun
+    REPORT_JOB_TIMEOUT = int(os.getenv('REPORT_JOB_TIMEOUT', '3600'))
+    REPORT_RETENTION_DAYS = int(os.getenv('REPORT_RETENTION_DAYS', '7'))
+    # Lifetime of the signed URLs that reports stored in S3 or GCS are downloaded from
+    REPORT_DOWNLOAD_URL_EXPIRY = int(os.getenv('REPORT_DOWNLOAD_URL_EXPIRY', '300'))
+    
+    # Expense archival (see archive.py). Expenses dated before the start of
+    # the month ARCHIVE_AFTER_MONTHS ago are moved to per-year archive files.
+    ARCHIVE_AFTER_MONTHS = int(os.getenv('ARCHIVE_AFTER_MONTHS', '24'))
+    # Decoded archive files kept per process, and the expenses they may hold in total
+    ARCHIVE_CACHE_SIZE = int(os.getenv('ARCHIVE_CACHE_SIZE', '64'))
+    ARCHIVE_CACHE_MAX_ROWS = int(os.getenv('ARCHIVE_CACHE_MAX_ROWS', '500000'))
     
     # Google OAuth Configuration
     GOOGLE_CLIENT_ID = os.getenv('GOOGLE_CLIENT_ID')
     GOOGLE_CLIENT_SECRET = os.getenv('GOOGLE_CLIENT_SECRET')
-    GOOGLE_DISCOVERY_URL = 'https://accounts.google.com/.well-known/openid-configuration'
\ No newline at end of file
+    GOOGLE_DISCOVERY_URL = os.getenv('GOOGLE_DISCOVERY_URL', 'https://accounts.google.com/.well-known/openid-configuration')
+
+    # HTTP settings for calls to Google
+    OAUTH_HTTP_TIMEOUT = float(os.getenv('OAUTH_HTTP_TIMEOUT', '5'))
+    OAUTH_HTTP_POOL_SIZE = int(os.getenv('OAUTH_HTTP_POOL_SIZE', '10'))
+    # Used when the discovery document has no Cache-Control max-age
+    OAUTH_DISCOVERY_TTL = int(os.getenv('OAUTH_DISCOVERY_TTL', '3600'))
\ No newline at end of file
@@ -0,0 +1,151 @@
+"""
+Dashboard data and the JSON dashboard API
+
+The dashboard page is a light shell: it renders one page of expenses and
+loads the summary cards and charts from the JSON endpoints built here.
+
+Every write to a user's expenses or budgets bumps ``users.data_version`` in
+the same transaction. API responses carry an ETag made from that version,
+so a client revalidating with If-None-Match gets a 304 after a single
+primary-key lookup, without the dashboard queries running at all.
+"""
+from datetime import date, datetime
+from flask import request, jsonify, url_for, Response
+import archive
+import money
+
+# Part of every ETag; bump when the shape of an API response changes
+API_VERSION = 2
+
+
+def data_version(conn, user_id):
+    """Return the user's current data version"""
+    row = conn.query('user_data_version', (user_id,)).fetchone()
+    return row[0] if row else 0
+
+
+def bump_data_version(conn, user_id):
+    """Mark the user's data as changed; call inside the writing transaction"""
+    conn.query('bump_data_version', (user_id,))
+
+
+def versioned_json(conn, user_id, build, *etag_parts):
+    """
+    Answer a dashboard API request, or 304 if the client's copy is current
+
+    Args:
+        conn: A pooled connection
+        user_id: The user whose data the response holds
+        build: Called with no arguments to produce the JSON body
+        etag_parts: Anything else the response depends on, such as the
+            current month or a pagination cursor
+
+    Returns:
+        A Flask response
+    """
+    parts = [API_VERSION, user_id, data_version(conn, user_id)] + [part for part in etag_parts if part]
+    etag = '-'.join(str(part) for part in parts)
+    # Revalidate every time, but only ever with this user's session
+    headers = {'Cache-Control': 'private, no-cache', 'Vary': 'Cookie'}
+
+    if request.if_none_match.contains(etag):
+        response = Response(status=304, headers=headers)
+    else:
+        response = jsonify(build())
+        response.headers.extend(headers)
+    response.set_etag(etag)
+    return response
+
+
+def current_month():
+    return datetime.now().strftime('%Y-%m')
+
+
+def summary(conn, user_id, month):
+    """Totals for the summary cards, from the monthly rollups"""
+    total_cents, categories_count = conn.query('rollup_totals', (user_id,)).fetchone()
+    monthly_cents = conn.query('rollup_month_total', (user_id, month)).fetchone()[0]
+    return {
+        'total_amount': money.to_float(total_cents),
+        'monthly_amount': money.to_float(monthly_cents),
+        'categories_count': categories_count,
+        'month': month,
+    }
+
+
+def category_totals(conn, user_id):
+    """All-time spending per category"""
+    rows = conn.query('rollup_category_totals', (user_id,)).fetchall()
+    return {'labels': [row[0] for row in rows], 'amounts': [money.to_float(row[1]) for row in rows]}
+
+
+def monthly_totals(conn, user_id):
+    """Spending per month, oldest month first"""
+    rows = conn.query('rollup_monthly_totals', (user_id,)).fetchall()
+    return {'labels': [row[0] for row in rows], 'amounts': [money.to_float(row[1]) for row in rows]}
+
+
+def parse_expense_cursor(value):
+    """Parse a ``<date>_<id>`` pagination cursor, ignoring malformed values"""
+    if not value:
+        return None
+    day, _, expense_id = value.rpartition('_')
+    try:
+        return date.fromisoformat(day), int(expense_id)
+    except ValueError:
+        return None
+
+
+def expense_page(conn, user_id, cursor, page_size):
+    """
+    Fetch one page of expenses, newest first, archived ones included
+
+    Args:
+        cursor: ``(date, id)`` of the last expense on the previous page, or
+            None for the first page
+
+    Returns:
+        ``(rows, next_cursor)``, where ``next_cursor`` is None on the last page
+    """
+    if cursor:
+        rows = conn.query('expense_page_after', (user_id, cursor[0], cursor[1], page_size + 1)).fetchall()
+    else:
+        rows = conn.query('expense_page', (user_id, page_size + 1)).fetchall()
+    rows = archive.merge_page(conn, user_id, rows, cursor, page_size + 1)
+
+    next_cursor = None
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        last = rows[-1]
+        next_cursor = f"{last['date']}_{last['id']}"
+    return rows, next_cursor
+
+
+def receipt_url(path):
+    """Link a stored receipt: cloud backends store URLs, local storage static paths"""
+    if path.startswith(('http://', 'https://')):
+        return path
+    return url_for('static', filename=path)
+
+
+def expense_json(row):
+    """Serialise an ``expense_page`` row for the API"""
+    receipt = thumbnail = None
+    if row['receipt_digest']:
+        receipt = url_for('main.receipt', digest=row['receipt_digest'])
+        if row['receipt_thumb_path']:
+            thumbnail = url_for('main.receipt', digest=row['receipt_digest'], thumbnail=True)
+    elif row['receipt_path']:
+        receipt = receipt_url(row['receipt_path'])
+        thumbnail = receipt_url(row['receipt_thumb_path']) if row['receipt_thumb_path'] else None
+    return {
+        'id': row['id'],
+        'date': row['date'].isoformat() if row['date'] else None,
+        'category': row['category'],
+        'amount': money.to_float(row['amount_cents']),
+        'description': row['description'],
+        'receipt_url': receipt,
+        'thumbnail_url': thumbnail,
+        'receipt_status': row['receipt_status'],
+        'archived': getattr(row, 'archived', False),
+    }
@@ -0,0 +1,540 @@
+import os
+import io
+import csv
+import sqlite3
+import threading
+import time
+import random
+import logging
+from contextlib import contextmanager
+from datetime import date
+from functools import wraps
+from flask import g, session
+from config import Config
+from queries import get_statement, statement_sql, translate
+
+logger = logging.getLogger(__name__)
+
+
+class PoolTimeout(Exception):
+    """Raised when no connection becomes available within the pool timeout"""
+
+
+# Called as listener(statement, seconds) after every statement a Connection
+# runs; used for query counts and timings. Statements are reported by their
+# name in ``queries.STATEMENTS``, or as SQL for ad-hoc ones.
+_query_listeners = []
+
+
+def add_query_listener(listener):
+    # Every app created in the process adds its listener again
+    if listener not in _query_listeners:
+        _query_listeners.append(listener)
+
+
+def remove_query_listener(listener):
+    if listener in _query_listeners:
+        _query_listeners.remove(listener)
+
+
+def _notify(statement, started):
+    seconds = time.perf_counter() - started
+    for listener in _query_listeners:
+        listener(statement, seconds)
+
+
+# SQLite has no date type, so DATE columns there hold the number of days
+# since 1970-01-01; the adapter and converter below map them to and from
+# datetime.date, which is what psycopg2 returns for PostgreSQL DATE columns.
+# Only plain column references are converted on SQLite: give computed dates
+# (MIN(date) and the like) back to ``from_day_number`` by hand.
+EPOCH_ORDINAL = date(1970, 1, 1).toordinal()
+
+
+def day_number(value):
+    return value.toordinal() - EPOCH_ORDINAL
+
+
+def from_day_number(value):
+    return date.fromordinal(int(value) + EPOCH_ORDINAL)
+
+
+sqlite3.register_adapter(date, day_number)
+sqlite3.register_converter('DATE', from_day_number)
+
+
+def normalize_database_url(database_url):
+    """
+    Normalise a DATABASE_URL into (dialect, target)
+
+    Heroku style ``postgres://`` URLs are rewritten to ``postgresql://``.
+    For SQLite the target is the database file path, for PostgreSQL it is
+    the full DSN accepted by psycopg2.
+    """
+    if database_url.startswith('postgres://'):
+        database_url = database_url.replace('postgres://', 'postgresql://', 1)
+
+    if database_url.startswith('sqlite:///'):
+        return 'sqlite', database_url.replace('sqlite:///', '', 1)
+    return 'postgresql', database_url
+
+
+class Connection:
+    """
+    A pooled DB-API connection with a sqlite3 style interface
+
+    Routes call ``conn.query(name, params)`` for the named statements in
+    ``queries`` or ``conn.execute(sql, params)`` for ad-hoc SQL, and index
+    rows by position or by column name regardless of which driver sits
+    underneath.
+    """
+
+    def __init__(self, pool, raw):
+        self.pool = pool
+        self.raw = raw
+        self.dialect = pool.dialect
+        self.created_at = time.monotonic()
+        # Names of statements PREPAREd on this PostgreSQL session
+        self.prepared = set()
+        # Whether anything was committed since the connection was checked out
+        self.committed = False
+
+    def cursor(self):
+        if self.dialect == 'postgresql':
+            from psycopg2.extras import DictCursor
+            return self.raw.cursor(cursor_factory=DictCursor)
+        return self.raw.cursor()
+
+    def execute(self, sql, params=()):
+        started = time.perf_counter()
+        cursor = self.cursor()
+        cursor.execute(translate(sql, self.dialect), params)
+        if _query_listeners:
+            _notify(sql, started)
+        return cursor
+
+    def query(self, name, params=()):
+        """Run a named statement from ``queries.STATEMENTS``"""
+        started = time.perf_counter()
+        sql, count = get_statement(name, self.dialect)
+        cursor = self.cursor()
+        if self.dialect == 'postgresql':
+            if name not in self.prepared:
+                cursor.execute(f'PREPARE {name} AS {sql}')
+                self.prepared.add(name)
+            if count:
+                cursor.execute(f"EXECUTE {name} ({', '.join(['%s'] * count)})", params)
+            else:
+                cursor.execute(f'EXECUTE {name}')
+        else:
+            cursor.execute(sql, params)
+        if _query_listeners:
+            _notify(name, started)
+        return cursor
+
+    def stream(self, name, params=(), batch_size=1000):
+        """
+        Yield lists of rows from a named statement, ``batch_size`` at a time
+
+        PostgreSQL results are read through a server-side (named) cursor so
+        only one batch is held in memory; sqlite3 cursors already step
+        through results lazily.
+        """
+        sql = translate(statement_sql(name, self.dialect), self.dialect)
+        if self.dialect == 'postgresql':
+            from psycopg2.extras import DictCursor
+            cursor = self.raw.cursor(name=f'stream_{name}', cursor_factory=DictCursor)
+            cursor.itersize = batch_size
+        else:
+            cursor = self.raw.cursor()
+        try:
+            started = time.perf_counter()
+            cursor.execute(sql, params)
+            if _query_listeners:
+                _notify(name, started)
+            while True:
+                rows = cursor.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def copy_rows(self, table, columns, rows):
+        """
+        Bulk-insert ``rows`` of ``columns`` into ``table``
+
+        PostgreSQL loads them with a single COPY; SQLite uses executemany on
+        one prepared INSERT.
+        """
+        started = time.perf_counter()
+        if self.dialect == 'postgresql':
+            buffer = io.StringIO()
+            # Strings are quoted so empty text stays distinct from NULL
+            csv.writer(buffer, quoting=csv.QUOTE_NONNUMERIC).writerows(rows)
+            buffer.seek(0)
+            self.cursor().copy_expert(
+                f"COPY {table} ({', '.join(columns)}) FROM STDIN WITH (FORMAT csv)", buffer
+            )
+        else:
+            placeholders = ', '.join('?' * len(columns))
+            self.cursor().executemany(
+                f"INSERT INTO {table} ({', '.join(columns)}) VALUES ({placeholders})", rows
+            )
+        if _query_listeners:
+            _notify(f'copy {table}', started)
+
+    def commit(self):
+        self.raw.commit()
+        self.committed = True
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        """Return the connection to its pool instead of closing it"""
+        self.pool.release(self)
+
+
+class ConnectionPool:
+    """
+    A thread-safe, process-wide pool of database connections
+
+    Up to ``size`` idle connections are kept open; when they are all checked
+    out up to ``max_overflow`` extra connections may be opened and are closed
+    again on release. Connections older than ``recycle`` seconds are replaced
+    the next time they are checked out.
+    """
+
+    def __init__(self, database_url, size=5, max_overflow=10, recycle=1800, timeout=30):
+        self.database_url = database_url
+        self.dialect, self.target = normalize_database_url(database_url)
+        self.size = size
+        self.max_overflow = max_overflow
+        self.recycle = recycle
+        self.timeout = timeout
+
+        self._idle = []
+        self._lock = threading.Condition()
+        self._open = 0
+        self._checked_out = 0
+        self._waiting = 0
+        self._created = 0
+        self._recycled = 0
+        self._timeouts = 0
+
+    def _connect(self):
+        if self.dialect == 'sqlite':
+            raw = sqlite3.connect(
+                self.target,
+                check_same_thread=False,
+                cached_statements=Config.DB_STATEMENT_CACHE_SIZE,
+                detect_types=sqlite3.PARSE_DECLTYPES,
+            )
+            raw.row_factory = sqlite3.Row
+        else:
+            import psycopg2
+            from psycopg2.extensions import parse_dsn
+            options = {}
+            if Config.DB_SSLMODE and 'sslmode' not in parse_dsn(self.target):
+                options['sslmode'] = Config.DB_SSLMODE
+            raw = psycopg2.connect(self.target, **options)
+        return Connection(self, raw)
+
+    def _discard(self, conn):
+        try:
+            conn.raw.close()
+        except Exception as e:
+            logger.warning(f"Error closing pooled connection: {e}")
+
+    def acquire(self):
+        """Check a connection out of the pool, opening one if allowed"""
+        deadline = time.monotonic() + self.timeout
+        with self._lock:
+            while not self._idle and self._open >= self.size + self.max_overflow:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._timeouts += 1
+                    raise PoolTimeout(
+                        f"No database connection available after {self.timeout}s "
+                        f"(size={self.size}, overflow={self.max_overflow})"
+                    )
+                self._waiting += 1
+                try:
+                    self._lock.wait(remaining)
+                finally:
+                    self._waiting -= 1
+
+            conn = self._idle.pop() if self._idle else None
+            if conn is None:
+                self._open += 1
+            self._checked_out += 1
+
+        if conn is not None and self.recycle and time.monotonic() - conn.created_at > self.recycle:
+            self._discard(conn)
+            conn = None
+            with self._lock:
+                self._recycled += 1
+
+        if conn is None:
+            try:
+                conn = self._connect()
+            except Exception:
+                with self._lock:
+                    self._open -= 1
+                    self._checked_out -= 1
+                    self._lock.notify()
+                raise
+            with self._lock:
+                self._created += 1
+        return conn
+
+    def release(self, conn):
+        """Return a checked out connection, rolling back any open transaction"""
+        try:
+            conn.rollback()
+            healthy = True
+        except Exception as e:
+            logger.warning(f"Discarding broken pooled connection: {e}")
+            healthy = False
+        conn.committed = False
+
+        with self._lock:
+            self._checked_out -= 1
+            if healthy and len(self._idle) < self.size:
+                self._idle.append(conn)
+                conn = None
+            else:
+                self._open -= 1
+            self._lock.notify()
+
+        if conn is not None:
+            self._discard(conn)
+
+    def dispose(self):
+        """Close every idle connection"""
+        with self._lock:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for conn in idle:
+            self._discard(conn)
+
+    def stats(self):
+        with self._lock:
+            return {
+                'dialect': self.dialect,
+                'size': self.size,
+                'max_overflow': self.max_overflow,
+                'open': self._open,
+                'idle': len(self._idle),
+                'checked_out': self._checked_out,
+                'waiting': self._waiting,
+                'created': self._created,
+                'recycled': self._recycled,
+                'timeouts': self._timeouts,
+            }
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_pool():
+    """
+    Return the pool for this process, creating it on first use
+
+    The pool is rebuilt after a fork so gunicorn workers never share sockets
+    inherited from the master process.
+    """
+    global _pool, _pool_pid
+    pid = os.getpid()
+    if _pool is None or _pool_pid != pid:
+        with _pool_lock:
+            if _pool is None or _pool_pid != pid:
+                _pool = ConnectionPool(
+                    os.getenv('DATABASE_URL', Config.DATABASE_URL),
+                    size=Config.DB_POOL_SIZE,
+                    max_overflow=Config.DB_MAX_OVERFLOW,
+                    recycle=Config.DB_POOL_RECYCLE,
+                    timeout=Config.DB_POOL_TIMEOUT,
+                )
+                _pool_pid = pid
+    return _pool
+
+
+# Read replicas. Views marked ``read_only`` read from a randomly chosen
+# replica in DATABASE_REPLICA_URLS; everything else, and every write, uses
+# the primary at DATABASE_URL. A request that commits on the primary stamps
+# the user's session, and for REPLICA_STICKY_SECONDS afterwards that user's
+# read-only views use the primary too, so they never see a replica that has
+# not caught up with their own write. A replica that cannot be reached is
+# skipped for REPLICA_RETRY_SECONDS, with reads falling back to the primary.
+
+STICKY_KEY = 'db_primary_until'
+
+_replicas = None
+_replicas_pid = None
+# Replica pool -> time.monotonic() before which it is not tried again
+_replica_down = {}
+_routing = {'replica_reads': 0, 'sticky_reads': 0, 'fallback_reads': 0, 'replica_errors': 0}
+# Guards _routing and _replica_down, which request threads share
+_routing_lock = threading.Lock()
+
+
+def get_replica_pools():
+    """Return this process's replica pools, one per DATABASE_REPLICA_URLS entry"""
+    global _replicas, _replicas_pid
+    pid = os.getpid()
+    if _replicas is None or _replicas_pid != pid:
+        with _pool_lock:
+            if _replicas is None or _replicas_pid != pid:
+                _replicas = [
+                    ConnectionPool(
+                        url,
+                        size=Config.DB_POOL_SIZE,
+                        max_overflow=Config.DB_MAX_OVERFLOW,
+                        recycle=Config.DB_POOL_RECYCLE,
+                        timeout=Config.DB_POOL_TIMEOUT,
+                    )
+                    for url in Config.DATABASE_REPLICA_URLS
+                ]
+                with _routing_lock:
+                    _replica_down.clear()
+                _replicas_pid = pid
+    return _replicas
+
+
+def _count(key):
+    with _routing_lock:
+        _routing[key] += 1
+
+
+def _acquire_replica():
+    """Check a connection out of a random reachable replica, or return None"""
+    replicas = get_replica_pools()
+    now = time.monotonic()
+    with _routing_lock:
+        pools = [pool for pool in replicas if _replica_down.get(pool, 0) <= now]
+    random.shuffle(pools)
+    for pool in pools:
+        try:
+            return pool.acquire()
+        except PoolTimeout:
+            # Busy rather than broken
+            continue
+        except Exception as e:
+            with _routing_lock:
+                _replica_down[pool] = time.monotonic() + Config.REPLICA_RETRY_SECONDS
+                _routing['replica_errors'] += 1
+            logger.warning(f"Read replica unavailable, skipping it for {Config.REPLICA_RETRY_SECONDS}s: {e}")
+    return None
+
+
+def _replica_connection():
+    if session.get(STICKY_KEY, 0) > time.time():
+        _count('sticky_reads')
+        return None
+    conn = _acquire_replica()
+    _count('replica_reads' if conn is not None else 'fallback_reads')
+    return conn
+
+
+def read_only(view):
+    """
+    Send a view's reads to a replica when DATABASE_REPLICA_URLS is set
+
+    Only for views that never write; a view that writes in some cases must
+    use ``get_primary_connection`` for that.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.db_read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+
+def get_primary_connection():
+    """
+    Return the primary connection bound to the current request
+
+    The first call in a request checks a connection out of the pool; later
+    calls reuse it. It is handed back to the pool by ``close_db`` when the
+    app context is torn down.
+    """
+    if 'db_conn' not in g:
+        g.db_conn = get_pool().acquire()
+    return g.db_conn
+
+
+def get_db_connection():
+    """
+    Return the connection the current request should use
+
+    This is the primary connection, except in ``read_only`` views while
+    replicas are configured and the user has not written recently; those
+    get a replica connection, chosen once per request.
+    """
+    if Config.DATABASE_REPLICA_URLS and g.get('db_read_only'):
+        if 'db_replica_conn' not in g:
+            g.db_replica_conn = _replica_connection()
+        if g.db_replica_conn is not None:
+            return g.db_replica_conn
+    return get_primary_connection()
+
+
+def replica_stats():
+    """Routing counts and combined pool stats for the replicas"""
+    pools = get_replica_pools()
+    now = time.monotonic()
+    with _routing_lock:
+        stats = dict(_routing)
+        stats['replicas_down'] = sum(1 for pool in pools if _replica_down.get(pool, 0) > now)
+    stats['replicas'] = len(pools)
+    for pool in pools:
+        pool_stats = pool.stats()
+        for key in ('open', 'idle', 'checked_out', 'waiting', 'timeouts'):
+            stats[key] = stats.get(key, 0) + pool_stats[key]
+    return stats
+
+
+def remember_write(response):
+    """Keep the user's reads on the primary for a while after a commit"""
+    conn = g.get('db_conn')
+    if conn is not None and conn.committed and Config.DATABASE_REPLICA_URLS:
+        session[STICKY_KEY] = time.time() + Config.REPLICA_STICKY_SECONDS
+    return response
+
+
+def close_db(exc=None):
+    for name in ('db_conn', 'db_replica_conn'):
+        conn = g.pop(name, None)
+        if conn is not None:
+            conn.close()
+
+
+def release_request_connections():
+    """
+    Return the request's connections to the pool before it finishes
+
+    For views that go on to slow work holding no connection of their own,
+    such as an inline receipt upload, so the pool is not drained by
+    requests that are only waiting.
+    """
+    remember_write(None)
+    close_db()
+
+
+def init_app(app):
+    app.after_request(remember_write)
+    app.teardown_appcontext(close_db)
+
+
+@contextmanager
+def connection():
+    """Check a connection out of the pool for work done outside a request"""
+    conn = get_pool().acquire()
+    try:
+        yield conn
+    finally:
+        conn.close()
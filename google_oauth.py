@@ -0,0 +1,137 @@
+"""
+HTTP plumbing for Google sign-in
+
+All calls to Google go through one keep-alive ``requests.Session`` per
+process with a bounded connection pool and timeouts. The OpenID Connect
+discovery document is cached and only refetched once its Cache-Control
+max-age (or OAUTH_DISCOVERY_TTL when the header gives none) has passed; a
+``no-cache`` or ``no-store`` document is fetched again on every sign-in.
+
+Point GOOGLE_DISCOVERY_URL at a local stub server to run the sign-in flow
+without Google; every other endpoint is read from the discovery document.
+
+``requests`` and ``oauthlib`` are imported on the first sign-in rather than
+with the app, since most processes never handle one.
+"""
+import re
+import threading
+import time
+import logging
+from config import Config
+import metrics
+
+logger = logging.getLogger(__name__)
+
+_session = None
+_session_lock = threading.Lock()
+
+_discovery = None
+_discovery_expires = 0
+_discovery_lock = threading.Lock()
+
+
+def web_client():
+    """Return a new OAuth 2 client for the sign-in flow; it holds the token it parses"""
+    from oauthlib.oauth2 import WebApplicationClient
+
+    return WebApplicationClient(Config.GOOGLE_CLIENT_ID)
+
+
+def http_session():
+    """Return the process-wide session used for every OAuth request"""
+    global _session
+    if _session is None:
+        with _session_lock:
+            if _session is None:
+                import requests
+                from requests.adapters import HTTPAdapter
+
+                session = requests.Session()
+                adapter = HTTPAdapter(
+                    pool_connections=4,
+                    pool_maxsize=Config.OAUTH_HTTP_POOL_SIZE,
+                )
+                session.mount('https://', adapter)
+                session.mount('http://', adapter)
+                _session = session
+    return _session
+
+
+def _max_age(cache_control):
+    """
+    Return how long a response may be reused for under its Cache-Control
+    header: 0 for ``no-store`` or ``no-cache``, the max-age, or None when the
+    header is missing or gives no max-age
+    """
+    if not cache_control:
+        return None
+    if 'no-store' in cache_control or 'no-cache' in cache_control:
+        return 0
+    match = re.search(r'max-age=(\d+)', cache_control)
+    return int(match.group(1)) if match else None
+
+
+def get_provider_config():
+    """
+    Return Google's discovery document, fetching it only when the cached
+    copy has expired
+
+    If a refresh fails and a stale copy exists, the stale copy is served
+    rather than failing the sign-in.
+    """
+    global _discovery, _discovery_expires
+    if _discovery is not None and time.monotonic() < _discovery_expires:
+        return _discovery
+
+    import requests
+
+    with _discovery_lock:
+        # Another thread may have refreshed it while we waited
+        if _discovery is not None and time.monotonic() < _discovery_expires:
+            return _discovery
+        try:
+            with metrics.timed('google_oauth', 'discovery'):
+                response = http_session().get(Config.GOOGLE_DISCOVERY_URL, timeout=Config.OAUTH_HTTP_TIMEOUT)
+                response.raise_for_status()
+            document = response.json()
+        except (requests.RequestException, ValueError) as e:
+            if _discovery is None:
+                raise
+            logger.warning(f"Could not refresh OAuth discovery document, using cached copy: {e}")
+            return _discovery
+
+        ttl = _max_age(response.headers.get('Cache-Control'))
+        if ttl is None:
+            ttl = Config.OAUTH_DISCOVERY_TTL
+        # Kept even when it may not be reused, as the fallback for a failed refresh
+        _discovery = document
+        _discovery_expires = time.monotonic() + ttl
+        return document
+
+
+def clear_provider_config():
+    """Forget the cached discovery document"""
+    global _discovery, _discovery_expires
+    with _discovery_lock:
+        _discovery = None
+        _discovery_expires = 0
+
+
+def fetch_token(token_url, headers, body):
+    """POST the authorization code to the token endpoint and return the raw response body"""
+    with metrics.timed('google_oauth', 'token'):
+        response = http_session().post(
+            token_url,
+            headers=headers,
+            data=body,
+            auth=(Config.GOOGLE_CLIENT_ID, Config.GOOGLE_CLIENT_SECRET),
+            timeout=Config.OAUTH_HTTP_TIMEOUT,
+        )
+    return response.text
+
+
+def fetch_userinfo(uri, headers, body):
+    """Return the parsed userinfo document"""
+    with metrics.timed('google_oauth', 'userinfo'):
+        response = http_session().get(uri, headers=headers, data=body, timeout=Config.OAUTH_HTTP_TIMEOUT)
+    return response.json()
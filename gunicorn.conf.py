@@ -0,0 +1,34 @@
+"""
+Gunicorn settings
+
+Loaded automatically when gunicorn is started from the repository root
+(``gunicorn app:app``); options given on the command line or in
+GUNICORN_CMD_ARGS take precedence.
+
+Workers are gevent workers by default. A request waiting on Google sign-in,
+receipt storage or PostgreSQL yields to the worker's other requests instead
+of holding the whole worker, so one worker serves up to
+GUNICORN_WORKER_CONNECTIONS requests at once. psycopg2 is made cooperative
+with psycogreen; SQLite statements still block their worker while they run.
+Set GUNICORN_WORKER_CLASS=sync for one request per worker process.
+"""
+import os
+
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gevent')
+worker_connections = int(os.getenv('GUNICORN_WORKER_CONNECTIONS', '100'))
+
+
+def post_fork(server, worker):
+    if type(worker).__module__ != 'gunicorn.workers.ggevent':
+        return
+    # psycopg2 talks to the server in C, out of gevent's sight; this makes
+    # it wait on its socket through the gevent hub instead
+    from psycogreen.gevent import patch_psycopg
+    patch_psycopg()
+
+
+def child_exit(server, worker):
+    # Runs in the master; the exited worker's metrics file would otherwise
+    # be added to every scrape from now on
+    import metrics
+    metrics.remove_process(worker.pid)
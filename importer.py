@@ -0,0 +1,357 @@
+"""
+Bulk statement import
+
+Bank statements in CSV, OFX or QIF are parsed as a stream of rows, so a
+file is never held in memory as a whole. Rows are collected into batches of
+IMPORT_BATCH_SIZE; each batch is checked for duplicates against the user's
+existing expenses, inserted in one statement (COPY on PostgreSQL,
+executemany on SQLite) and committed together with its rollup updates, so a
+transaction never covers more than one batch.
+
+Duplicates are counted per (date, amount, description): a row is skipped
+while the user already has at least as many matching expenses as the file
+has produced so far. Importing the same statement twice therefore adds
+nothing, while repeated identical purchases within one statement are kept.
+"""
+import csv
+import io
+import re
+import time
+import hashlib
+import logging
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+import archive
+import money
+import rollups
+import dashboard
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+FORMATS = ('csv', 'ofx', 'qif')
+
+# How amounts in the file describe spending
+SIGN_POSITIVE = 'positive'   # expenses are positive numbers
+SIGN_NEGATIVE = 'negative'   # expenses are negative numbers, as in most bank exports
+
+DEFAULT_CATEGORY = 'Other'
+
+# Tried in order when no format is given; day-first before month-first
+DATE_FORMATS = ('%Y-%m-%d', '%d/%m/%Y', '%d-%m-%Y', '%d.%m.%Y', '%d/%m/%y', '%Y/%m/%d', '%d %b %Y', '%d-%b-%Y',
+                '%m/%d/%Y', '%m/%d/%y', '%Y%m%d')
+
+# Lower-cased CSV header names recognised for each field, in order of preference
+CSV_COLUMNS = {
+    'date': ('date', 'transaction date', 'txn date', 'posted date', 'posting date', 'value date'),
+    'amount': ('amount', 'debit', 'withdrawal', 'withdrawal amt.', 'withdrawal amount', 'debit amount'),
+    'description': ('description', 'narration', 'details', 'particulars', 'memo', 'payee', 'remarks'),
+    'category': ('category',),
+}
+
+EXPENSE_COLUMNS = ('user_id', 'date', 'category', 'amount_cents', 'description')
+
+
+class StatementError(ValueError):
+    """Raised for statement files that cannot be parsed"""
+
+
+class ImportResult:
+    """Counts and timing of one import"""
+
+    def __init__(self):
+        self.parsed = 0
+        self.inserted = 0
+        self.duplicates = 0
+        self.skipped = 0
+        self.batches = 0
+        self.seconds = 0.0
+
+    @property
+    def rows_per_second(self):
+        return self.parsed / self.seconds if self.seconds else 0.0
+
+    def summary(self):
+        return (f"Imported {self.inserted} expenses ({self.duplicates} duplicates and "
+                f"{self.skipped} other rows skipped) at {self.rows_per_second:,.0f} rows/sec")
+
+
+# The number in an amount cell; the dot of a currency prefix such as "Rs."
+# is not a decimal point
+AMOUNT_NUMBER = re.compile(r'(-?)\s*(\d[\d,]*(?:\.\d+)?|(?<![A-Za-z])\.\d+)')
+
+
+def parse_amount(value):
+    """Parse amounts like ``1,234.50``, ``-12``, ``(12.00)`` or ``Rs. 50`` into cents"""
+    text = (value or '').strip()
+    match = AMOUNT_NUMBER.search(text)
+    if match is None:
+        return None
+    amount = money.to_cents(match.group(2).replace(',', ''))
+    negative = bool(match.group(1)) or text.startswith('-') or (text.startswith('(') and text.endswith(')'))
+    return -amount if negative else amount
+
+
+def parse_date(value, formats=DATE_FORMATS):
+    """
+    Return the date in ``value``, or None
+
+    The first of ``formats`` that matches is moved to the front when
+    ``formats`` is a list, since a statement uses one format throughout.
+    """
+    text = (value or '').strip()
+    for i, fmt in enumerate(formats):
+        try:
+            date = datetime.strptime(text, fmt).date()
+        except ValueError:
+            continue
+        if i and isinstance(formats, list):
+            formats.insert(0, formats.pop(i))
+        return date
+    return None
+
+
+def _text_stream(file):
+    stream = getattr(file, 'stream', file)
+    if isinstance(stream, io.TextIOBase):
+        return stream
+    return io.TextIOWrapper(stream, encoding='utf-8-sig', errors='replace', newline='')
+
+
+def _pick_column(fieldnames, field, mapping):
+    if mapping.get(field):
+        wanted = mapping[field].strip().lower()
+        if wanted not in fieldnames:
+            raise StatementError(f"Column '{mapping[field]}' not found in the file")
+        return fieldnames[wanted]
+    for alias in CSV_COLUMNS[field]:
+        if alias in fieldnames:
+            return fieldnames[alias]
+    return None
+
+
+def parse_csv(file, mapping=None):
+    """
+    Yield ``(date, amount, description, category)`` text tuples from a CSV
+
+    Args:
+        file: A file object or werkzeug FileStorage
+        mapping: Optional {field: column name} overriding header detection
+    """
+    reader = csv.reader(_text_stream(file))
+    header = next(reader, None)
+    if not header:
+        raise StatementError("The file is empty")
+    fieldnames = {name.strip().lower(): i for i, name in enumerate(header)}
+    mapping = mapping or {}
+    columns = {field: _pick_column(fieldnames, field, mapping) for field in CSV_COLUMNS}
+    if columns['date'] is None or columns['amount'] is None:
+        raise StatementError("Could not find date and amount columns; please name them")
+
+    def cell(row, field):
+        index = columns[field]
+        return row[index] if index is not None and index < len(row) else ''
+
+    for row in reader:
+        if not any(row):
+            continue
+        yield cell(row, 'date'), cell(row, 'amount'), cell(row, 'description'), cell(row, 'category')
+
+
+OFX_TAG = re.compile(r'<(/?)([A-Za-z0-9.]+)>([^<\r\n]*)')
+
+
+def parse_ofx(file):
+    """Yield ``(date, amount, description, category)`` from OFX (SGML or XML) transactions"""
+    transaction = None
+    for line in _text_stream(file):
+        for closing, tag, value in OFX_TAG.findall(line):
+            tag = tag.upper()
+            if tag == 'STMTTRN':
+                if closing and transaction is not None:
+                    description = transaction.get('NAME') or transaction.get('PAYEE') or ''
+                    memo = transaction.get('MEMO')
+                    if memo and memo != description:
+                        description = f"{description} {memo}".strip()
+                    yield transaction.get('DTPOSTED', '')[:8], transaction.get('TRNAMT', ''), description, ''
+                    transaction = None
+                elif not closing:
+                    transaction = {}
+            elif transaction is not None and not closing:
+                transaction[tag] = value.strip()
+
+
+def parse_qif(file):
+    """Yield ``(date, amount, description, category)`` from QIF records"""
+    record = {}
+    for line in _text_stream(file):
+        line = line.rstrip('\r\n')
+        if not line or line.startswith('!'):
+            continue
+        code, value = line[0], line[1:].strip()
+        if code == '^':
+            if record:
+                description = record.get('P', '')
+                memo = record.get('M')
+                if memo and memo != description:
+                    description = f"{description} {memo}".strip()
+                # QIF dates may abbreviate the year as 1/31'24
+                date = record.get('D', '').replace("'", '/').replace(' ', '')
+                yield date, record.get('T') or record.get('U', ''), description, record.get('L', '')
+            record = {}
+        elif code in 'DTUPML':
+            record[code] = value
+
+
+def detect_format(filename):
+    extension = (filename or '').rsplit('.', 1)[-1].lower()
+    if extension == 'qfx':
+        return 'ofx'
+    return extension if extension in FORMATS else 'csv'
+
+
+def iter_rows(file, file_format, mapping=None):
+    if file_format == 'csv':
+        return parse_csv(file, mapping)
+    if file_format == 'ofx':
+        return parse_ofx(file)
+    if file_format == 'qif':
+        return parse_qif(file)
+    raise StatementError(f"Unsupported format: {file_format}")
+
+
+def _key(date, amount, description):
+    # Fixed-size digest so the per-import occurrence counts stay small for
+    # very large files
+    text = f"{date}|{amount}|{description}"
+    return hashlib.blake2b(text.encode(), digest_size=8).digest()
+
+
+class _Deduper:
+    """
+    Tracks how often each (date, amount, description) key already exists
+
+    Existing counts are loaded once per date range the import touches, so
+    batches with overlapping ranges do not re-read the same rows.
+    """
+
+    def __init__(self, conn, user_id):
+        self.conn = conn
+        self.user_id = user_id
+        self.seen = Counter()
+        self.existing = Counter()
+        # Half-open [start, end) date range whose existing rows are loaded
+        self.start = self.end = None
+
+    def _load(self, start, end):
+        for date, amount_cents, description, count in self.conn.query(
+            'import_existing_counts', (self.user_id, start, end)
+        ):
+            self.existing[_key(date, amount_cents, description or '')] += count
+        # Archived expenses count as stored too (see archive.py)
+        for row in archive.expenses_between(self.conn, self.user_id, start, end - timedelta(days=1)):
+            self.existing[_key(row[0], row[2], row[3] or '')] += 1
+
+    def _cover(self, start, end):
+        if self.start is None:
+            self._load(start, end)
+            self.start, self.end = start, end
+            return
+        if start < self.start:
+            self._load(start, self.start)
+            self.start = start
+        if end > self.end:
+            self._load(self.end, end)
+            self.end = end
+
+    def filter(self, batch):
+        """Return the rows of ``batch`` that are not already stored"""
+        self._cover(min(row[1] for row in batch), max(row[1] for row in batch) + timedelta(days=1))
+        fresh = []
+        for row in batch:
+            key = _key(row[1], row[3], row[4])
+            self.seen[key] += 1
+            if self.seen[key] > self.existing[key]:
+                fresh.append(row)
+        return fresh
+
+
+def _insert_batch(conn, user_id, rows):
+    conn.copy_rows('expenses', EXPENSE_COLUMNS, rows)
+    totals = defaultdict(lambda: [0, 0])
+    for _, date, category, amount_cents, _ in rows:
+        total = totals[(rollups.expense_month(date), category)]
+        total[0] += amount_cents
+        total[1] += 1
+    for (month, category), (total_cents, count) in totals.items():
+        rollups.add_expenses(conn, user_id, month, category, total_cents, count)
+
+
+def import_statement(conn, user_id, file, file_format='csv', sign=SIGN_POSITIVE, default_category=DEFAULT_CATEGORY,
+                     date_format=None, mapping=None, batch_size=None):
+    """
+    Import a statement file as expenses for ``user_id``
+
+    Args:
+        conn: A pooled connection; each batch is committed on it
+        user_id: The importing user
+        file: A file object or werkzeug FileStorage
+        file_format: One of FORMATS
+        sign: SIGN_POSITIVE or SIGN_NEGATIVE; rows of the other sign
+            (income, refunds) are skipped
+        default_category: Category for rows without one
+        date_format: strptime format for dates, detected per row when None
+        mapping: {field: column name} for CSV files with unusual headers
+        batch_size: Rows per insert and transaction
+
+    Returns:
+        An ImportResult
+    """
+    batch_size = batch_size or Config.IMPORT_BATCH_SIZE
+    result = ImportResult()
+    deduper = _Deduper(conn, user_id)
+    formats = [date_format] if date_format else list(DATE_FORMATS)
+    started = time.perf_counter()
+
+    def flush(batch):
+        fresh = deduper.filter(batch)
+        result.duplicates += len(batch) - len(fresh)
+        if fresh:
+            _insert_batch(conn, user_id, fresh)
+            dashboard.bump_data_version(conn, user_id)
+        conn.commit()
+        result.inserted += len(fresh)
+        result.batches += 1
+
+    batch = []
+    try:
+        for raw_date, raw_amount, description, category in iter_rows(file, file_format, mapping):
+            result.parsed += 1
+            date = parse_date(raw_date, formats)
+            try:
+                amount = parse_amount(raw_amount)
+            except ValueError:
+                amount = None
+            if sign == SIGN_NEGATIVE and amount is not None:
+                amount = -amount
+            if date is None or not amount or amount < 0:
+                result.skipped += 1
+                continue
+            description = ' '.join(description.split())
+            batch.append((user_id, date, category.strip() or default_category, amount, description))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+        if batch:
+            flush(batch)
+    except csv.Error as e:
+        conn.rollback()
+        raise StatementError(f"Could not read the file: {e}")
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        result.seconds = time.perf_counter() - started
+        logger.info(f"Statement import for user {user_id}: {result.summary()} "
+                    f"({result.parsed} rows in {result.batches} batches, {result.seconds:.2f}s)")
+    return result
@@ -0,0 +1,413 @@
+"""
+Request, SQL and external call instrumentation
+
+``init_app`` times every request and every statement run through a pooled
+connection (see ``db.add_query_listener``), and ``timed`` wraps calls to
+Google and to receipt storage. The results are exposed at ``/metrics`` in
+the Prometheus text format:
+
+    spendizo_http_requests_total                  by endpoint, method, status
+    spendizo_http_request_duration_seconds        by endpoint, method
+    spendizo_http_request_queries                 statements per request, by endpoint
+    spendizo_http_request_query_seconds           time in SQL per request, by endpoint
+    spendizo_db_query_duration_seconds            by statement name
+    spendizo_external_call_duration_seconds       by service, operation
+    spendizo_external_call_errors_total           by service, operation
+
+plus gauges from the stats functions passed to ``register_stats`` (the
+connection pool, user cache and response cache). Requests slower than
+SLOW_REQUEST_SECONDS are logged with the statements and external calls that
+made them slow.
+
+Each process keeps its own counts. Under gunicorn, set METRICS_DIR to a
+directory shared by the workers: every worker writes its counts there every
+METRICS_FLUSH_INTERVAL seconds, and whichever worker answers ``/metrics``
+adds them all up. gunicorn.conf.py removes a worker's file when the worker
+exits (``remove_process``), which Prometheus sees as a counter reset. Empty
+the directory whenever the server is restarted.
+
+``/metrics`` requires METRICS_TOKEN when it is set; without one it only
+answers requests from the machine itself.
+"""
+import os
+import hmac
+import json
+import time
+import atexit
+import logging
+import threading
+from contextlib import contextmanager
+from flask import g, request, has_request_context, abort, Response
+from config import Config
+from queries import STATEMENTS
+import db
+
+logger = logging.getLogger(__name__)
+
+PREFIX = 'spendizo_'
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+
+# name: (type, help, histogram buckets)
+METRICS = {
+    'http_requests_total': ('counter', 'Requests handled', None),
+    'http_request_duration_seconds': ('histogram', 'Request latency, including streamed bodies', LATENCY_BUCKETS),
+    'http_request_queries': ('histogram', 'SQL statements run per request', COUNT_BUCKETS),
+    'http_request_query_seconds': ('histogram', 'Time spent in SQL per request', LATENCY_BUCKETS),
+    'db_query_duration_seconds': ('histogram', 'SQL statement latency', QUERY_BUCKETS),
+    'external_call_duration_seconds': ('histogram', 'Latency of calls to external services', LATENCY_BUCKETS),
+    'external_call_errors_total': ('counter', 'Calls to external services that raised', None),
+}
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Registry:
+    """
+    One process's counters and histograms
+
+    Series are keyed by ``(name, labels)``, labels being a sorted tuple of
+    ``(label, value)`` pairs. Histograms hold per-bucket (not cumulative)
+    counts followed by the sum and the count.
+    """
+
+    def __init__(self):
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def inc(self, name, labels, amount=1):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + amount
+
+    def observe(self, name, labels, value):
+        buckets = METRICS[name][2]
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            series = self.values.get(key)
+            if series is None:
+                series = self.values[key] = [0] * (len(buckets) + 3)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            else:
+                series[len(buckets)] += 1
+            series[-2] += value
+            series[-1] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return [[name, [list(pair) for pair in labels], list(value) if isinstance(value, list) else value]
+                    for (name, labels), value in self.values.items()]
+
+
+_registry = None
+_registry_pid = None
+_registry_lock = threading.Lock()
+
+# (prefix, collect) pairs; see register_stats
+_stats = []
+
+
+def get_registry():
+    """Return this process's registry, starting afresh after a fork"""
+    global _registry, _registry_pid
+    pid = os.getpid()
+    if _registry_pid != pid:
+        with _registry_lock:
+            if _registry_pid != pid:
+                _registry = Registry()
+                _registry_pid = pid
+                if Config.METRICS_DIR:
+                    threading.Thread(target=_flush_loop, name='metrics-flush', daemon=True).start()
+    return _registry
+
+
+def register_stats(prefix, collect):
+    """
+    Expose a stats dict as gauges
+
+    Args:
+        prefix: Metric name prefix, e.g. ``db_pool``
+        collect: Called at scrape time; numeric values become gauges named
+            ``<prefix>_<key>`` and text values become labels on all of them
+    """
+    _stats.append((prefix, collect))
+
+
+def _gauges():
+    gauges = []
+    for prefix, collect in _stats:
+        try:
+            stats = collect()
+        except Exception as e:
+            logger.warning(f"Could not collect {prefix} stats: {e}")
+            continue
+        labels = [[key, str(value)] for key, value in stats.items() if isinstance(value, str)]
+        for key, value in stats.items():
+            if isinstance(value, (int, float)):
+                gauges.append([f"{prefix}_{key}", labels, value])
+    return gauges
+
+
+# Per-request trace ----------------------------------------------------------
+
+class RequestTrace:
+    """Statements and external calls of the current request, for the slow request log"""
+
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.status = 500
+        self.queries = 0
+        self.query_seconds = 0.0
+        # statement: [count, seconds]
+        self.statements = {}
+        self.calls = []
+
+
+def _trace():
+    if has_request_context():
+        return g.get('metrics_trace')
+    return None
+
+
+def _on_query(statement, seconds):
+    if statement not in STATEMENTS and not statement.startswith('copy '):
+        statement = 'sql'
+    get_registry().observe('db_query_duration_seconds', {'statement': statement}, seconds)
+    trace = _trace()
+    if trace is not None:
+        trace.queries += 1
+        trace.query_seconds += seconds
+        totals = trace.statements.setdefault(statement, [0, 0.0])
+        totals[0] += 1
+        totals[1] += seconds
+
+
+@contextmanager
+def timed(service, operation):
+    """Time a call to an external service, counting it as an error if it raises"""
+    started = time.perf_counter()
+    failed = False
+    try:
+        yield
+    except Exception:
+        failed = True
+        raise
+    finally:
+        seconds = time.perf_counter() - started
+        labels = {'service': service, 'operation': operation}
+        registry = get_registry()
+        registry.observe('external_call_duration_seconds', labels, seconds)
+        if failed:
+            registry.inc('external_call_errors_total', labels)
+        trace = _trace()
+        if trace is not None:
+            trace.calls.append((f"{service} {operation}", seconds))
+
+
+def _before_request():
+    g.metrics_trace = RequestTrace()
+
+
+def _after_request(response):
+    trace = _trace()
+    if trace is not None:
+        trace.status = response.status_code
+    return response
+
+
+def _teardown_request(exc=None):
+    # Streamed responses are torn down once their body has been sent, so
+    # report downloads are timed in full
+    trace = g.pop('metrics_trace', None)
+    if trace is None:
+        return
+    seconds = time.perf_counter() - trace.started
+    endpoint = request.endpoint or 'unmatched'
+    status = 500 if exc is not None else trace.status
+
+    registry = get_registry()
+    registry.inc('http_requests_total', {'endpoint': endpoint, 'method': request.method, 'status': str(status)})
+    registry.observe('http_request_duration_seconds', {'endpoint': endpoint, 'method': request.method}, seconds)
+    registry.observe('http_request_queries', {'endpoint': endpoint}, trace.queries)
+    registry.observe('http_request_query_seconds', {'endpoint': endpoint}, trace.query_seconds)
+
+    if Config.SLOW_REQUEST_SECONDS and seconds >= Config.SLOW_REQUEST_SECONDS:
+        statements = sorted(trace.statements.items(), key=lambda item: item[1][1], reverse=True)[:5]
+        details = ', '.join(f"{name} x{count} {total * 1000:.1f}ms" for name, (count, total) in statements)
+        calls = ', '.join(f"{name} {total * 1000:.1f}ms" for name, total in trace.calls)
+        logger.warning(f"Slow request: {request.method} {request.path} -> {status} in {seconds * 1000:.0f}ms; "
+                       f"{trace.queries} queries in {trace.query_seconds * 1000:.1f}ms"
+                       f"{f' ({details})' if details else ''}"
+                       f"{f'; external calls: {calls}' if calls else ''}")
+
+
+# Multi-process files --------------------------------------------------------
+
+def _path(pid):
+    return os.path.join(Config.METRICS_DIR, f"metrics-{pid}.json")
+
+
+def flush():
+    """Write this process's counts and gauges to METRICS_DIR"""
+    if not Config.METRICS_DIR:
+        return
+    pid = os.getpid()
+    data = {'pid': pid, 'samples': get_registry().snapshot(), 'gauges': _gauges()}
+    os.makedirs(Config.METRICS_DIR, exist_ok=True)
+    path = _path(pid)
+    tmp = f"{path}.tmp"
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+
+def _flush_loop():
+    pid = os.getpid()
+    while _registry_pid == pid:
+        time.sleep(Config.METRICS_FLUSH_INTERVAL)
+        try:
+            flush()
+        except Exception as e:
+            logger.warning(f"Could not write metrics: {e}")
+
+
+def remove_process(pid):
+    """Forget the counts of an exited process; called by gunicorn's child_exit hook"""
+    if not Config.METRICS_DIR:
+        return
+    try:
+        os.remove(_path(pid))
+    except FileNotFoundError:
+        pass
+
+
+def _alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def _other_processes():
+    if not Config.METRICS_DIR or not os.path.isdir(Config.METRICS_DIR):
+        return
+    own = os.getpid()
+    for name in os.listdir(Config.METRICS_DIR):
+        if not (name.startswith('metrics-') and name.endswith('.json')):
+            continue
+        try:
+            with open(os.path.join(Config.METRICS_DIR, name)) as f:
+                data = json.load(f)
+        except (OSError, ValueError) as e:
+            logger.warning(f"Skipping unreadable metrics file {name}: {e}")
+            continue
+        if data['pid'] != own:
+            yield data
+
+
+# Exposition -----------------------------------------------------------------
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _labels(pairs):
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{key}="{_escape(value)}"' for key, value in pairs) + '}'
+
+
+def _number(value):
+    if isinstance(value, float):
+        return repr(value) if value != int(value) else str(int(value))
+    return str(value)
+
+
+def render():
+    """Return the metrics of every process in the Prometheus text format"""
+    multiprocess = bool(Config.METRICS_DIR)
+    processes = [{'pid': os.getpid(), 'samples': get_registry().snapshot(), 'gauges': _gauges()}]
+    processes.extend(_other_processes())
+
+    totals = {}
+    gauges = {}
+    for data in processes:
+        for name, labels, value in data['samples']:
+            if name not in METRICS:
+                continue
+            key = (name, tuple(tuple(pair) for pair in labels))
+            if isinstance(value, list):
+                current = totals.setdefault(key, [0] * len(value))
+                for i, part in enumerate(value):
+                    current[i] += part
+            else:
+                totals[key] = totals.get(key, 0) + value
+        if data['pid'] != os.getpid() and not _alive(data['pid']):
+            continue
+        for name, labels, value in data['gauges']:
+            if multiprocess:
+                labels = labels + [['pid', str(data['pid'])]]
+            gauges.setdefault(name, []).append((labels, value))
+
+    lines = []
+    for name, (kind, help_text, buckets) in METRICS.items():
+        series = sorted((labels, value) for (key, labels), value in totals.items() if key == name)
+        if not series:
+            continue
+        full = PREFIX + name
+        lines.append(f"# HELP {full} {help_text}")
+        lines.append(f"# TYPE {full} {kind}")
+        for labels, value in series:
+            labels = list(labels)
+            if kind == 'counter':
+                lines.append(f"{full}{_labels(labels)} {_number(value)}")
+                continue
+            cumulative = 0
+            for bound, count in zip(list(buckets) + ['+Inf'], value):
+                cumulative += count
+                lines.append(f"{full}_bucket{_labels(labels + [('le', _number(bound))])} {cumulative}")
+            lines.append(f"{full}_sum{_labels(labels)} {_number(value[-2])}")
+            lines.append(f"{full}_count{_labels(labels)} {value[-1]}")
+
+    for name in sorted(gauges):
+        full = PREFIX + name
+        lines.append(f"# TYPE {full} gauge")
+        for labels, value in gauges[name]:
+            lines.append(f"{full}{_labels(labels)} {_number(value)}")
+    return '\n'.join(lines) + '\n'
+
+
+LOOPBACK = ('127.0.0.1', '::1')
+
+
+def metrics_view():
+    if Config.METRICS_TOKEN:
+        supplied = request.headers.get('Authorization', '')
+        if not hmac.compare_digest(supplied, f"Bearer {Config.METRICS_TOKEN}"):
+            abort(401)
+    elif request.remote_addr not in LOOPBACK:
+        abort(404)
+    return Response(render(), content_type=CONTENT_TYPE)
+
+
+def init_app(app):
+    """Instrument requests and SQL, and add the /metrics endpoint"""
+    if not Config.METRICS_ENABLED:
+        return
+    app.before_request(_before_request)
+    app.after_request(_after_request)
+    app.teardown_request(_teardown_request)
+    app.add_url_rule('/metrics', 'metrics', metrics_view)
+    # Process-wide, while apps may be created more than once
+    db.add_query_listener(_on_query)
+    if Config.METRICS_DIR:
+        atexit.unregister(flush)
+        atexit.register(flush)
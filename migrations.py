@@ -0,0 +1,552 @@
+"""
+Versioned schema migrations
+
+The applied schema version is recorded in ``schema_migrations``. Pending
+migrations run in order inside one transaction, together with their version
+rows, so a failed upgrade leaves the schema as it was. They are never
+applied at app import or worker start; run them once per deploy instead:
+
+    python migrations.py upgrade     # apply pending migrations
+    python migrations.py status      # show applied and pending versions
+
+or ``flask migrate``. A migration is a list of SQL statements shared by both
+dialects, or a dict of lists keyed by dialect. A list entry may also be a
+callable taking the connection, for data conversions that need Python.
+"""
+import sys
+import logging
+from datetime import datetime, timedelta
+import db
+
+logger = logging.getLogger(__name__)
+
+# Arbitrary key for the PostgreSQL advisory lock that serialises migration runs
+ADVISORY_LOCK_KEY = 5150_2024
+
+
+class Migration:
+    def __init__(self, version, name, statements):
+        self.version = version
+        self.name = name
+        self.statements = statements
+
+    def statements_for(self, dialect):
+        if isinstance(self.statements, dict):
+            return self.statements[dialect]
+        return self.statements
+
+
+# Keep the SQLite full-text index of expense descriptions in step with the
+# table (migration 8); recreated whenever the table is rebuilt
+SQLITE_FTS_TRIGGERS = [
+    '''
+    CREATE TRIGGER IF NOT EXISTS expenses_fts_insert AFTER INSERT ON expenses BEGIN
+        INSERT INTO expenses_fts (rowid, description) VALUES (new.id, new.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS expenses_fts_delete AFTER DELETE ON expenses BEGIN
+        INSERT INTO expenses_fts (expenses_fts, rowid, description) VALUES ('delete', old.id, old.description);
+    END
+    ''',
+    '''
+    CREATE TRIGGER IF NOT EXISTS expenses_fts_update AFTER UPDATE OF description ON expenses BEGIN
+        INSERT INTO expenses_fts (expenses_fts, rowid, description) VALUES ('delete', old.id, old.description);
+        INSERT INTO expenses_fts (rowid, description) VALUES (new.id, new.description);
+    END
+    ''',
+]
+
+# Day number (days since 1970-01-01, see db.py) of an ISO date in SQLite
+SQLITE_DAY = "CAST(julianday({}) - 2440587.5 AS INTEGER)"
+
+# Length of each budget period in days, as add_budget computes end_date
+BUDGET_PERIOD_DAYS = {
+    'monthly': 30,
+    'quarterly': 90,
+    'yearly': 365,
+}
+
+
+def _has_column(conn, table, column):
+    if conn.dialect == 'sqlite':
+        return any(row['name'] == column for row in conn.execute(f'PRAGMA table_info({table})').fetchall())
+    return conn.execute(
+        'SELECT 1 FROM information_schema.columns '
+        'WHERE table_schema = current_schema() AND table_name = ? AND column_name = ?',
+        (table, column)
+    ).fetchone() is not None
+
+
+def _add_budget_end_dates(conn):
+    """
+    Give a budgets table created before end_date existed its end dates
+
+    Databases set up by the old import-time schema already have a budgets
+    table without the column, which CREATE TABLE IF NOT EXISTS leaves alone.
+    Each row's end_date is its start_date plus the length of its period;
+    rows with a period add_budget does not know are treated as monthly.
+    """
+    if _has_column(conn, 'budgets', 'end_date'):
+        return
+    conn.execute('ALTER TABLE budgets ADD COLUMN end_date TEXT')
+    rows = conn.execute('SELECT id, period, start_date FROM budgets').fetchall()
+    for budget_id, period, start_date in rows:
+        if period not in BUDGET_PERIOD_DAYS:
+            logger.warning(f"Budget {budget_id} has unknown period {period!r}; giving it a monthly end date")
+        start = datetime.strptime(start_date[:10], '%Y-%m-%d').date()
+        end = start + timedelta(days=BUDGET_PERIOD_DAYS.get(period, BUDGET_PERIOD_DAYS['monthly']))
+        conn.execute('UPDATE budgets SET end_date = ? WHERE id = ?', (end.isoformat(), budget_id))
+    if conn.dialect == 'postgresql':
+        conn.execute('ALTER TABLE budgets ALTER COLUMN end_date SET NOT NULL')
+
+
+def _stamp_receipt_uploads(conn):
+    conn.execute(
+        "UPDATE expenses SET receipt_claimed_at = ? WHERE receipt_status = 'uploading'",
+        (datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f'),)
+    )
+
+
+MIGRATIONS = [
+    Migration(1, 'create core tables', {
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT,
+                email TEXT UNIQUE,
+                google_id TEXT UNIQUE
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS expenses (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                date TEXT,
+                category TEXT,
+                amount REAL,
+                description TEXT,
+                receipt_path TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS budgets (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                category TEXT NOT NULL,
+                amount REAL NOT NULL,
+                period TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            _add_budget_end_dates,
+            '''
+            CREATE TABLE IF NOT EXISTS expense_rollups (
+                user_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                category TEXT NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                expense_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, month, category),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+        ],
+        'postgresql': [
+            '''
+            CREATE TABLE IF NOT EXISTS users (
+                id SERIAL PRIMARY KEY,
+                username TEXT UNIQUE NOT NULL,
+                password TEXT,
+                email TEXT UNIQUE,
+                google_id TEXT UNIQUE
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS expenses (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                date TEXT,
+                category TEXT,
+                amount REAL,
+                description TEXT,
+                receipt_path TEXT
+            )
+            ''',
+            '''
+            CREATE TABLE IF NOT EXISTS budgets (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                category TEXT NOT NULL,
+                amount REAL NOT NULL,
+                period TEXT NOT NULL,
+                start_date TEXT NOT NULL,
+                end_date TEXT NOT NULL
+            )
+            ''',
+            _add_budget_end_dates,
+            '''
+            CREATE TABLE IF NOT EXISTS expense_rollups (
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                month TEXT NOT NULL,
+                category TEXT NOT NULL,
+                total REAL NOT NULL DEFAULT 0,
+                expense_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, month, category)
+            )
+            ''',
+        ],
+    }),
+    # Per-user range scans for the dashboard pages, budget windows and
+    # reports. The trailing id lets keyset pagination on (date, id) walk
+    # the index in order.
+    Migration(2, 'add per-user indexes', [
+        'CREATE INDEX IF NOT EXISTS idx_expenses_user_date ON expenses (user_id, date, id)',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_user_category_date ON expenses (user_id, category, date)',
+        'CREATE INDEX IF NOT EXISTS idx_budgets_user ON budgets (user_id)',
+    ]),
+    # Receipts are uploaded in the background; receipt_spool names the local
+    # spool file while receipt_status is 'pending' or 'uploading'
+    Migration(3, 'add background receipt upload state', [
+        'ALTER TABLE expenses ADD COLUMN receipt_status TEXT',
+        'ALTER TABLE expenses ADD COLUMN receipt_spool TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_receipt_status ON expenses (receipt_status) '
+        'WHERE receipt_status IS NOT NULL',
+    ]),
+    # Thumbnails of processed receipt images, shown in list views instead of
+    # the full-size image (see receipt_images.py)
+    Migration(4, 'add receipt thumbnails', [
+        'ALTER TABLE expenses ADD COLUMN receipt_thumb_path TEXT',
+    ]),
+    # Content-addressed receipts (see receipt_store.py). Receipts stored
+    # before this keep their receipt_path and have no receipt_digest.
+    Migration(5, 'add content-addressed receipt blobs', [
+        '''
+        CREATE TABLE IF NOT EXISTS receipt_blobs (
+            digest TEXT PRIMARY KEY,
+            storage TEXT,
+            filename TEXT,
+            receipt_path TEXT,
+            thumb_path TEXT,
+            content_type TEXT,
+            size INTEGER,
+            refcount INTEGER NOT NULL DEFAULT 0
+        )
+        ''',
+        'ALTER TABLE expenses ADD COLUMN receipt_digest TEXT',
+        'CREATE INDEX IF NOT EXISTS idx_expenses_receipt_digest ON expenses (receipt_digest) '
+        'WHERE receipt_digest IS NOT NULL',
+    ]),
+    # Bumped by every write to a user's expenses or budgets; dashboard API
+    # ETags are derived from it (see dashboard.py)
+    Migration(6, 'add per-user data version', [
+        'ALTER TABLE users ADD COLUMN data_version INTEGER NOT NULL DEFAULT 0',
+    ]),
+    # Reports generated in the background (see report_jobs.py). Timestamps
+    # are ISO text like the other dates in the schema.
+    Migration(7, 'add report jobs', {
+        'sqlite': [
+            '''
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                status TEXT NOT NULL,
+                format TEXT NOT NULL,
+                range_start TEXT NOT NULL,
+                range_end TEXT NOT NULL,
+                title TEXT NOT NULL,
+                label TEXT NOT NULL,
+                month TEXT,
+                storage TEXT,
+                path TEXT,
+                filename TEXT,
+                content_type TEXT,
+                size INTEGER,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_user ON report_jobs (user_id, id)',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs (status, id)',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_finished ON report_jobs (finished_at)',
+        ],
+        'postgresql': [
+            '''
+            CREATE TABLE IF NOT EXISTS report_jobs (
+                id SERIAL PRIMARY KEY,
+                user_id INTEGER NOT NULL REFERENCES users (id),
+                status TEXT NOT NULL,
+                format TEXT NOT NULL,
+                range_start TEXT NOT NULL,
+                range_end TEXT NOT NULL,
+                title TEXT NOT NULL,
+                label TEXT NOT NULL,
+                month TEXT,
+                storage TEXT,
+                path TEXT,
+                filename TEXT,
+                content_type TEXT,
+                size BIGINT,
+                error TEXT,
+                created_at TEXT NOT NULL,
+                started_at TEXT,
+                finished_at TEXT
+            )
+            ''',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_user ON report_jobs (user_id, id)',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_status ON report_jobs (status, id)',
+            'CREATE INDEX IF NOT EXISTS idx_report_jobs_finished ON report_jobs (finished_at)',
+        ],
+    }),
+    # Full-text search over expense descriptions (see search.py). SQLite
+    # keeps an external-content FTS5 index in step with triggers; PostgreSQL
+    # a generated tsvector column under a GIN index. Either way every write
+    # path, imports included, updates the index in the same transaction.
+    # The category index gains the amount so category facets with amount
+    # and date filters are counted from the index alone.
+    Migration(8, 'add expense description search', {
+        'sqlite': [
+            "CREATE VIRTUAL TABLE IF NOT EXISTS expenses_fts USING fts5("
+            "description, content='expenses', content_rowid='id', tokenize='unicode61 remove_diacritics 2')",
+            *SQLITE_FTS_TRIGGERS,
+            "INSERT INTO expenses_fts (expenses_fts) VALUES ('rebuild')",
+            'DROP INDEX IF EXISTS idx_expenses_user_category_date',
+            'CREATE INDEX IF NOT EXISTS idx_expenses_user_category_date_amount '
+            'ON expenses (user_id, category, date, amount)',
+        ],
+        'postgresql': [
+            "ALTER TABLE expenses ADD COLUMN IF NOT EXISTS description_tsv tsvector "
+            "GENERATED ALWAYS AS (to_tsvector('simple', coalesce(description, ''))) STORED",
+            'CREATE INDEX IF NOT EXISTS idx_expenses_description_tsv ON expenses USING GIN (description_tsv)',
+            'DROP INDEX IF EXISTS idx_expenses_user_category_date',
+            'CREATE INDEX IF NOT EXISTS idx_expenses_user_category_date_amount '
+            'ON expenses (user_id, category, date, amount)',
+        ],
+    }),
+    # Money as integer cents and dates as DATE (see money.py and db.py).
+    # PostgreSQL converts the columns in place. SQLite cannot change a
+    # column's type, so the tables are rebuilt with dates as day numbers,
+    # keeping their ids, and the indexes and search triggers are recreated.
+    # Rollups are recomputed from the converted expenses so their totals are
+    # exact sums.
+    Migration(9, 'store amounts as integer cents and dates as dates', {
+        'sqlite': [
+            '''
+            CREATE TABLE expenses_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                date DATE,
+                category TEXT,
+                amount_cents INTEGER,
+                description TEXT,
+                receipt_path TEXT,
+                receipt_status TEXT,
+                receipt_spool TEXT,
+                receipt_thumb_path TEXT,
+                receipt_digest TEXT,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            'INSERT INTO expenses_new (id, user_id, date, category, amount_cents, description, receipt_path, '
+            'receipt_status, receipt_spool, receipt_thumb_path, receipt_digest) '
+            f"SELECT id, user_id, {SQLITE_DAY.format('date')}, category, CAST(ROUND(amount * 100) AS INTEGER), "
+            'description, receipt_path, receipt_status, receipt_spool, receipt_thumb_path, receipt_digest '
+            'FROM expenses',
+            'DROP TABLE expenses',
+            'ALTER TABLE expenses_new RENAME TO expenses',
+            'CREATE INDEX idx_expenses_user_date ON expenses (user_id, date, id)',
+            'CREATE INDEX idx_expenses_user_category_date_amount ON expenses (user_id, category, date, amount_cents)',
+            'CREATE INDEX idx_expenses_receipt_status ON expenses (receipt_status) WHERE receipt_status IS NOT NULL',
+            'CREATE INDEX idx_expenses_receipt_digest ON expenses (receipt_digest) WHERE receipt_digest IS NOT NULL',
+            *SQLITE_FTS_TRIGGERS,
+            '''
+            CREATE TABLE budgets_new (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                user_id INTEGER NOT NULL,
+                category TEXT NOT NULL,
+                amount_cents INTEGER NOT NULL,
+                period TEXT NOT NULL,
+                start_date DATE NOT NULL,
+                end_date DATE NOT NULL,
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            'INSERT INTO budgets_new (id, user_id, category, amount_cents, period, start_date, end_date) '
+            'SELECT id, user_id, category, CAST(ROUND(amount * 100) AS INTEGER), period, '
+            f"{SQLITE_DAY.format('start_date')}, {SQLITE_DAY.format('end_date')} FROM budgets",
+            'DROP TABLE budgets',
+            'ALTER TABLE budgets_new RENAME TO budgets',
+            'CREATE INDEX idx_budgets_user ON budgets (user_id)',
+            '''
+            CREATE TABLE expense_rollups_new (
+                user_id INTEGER NOT NULL,
+                month TEXT NOT NULL,
+                category TEXT NOT NULL,
+                total_cents INTEGER NOT NULL DEFAULT 0,
+                expense_count INTEGER NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, month, category),
+                FOREIGN KEY (user_id) REFERENCES users (id)
+            )
+            ''',
+            'DROP TABLE expense_rollups',
+            'ALTER TABLE expense_rollups_new RENAME TO expense_rollups',
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, strftime('%Y-%m', date * 86400, 'unixepoch') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses GROUP BY user_id, month, category',
+        ],
+        'postgresql': [
+            # Through float8, since REAL to numeric keeps only six digits
+            'ALTER TABLE expenses '
+            'ALTER COLUMN amount TYPE BIGINT USING round(amount::float8 * 100)::bigint, '
+            "ALTER COLUMN date TYPE DATE USING NULLIF(date, '')::date",
+            'ALTER TABLE expenses RENAME COLUMN amount TO amount_cents',
+            'ALTER TABLE budgets '
+            'ALTER COLUMN amount TYPE BIGINT USING round(amount::float8 * 100)::bigint, '
+            'ALTER COLUMN start_date TYPE DATE USING start_date::date, '
+            'ALTER COLUMN end_date TYPE DATE USING end_date::date',
+            'ALTER TABLE budgets RENAME COLUMN amount TO amount_cents',
+            'ALTER TABLE expense_rollups ALTER COLUMN total TYPE BIGINT USING 0',
+            'ALTER TABLE expense_rollups RENAME COLUMN total TO total_cents',
+            'DELETE FROM expense_rollups',
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, to_char(date, 'YYYY-MM') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses GROUP BY user_id, month, category',
+        ],
+    }),
+    # Cold storage for old expenses (see archive.py). Each user's archived
+    # expenses of one year live in one file; archived_receipts keeps their
+    # receipts reachable by digest once the rows have left the expenses table.
+    Migration(10, 'add expense archives', [
+        '''
+        CREATE TABLE IF NOT EXISTS expense_archives (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            year INTEGER NOT NULL,
+            storage TEXT NOT NULL,
+            filename TEXT NOT NULL,
+            row_count INTEGER NOT NULL,
+            first_date DATE NOT NULL,
+            last_date DATE NOT NULL,
+            created_at TEXT NOT NULL,
+            PRIMARY KEY (user_id, year)
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS archived_receipts (
+            user_id INTEGER NOT NULL REFERENCES users (id),
+            digest TEXT NOT NULL,
+            year INTEGER NOT NULL,
+            PRIMARY KEY (user_id, digest, year)
+        )
+        ''',
+    ]),
+    # When a receipt upload was claimed, so uploads lost with their worker
+    # can be requeued (see receipt_queue.py). Uploads already running count
+    # from the time of the migration.
+    Migration(11, 'add receipt upload claim time', [
+        'ALTER TABLE expenses ADD COLUMN receipt_claimed_at TEXT',
+        _stamp_receipt_uploads,
+    ]),
+]
+
+
+def _ensure_version_table(conn):
+    conn.execute('''
+    CREATE TABLE IF NOT EXISTS schema_migrations (
+        version INTEGER PRIMARY KEY,
+        name TEXT NOT NULL,
+        applied_at TEXT NOT NULL
+    )
+    ''')
+    conn.commit()
+
+
+def applied_versions(conn):
+    _ensure_version_table(conn)
+    return {row[0] for row in conn.execute('SELECT version FROM schema_migrations').fetchall()}
+
+
+def _begin(conn):
+    # sqlite3 only opens transactions implicitly before DML, so start one
+    # explicitly to make the DDL and the version rows atomic
+    if conn.dialect == 'sqlite':
+        conn.execute('BEGIN IMMEDIATE')
+
+
+def upgrade(conn, target=None):
+    """
+    Apply pending migrations up to ``target`` (default: the latest)
+
+    Returns:
+        The list of versions that were applied
+    """
+    if conn.dialect == 'postgresql':
+        conn.execute('SELECT pg_advisory_lock(?)', (ADVISORY_LOCK_KEY,))
+        conn.commit()
+    try:
+        done = applied_versions(conn)
+        pending = [
+            migration for migration in MIGRATIONS
+            if migration.version not in done and (target is None or migration.version <= target)
+        ]
+        if not pending:
+            return []
+        _begin(conn)
+        try:
+            for migration in pending:
+                logger.info(f"Applying migration {migration.version}: {migration.name}")
+                for statement in migration.statements_for(conn.dialect):
+                    if callable(statement):
+                        statement(conn)
+                    else:
+                        conn.execute(statement)
+                conn.execute(
+                    'INSERT INTO schema_migrations (version, name, applied_at) VALUES (?, ?, ?)',
+                    (migration.version, migration.name, datetime.utcnow().isoformat(timespec='seconds'))
+                )
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            logger.error(f"Migration {migration.version} failed; no pending migrations were applied")
+            raise
+        return [migration.version for migration in pending]
+    finally:
+        if conn.dialect == 'postgresql':
+            conn.execute('SELECT pg_advisory_unlock(?)', (ADVISORY_LOCK_KEY,))
+            conn.commit()
+
+
+def status(conn):
+    """Return ``[(version, name, applied), ...]`` for every known migration"""
+    done = applied_versions(conn)
+    return [(m.version, m.name, m.version in done) for m in MIGRATIONS]
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    command = argv[0] if argv else 'upgrade'
+    logging.basicConfig(level=logging.INFO)
+
+    with db.connection() as conn:
+        if command == 'upgrade':
+            target = int(argv[1]) if len(argv) > 1 else None
+            applied = upgrade(conn, target)
+            print(f"Applied migrations: {applied}" if applied else "Database schema is up to date")
+        elif command == 'status':
+            for version, name, applied in status(conn):
+                print(f"{version:>4}  {'applied' if applied else 'pending':<8} {name}")
+        else:
+            print(f"Unknown command: {command} (expected 'upgrade' or 'status')")
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,50 @@
+"""
+Money amounts
+
+Amounts are stored and summed as integers in minor units (paise, called
+cents here), so totals are exact. They are parsed from user input with
+``to_cents`` and turned back into rupees only for display and for the JSON
+API.
+"""
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+
+CURRENCY = 'Rs.'
+
+# Amount columns are 64-bit integers on both databases
+MAX_CENTS = 2 ** 63 - 1
+
+
+def to_cents(value):
+    """
+    Parse an amount such as ``'12.5'`` into integer cents
+
+    Sub-cent digits are rounded half up. Raises ValueError for anything that
+    is not a finite number or does not fit in MAX_CENTS.
+    """
+    try:
+        amount = Decimal(str(value).strip())
+    except InvalidOperation:
+        raise ValueError(f"Invalid amount: {value}")
+    if not amount.is_finite() or abs(amount.scaleb(2)) > MAX_CENTS:
+        raise ValueError(f"Invalid amount: {value}")
+    return int(amount.scaleb(2).quantize(Decimal(1), rounding=ROUND_HALF_UP))
+
+
+def to_decimal(cents):
+    """Return ``cents`` as an exact Decimal number of rupees"""
+    return Decimal(int(cents)).scaleb(-2)
+
+
+def to_float(cents):
+    """Return ``cents`` as rupees for JSON and spreadsheets"""
+    return int(cents) / 100
+
+
+def format_amount(cents):
+    """Format cents as ``1234.50``"""
+    return f"{to_decimal(cents):.2f}"
+
+
+def format_money(cents):
+    """Format cents as ``Rs. 1234.50``"""
+    return f"{CURRENCY} {format_amount(cents)}"
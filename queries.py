@@ -0,0 +1,344 @@
+"""
+Named SQL statements used by the application
+
+Statements are written once with sqlite style ``?`` placeholders and
+translated per dialect the first time they are used. The few that cannot be
+written portably are dicts of SQL keyed by dialect. Pooled connections run
+them through ``Connection.query(name, params)``, which keeps them prepared
+for the lifetime of the connection: PostgreSQL gets a server-side
+``PREPARE``/``EXECUTE`` pair and SQLite relies on the connection's compiled
+statement cache, which only hits when the SQL text is identical.
+"""
+from functools import lru_cache
+
+STATEMENTS = {
+    # Users
+    'user_by_id': 'SELECT * FROM users WHERE id = ?',
+    'user_by_username': 'SELECT * FROM users WHERE username = ?',
+    'user_id_by_username': 'SELECT id FROM users WHERE username = ?',
+    'user_by_google_id': 'SELECT * FROM users WHERE google_id = ?',
+    'insert_user': 'INSERT INTO users (username, password) VALUES (?, ?)',
+    'insert_google_user': 'INSERT INTO users (username, email, google_id) VALUES (?, ?, ?)',
+    'user_data_version': 'SELECT data_version FROM users WHERE id = ?',
+    'bump_data_version': 'UPDATE users SET data_version = data_version + 1 WHERE id = ?',
+    'bump_data_version_for_expense': (
+        'UPDATE users SET data_version = data_version + 1 '
+        'WHERE id = (SELECT user_id FROM expenses WHERE id = ?)'
+    ),
+
+    # Expenses
+    'expense_page': (
+        'SELECT date, category, amount_cents, description, id, receipt_path, receipt_status, '
+        'receipt_thumb_path, receipt_digest FROM expenses '
+        'WHERE user_id = ? ORDER BY date DESC, id DESC LIMIT ?'
+    ),
+    'expense_page_after': (
+        'SELECT date, category, amount_cents, description, id, receipt_path, receipt_status, '
+        'receipt_thumb_path, receipt_digest FROM expenses '
+        'WHERE user_id = ? AND (date, id) < (?, ?) ORDER BY date DESC, id DESC LIMIT ?'
+    ),
+    'expense_for_user': (
+        'SELECT date, category, amount_cents, receipt_digest, receipt_status, receipt_spool FROM expenses '
+        'WHERE id = ? AND user_id = ?'
+    ),
+    'insert_expense': (
+        'INSERT INTO expenses '
+        '(user_id, date, category, amount_cents, description, receipt_path, receipt_status, receipt_spool) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?) RETURNING id'
+    ),
+    'delete_expense': 'DELETE FROM expenses WHERE id = ? AND user_id = ?',
+
+    # Background receipt uploads (see receipt_queue.py)
+    'claim_pending_receipt': (
+        'UPDATE expenses SET receipt_status = ?, receipt_claimed_at = ? WHERE id = ? AND receipt_status = ?'
+    ),
+    'finish_receipt_upload': (
+        'UPDATE expenses SET receipt_path = ?, receipt_thumb_path = ?, receipt_digest = ?, receipt_status = ?, '
+        'receipt_spool = NULL, receipt_claimed_at = NULL WHERE id = ? AND receipt_claimed_at = ?'
+    ),
+    'fail_receipt_upload': (
+        'UPDATE expenses SET receipt_status = ?, receipt_claimed_at = NULL WHERE id = ? AND receipt_claimed_at = ?'
+    ),
+    'requeue_stale_receipt_uploads': (
+        'UPDATE expenses SET receipt_status = ?, receipt_claimed_at = NULL '
+        'WHERE receipt_status = ? AND receipt_claimed_at < ?'
+    ),
+    'expense_exists': 'SELECT 1 FROM expenses WHERE id = ?',
+    'pending_receipts': (
+        'SELECT id, receipt_spool FROM expenses WHERE receipt_status = ? ORDER BY id LIMIT ?'
+    ),
+
+    # Statement import (see importer.py)
+    'import_existing_counts': (
+        'SELECT date, amount_cents, description, COUNT(*) FROM expenses '
+        'WHERE user_id = ? AND date >= ? AND date < ? GROUP BY date, amount_cents, description'
+    ),
+
+    # Content-addressed receipt blobs (see receipt_store.py)
+    'acquire_receipt_blob': (
+        'INSERT INTO receipt_blobs (digest, refcount) VALUES (?, 1) '
+        'ON CONFLICT (digest) DO UPDATE SET refcount = receipt_blobs.refcount + 1 '
+        'RETURNING receipt_path, thumb_path'
+    ),
+    'record_receipt_blob': (
+        'UPDATE receipt_blobs SET storage = ?, filename = ?, receipt_path = ?, thumb_path = ?, '
+        'content_type = ?, size = ? WHERE digest = ?'
+    ),
+    'release_receipt_blob': 'UPDATE receipt_blobs SET refcount = refcount - 1 WHERE digest = ?',
+    'delete_receipt_blob': (
+        'DELETE FROM receipt_blobs WHERE digest = ? AND refcount <= 0 '
+        'RETURNING digest, storage, filename, receipt_path, thumb_path'
+    ),
+    'receipt_blob_for_user': (
+        'SELECT digest, storage, filename, receipt_path, thumb_path, content_type, size FROM receipt_blobs b '
+        'WHERE digest = ? AND (EXISTS '
+        '(SELECT 1 FROM expenses e WHERE e.receipt_digest = b.digest AND e.user_id = ?) '
+        'OR EXISTS (SELECT 1 FROM archived_receipts a WHERE a.digest = b.digest AND a.user_id = ?))'
+    ),
+
+    # Rollups (see rollups.py)
+    'rollup_add': (
+        'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+        'VALUES (?, ?, ?, ?, 1) '
+        'ON CONFLICT (user_id, month, category) DO UPDATE SET '
+        'total_cents = expense_rollups.total_cents + excluded.total_cents, '
+        'expense_count = expense_rollups.expense_count + 1'
+    ),
+    'rollup_add_many': (
+        'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+        'VALUES (?, ?, ?, ?, ?) '
+        'ON CONFLICT (user_id, month, category) DO UPDATE SET '
+        'total_cents = expense_rollups.total_cents + excluded.total_cents, '
+        'expense_count = expense_rollups.expense_count + excluded.expense_count'
+    ),
+    'rollup_subtract': (
+        'UPDATE expense_rollups SET total_cents = total_cents - ?, expense_count = expense_count - 1 '
+        'WHERE user_id = ? AND month = ? AND category = ?'
+    ),
+    'rollup_prune': (
+        'DELETE FROM expense_rollups '
+        'WHERE user_id = ? AND month = ? AND category = ? AND expense_count <= 0'
+    ),
+    'rollup_clear_all': 'DELETE FROM expense_rollups',
+    'rollup_clear_user': 'DELETE FROM expense_rollups WHERE user_id = ?',
+    # Months are YYYY-MM; SQLite dates are day numbers (see db.py)
+    'rollup_rebuild_all': {
+        'sqlite': (
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, strftime('%Y-%m', date * 86400, 'unixepoch') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses GROUP BY user_id, month, category'
+        ),
+        'postgresql': (
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, to_char(date, 'YYYY-MM') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses GROUP BY user_id, month, category'
+        ),
+    },
+    'rollup_rebuild_user': {
+        'sqlite': (
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, strftime('%Y-%m', date * 86400, 'unixepoch') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses WHERE user_id = ? GROUP BY user_id, month, category'
+        ),
+        'postgresql': (
+            'INSERT INTO expense_rollups (user_id, month, category, total_cents, expense_count) '
+            "SELECT user_id, to_char(date, 'YYYY-MM') AS month, category, "
+            'SUM(amount_cents), COUNT(*) FROM expenses WHERE user_id = ? GROUP BY user_id, month, category'
+        ),
+    },
+    'rollup_count_all': 'SELECT COUNT(*) FROM expense_rollups',
+    'rollup_count_user': 'SELECT COUNT(*) FROM expense_rollups WHERE user_id = ?',
+    'rollup_totals': (
+        'SELECT CAST(COALESCE(SUM(total_cents), 0) AS BIGINT), COUNT(DISTINCT category) FROM expense_rollups '
+        'WHERE user_id = ?'
+    ),
+    'rollup_month_total': (
+        'SELECT CAST(COALESCE(SUM(total_cents), 0) AS BIGINT) FROM expense_rollups WHERE user_id = ? AND month = ?'
+    ),
+    'rollup_category_totals': (
+        'SELECT category, CAST(SUM(total_cents) AS BIGINT) FROM expense_rollups '
+        'WHERE user_id = ? GROUP BY category ORDER BY category'
+    ),
+    'rollup_category_counts': (
+        'SELECT category, SUM(expense_count) AS matches FROM expense_rollups '
+        'WHERE user_id = ? GROUP BY category HAVING SUM(expense_count) > 0 ORDER BY matches DESC, category'
+    ),
+    'rollup_monthly_totals': (
+        'SELECT month, CAST(SUM(total_cents) AS BIGINT) FROM expense_rollups '
+        'WHERE user_id = ? GROUP BY month ORDER BY month'
+    ),
+    'rollup_categories_between': (
+        'SELECT category, CAST(SUM(total_cents) AS BIGINT) FROM expense_rollups '
+        'WHERE user_id = ? AND month >= ? AND month <= ? '
+        'GROUP BY category ORDER BY category'
+    ),
+
+    # Budgets
+    # Spending per budget in one pass; the two parameters before user_id are
+    # today's date, which caps budget windows that have not ended yet
+    'budgets_with_spent': (
+        'SELECT b.id, b.category, b.amount_cents, b.period, b.start_date, b.end_date, '
+        'COALESCE(SUM(e.amount_cents), 0) AS spent '
+        'FROM budgets b '
+        'LEFT JOIN expenses e ON e.user_id = b.user_id AND e.category = b.category '
+        'AND e.date BETWEEN b.start_date '
+        'AND CASE WHEN b.end_date < ? THEN b.end_date ELSE ? END '
+        'WHERE b.user_id = ? '
+        'GROUP BY b.id, b.category, b.amount_cents, b.period, b.start_date, b.end_date '
+        'ORDER BY b.id'
+    ),
+    'insert_budget': (
+        'INSERT INTO budgets (user_id, category, amount_cents, period, start_date, end_date) '
+        'VALUES (?, ?, ?, ?, ?, ?)'
+    ),
+    'delete_budget': 'DELETE FROM budgets WHERE id = ? AND user_id = ?',
+
+    # Reports (see reports.py); date ranges are inclusive
+    'report_expenses': (
+        'SELECT date, category, amount_cents, description, id FROM expenses '
+        'WHERE user_id = ? AND date >= ? AND date <= ? ORDER BY date, id'
+    ),
+    'report_category_totals': (
+        'SELECT category, SUM(amount_cents) FROM expenses '
+        'WHERE user_id = ? AND date >= ? AND date <= ? '
+        'GROUP BY category ORDER BY category'
+    ),
+    'monthly_budgets': "SELECT category, amount_cents FROM budgets WHERE user_id = ? AND period = 'monthly'",
+
+    # Background report jobs (see report_jobs.py)
+    'insert_report_job': (
+        'INSERT INTO report_jobs (user_id, status, format, range_start, range_end, title, label, month, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) RETURNING id'
+    ),
+    'claim_report_job': 'UPDATE report_jobs SET status = ?, started_at = ? WHERE id = ? AND status = ?',
+    'report_job': (
+        'SELECT id, user_id, status, format, range_start, range_end, title, label, month, storage, path, '
+        'filename, content_type, size, error, created_at, finished_at FROM report_jobs WHERE id = ?'
+    ),
+    'report_job_for_user': (
+        'SELECT id, user_id, status, format, range_start, range_end, title, label, month, storage, path, '
+        'filename, content_type, size, error, created_at, finished_at FROM report_jobs WHERE id = ? AND user_id = ?'
+    ),
+    'report_jobs_for_user': (
+        'SELECT id, user_id, status, format, range_start, range_end, title, label, month, storage, path, '
+        'filename, content_type, size, error, created_at, finished_at FROM report_jobs '
+        'WHERE user_id = ? ORDER BY id DESC LIMIT ?'
+    ),
+    'active_report_job_count': 'SELECT COUNT(*) FROM report_jobs WHERE user_id = ? AND status IN (?, ?)',
+    'finish_report_job': (
+        'UPDATE report_jobs SET status = ?, storage = ?, path = ?, filename = ?, content_type = ?, size = ?, '
+        'finished_at = ? WHERE id = ?'
+    ),
+    'fail_report_job': 'UPDATE report_jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?',
+    'queued_report_jobs': 'SELECT id FROM report_jobs WHERE status = ? ORDER BY id LIMIT ?',
+    'requeue_stale_report_jobs': (
+        'UPDATE report_jobs SET status = ?, started_at = NULL WHERE status = ? AND started_at < ?'
+    ),
+    'expired_report_jobs': (
+        'SELECT id, storage, filename FROM report_jobs WHERE finished_at < ? ORDER BY id LIMIT ?'
+    ),
+    'delete_report_job': 'DELETE FROM report_jobs WHERE id = ?',
+
+    # Expense archives (see archive.py); date ranges are inclusive
+    'expense_archive': (
+        'SELECT user_id, year, storage, filename, row_count, first_date, last_date FROM expense_archives '
+        'WHERE user_id = ? AND year = ?'
+    ),
+    'expense_archives_between': (
+        'SELECT user_id, year, storage, filename, row_count, first_date, last_date FROM expense_archives '
+        'WHERE user_id = ? AND first_date <= ? AND last_date >= ? ORDER BY year'
+    ),
+    'expense_archives_for_user': (
+        'SELECT user_id, year, storage, filename, row_count, first_date, last_date FROM expense_archives '
+        'WHERE user_id = ? ORDER BY year'
+    ),
+    'all_expense_archives': (
+        'SELECT user_id, year, storage, filename, row_count, first_date, last_date FROM expense_archives '
+        'ORDER BY user_id, year'
+    ),
+    'insert_expense_archive': (
+        'INSERT INTO expense_archives '
+        '(user_id, year, storage, filename, row_count, first_date, last_date, created_at) '
+        'VALUES (?, ?, ?, ?, ?, ?, ?, ?) ON CONFLICT (user_id, year) DO NOTHING'
+    ),
+    # Conditional on the file being replaced, so concurrent runs cannot
+    # both replace it
+    'replace_expense_archive': (
+        'UPDATE expense_archives SET storage = ?, filename = ?, row_count = ?, first_date = ?, last_date = ?, '
+        'created_at = ? WHERE user_id = ? AND year = ? AND filename = ?'
+    ),
+    'delete_expense_archive': 'DELETE FROM expense_archives WHERE user_id = ? AND year = ? AND filename = ?',
+    'archive_users': 'SELECT DISTINCT user_id FROM expenses WHERE date < ? ORDER BY user_id',
+    'oldest_expense_date': (
+        'SELECT date FROM expenses WHERE user_id = ? AND date IS NOT NULL ORDER BY date LIMIT 1'
+    ),
+    # Receipts still uploading stay in the table until they are done
+    'archivable_expenses': (
+        'SELECT date, category, amount_cents, description, id, receipt_path, receipt_status, '
+        'receipt_thumb_path, receipt_digest FROM expenses '
+        'WHERE user_id = ? AND date >= ? AND date <= ? '
+        'AND (receipt_status IS NULL OR receipt_status NOT IN (?, ?)) ORDER BY date, id'
+    ),
+    'insert_archived_receipt': (
+        'INSERT INTO archived_receipts (user_id, digest, year) VALUES (?, ?, ?) '
+        'ON CONFLICT (user_id, digest, year) DO NOTHING'
+    ),
+    'delete_archived_receipts': 'DELETE FROM archived_receipts WHERE user_id = ? AND year = ?',
+}
+
+
+def translate_placeholders(sql, style):
+    """
+    Rewrite ``?`` placeholders outside of string literals
+
+    ``style`` is ``'qmark'`` (unchanged), ``'format'`` (psycopg2's ``%s``,
+    with literal ``%`` escaped) or ``'numeric'`` (PostgreSQL's ``$1``, ``$2``
+    as used by PREPARE). Returns the new SQL and the number of placeholders.
+    """
+    out = []
+    count = 0
+    quote = None
+    for ch in sql:
+        if quote:
+            if ch == quote:
+                quote = None
+        elif ch in ("'", '"'):
+            quote = ch
+        elif ch == '?':
+            count += 1
+            if style == 'format':
+                ch = '%s'
+            elif style == 'numeric':
+                ch = f'${count}'
+        if ch == '%' and style == 'format':
+            ch = '%%'
+        out.append(ch)
+    return ''.join(out), count
+
+
+def statement_sql(name, dialect):
+    """Return the SQL of a named statement for ``dialect``, with ``?`` placeholders"""
+    sql = STATEMENTS[name]
+    return sql[dialect] if isinstance(sql, dict) else sql
+
+
+@lru_cache(maxsize=None)
+def get_statement(name, dialect):
+    """
+    Return ``(sql, param_count)`` for a named statement in the given dialect
+
+    For PostgreSQL the SQL uses ``$n`` placeholders and is meant to be
+    wrapped in ``PREPARE``.
+    """
+    sql = statement_sql(name, dialect)
+    if dialect == 'postgresql':
+        return translate_placeholders(sql, 'numeric')
+    return translate_placeholders(sql, 'qmark')
+
+
+@lru_cache(maxsize=256)
+def translate(sql, dialect):
+    """Translate ad-hoc ``?`` style SQL for the driver behind ``dialect``"""
+    if dialect == 'postgresql':
+        return translate_placeholders(sql, 'format')[0]
+    return sql
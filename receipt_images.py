@@ -0,0 +1,180 @@
+"""
+Receipt image processing
+
+Phone photos of receipts are often several megabytes. Before a receipt image
+is stored it is rotated upright according to its EXIF orientation, scaled
+down to RECEIPT_IMAGE_MAX_DIMENSION, stripped of EXIF metadata and
+re-encoded as a compressed JPEG (or RECEIPT_IMAGE_FORMAT). A small thumbnail
+is made for list views at the same time.
+
+The work runs in a pool of separate processes so decoding and encoding do
+not hold the GIL in web workers. Pillow is optional: without it, or for
+files that are not images, receipts are stored unchanged.
+"""
+import io
+import os
+import threading
+import logging
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif', '.bmp', '.tif', '.tiff', '.heic'}
+
+FORMAT_EXTENSIONS = {
+    'JPEG': ('.jpg', 'image/jpeg'),
+    'WEBP': ('.webp', 'image/webp'),
+}
+
+# ICC colour profiles up to this size are kept; everything else is dropped
+MAX_ICC_PROFILE_BYTES = 64 * 1024
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class ProcessedFile:
+    """In-memory file with the attributes storage backends expect"""
+
+    def __init__(self, data, filename, mimetype):
+        self.stream = io.BytesIO(data)
+        self.filename = filename
+        self.mimetype = mimetype
+        self.size = len(data)
+
+
+class ProcessedReceipt:
+    def __init__(self, filename, image, thumbnail):
+        self.filename = filename
+        self.image = image
+        self.thumbnail = thumbnail
+
+
+def _encode(image, image_format, quality, icc_profile):
+    output = io.BytesIO()
+    options = {'quality': quality, 'optimize': True}
+    if image_format == 'JPEG':
+        options['progressive'] = True
+    if icc_profile:
+        options['icc_profile'] = icc_profile
+    image.save(output, image_format, **options)
+    return output.getvalue()
+
+
+def process_image_bytes(data, image_format='JPEG', max_dimension=2000, quality=80,
+                        thumbnail_size=320, thumbnail_quality=70):
+    """
+    Normalise, compress and thumbnail one image
+
+    Runs in a worker process, so it only takes and returns plain values.
+
+    Returns:
+        ``(image_bytes, thumbnail_bytes)``, or None if ``data`` is not an
+        image Pillow can read
+    """
+    from PIL import Image, ImageOps
+
+    try:
+        with Image.open(io.BytesIO(data)) as source:
+            image = ImageOps.exif_transpose(source)
+            icc_profile = source.info.get('icc_profile')
+            if icc_profile and len(icc_profile) > MAX_ICC_PROFILE_BYTES:
+                icc_profile = None
+
+            if image.mode not in ('RGB', 'L'):
+                image = image.convert('RGB')
+            image.thumbnail((max_dimension, max_dimension), Image.LANCZOS)
+            image_bytes = _encode(image, image_format, quality, icc_profile)
+
+            thumbnail = image.copy()
+            thumbnail.thumbnail((thumbnail_size, thumbnail_size), Image.LANCZOS)
+            thumbnail_bytes = _encode(thumbnail, image_format, thumbnail_quality, None)
+    except (OSError, ValueError, Image.DecompressionBombError):
+        return None
+    return image_bytes, thumbnail_bytes
+
+
+def _get_executor():
+    """Return this process's image pool, rebuilding it after a fork"""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                # Imported here so starting the app does not load them
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Spawned rather than forked children, since web workers run
+                # threads that must not be copied mid-operation
+                _executor = ProcessPoolExecutor(
+                    max_workers=Config.RECEIPT_IMAGE_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                )
+                _executor_pid = pid
+    return _executor
+
+
+def _is_image(file, filename):
+    mimetype = getattr(file, 'mimetype', None) or ''
+    extension = os.path.splitext(filename)[1].lower()
+    return mimetype.startswith('image/') or extension in IMAGE_EXTENSIONS
+
+
+def process_receipt(file, filename):
+    """
+    Process an uploaded receipt image in the process pool
+
+    Args:
+        file: A werkzeug FileStorage or file-like object with a stream
+        filename: The name the receipt will be stored under
+
+    Returns:
+        A ProcessedReceipt whose image is renamed to match its new format,
+        or None when the receipt should be stored unchanged
+    """
+    if not Config.RECEIPT_IMAGE_PROCESSING or not _is_image(file, filename):
+        return None
+    try:
+        import PIL  # noqa: F401
+    except ImportError:
+        return None
+
+    image_format = Config.RECEIPT_IMAGE_FORMAT
+    if image_format not in FORMAT_EXTENSIONS:
+        logger.warning(f"Unsupported RECEIPT_IMAGE_FORMAT {image_format!r}, storing receipt images as JPEG")
+        image_format = 'JPEG'
+    extension, mimetype = FORMAT_EXTENSIONS[image_format]
+
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    data = stream.read(Config.RECEIPT_IMAGE_MAX_BYTES + 1)
+    stream.seek(0)
+    if len(data) > Config.RECEIPT_IMAGE_MAX_BYTES:
+        logger.warning(f"Receipt {filename} is too large to process, storing it unchanged")
+        return None
+
+    try:
+        future = _get_executor().submit(
+            process_image_bytes,
+            data,
+            image_format,
+            Config.RECEIPT_IMAGE_MAX_DIMENSION,
+            Config.RECEIPT_IMAGE_QUALITY,
+            Config.RECEIPT_THUMBNAIL_SIZE,
+        )
+        result = future.result(timeout=Config.RECEIPT_IMAGE_TIMEOUT)
+    except Exception as e:
+        logger.error(f"Error processing receipt image {filename}: {e}")
+        return None
+    if result is None:
+        return None
+
+    image_bytes, thumbnail_bytes = result
+    new_filename = os.path.splitext(filename)[0] + extension
+    return ProcessedReceipt(
+        new_filename,
+        ProcessedFile(image_bytes, new_filename, mimetype),
+        ProcessedFile(thumbnail_bytes, new_filename, mimetype),
+    )
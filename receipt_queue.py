@@ -0,0 +1,265 @@
+"""
+Background receipt uploads
+
+``add_expense`` writes the uploaded receipt to a local spool directory,
+commits the expense with ``receipt_status = 'pending'`` and hands the upload
+to this module. A bounded pool of worker threads per process processes
+receipt images (see receipt_images.py), moves spooled files to the
+configured storage backend under their content digest (see
+receipt_store.py), retrying with exponential backoff, and then records the
+final ``receipt_path``, ``receipt_thumb_path`` and ``receipt_digest`` on the
+expense. A receipt already in the store is not processed or uploaded again.
+
+Backpressure: at most RECEIPT_UPLOAD_WORKERS uploads run at once and at most
+RECEIPT_UPLOAD_QUEUE_SIZE more may wait. When the queue is full, ``enqueue``
+waits up to RECEIPT_UPLOAD_QUEUE_TIMEOUT seconds for room and otherwise
+uploads in the calling thread, so receipts are never dropped.
+
+An upload is claimed by setting the expense to ``'uploading'`` with the
+claim time. Receipts whose upload never started keep their spool file and
+are picked up again by ``resume_pending``; so are uploads claimed more than
+RECEIPT_UPLOAD_TIMEOUT seconds ago, which are assumed lost with a worker
+that was restarted. Only the latest claim may record its result, so an
+upload that was requeued while still running does not record it twice.
+"""
+import os
+import time
+import mimetypes
+import threading
+import logging
+from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+import cloud_storage
+import receipt_images
+import receipt_store
+import db
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+STATUS_PENDING = 'pending'
+STATUS_UPLOADING = 'uploading'
+STATUS_STORED = 'stored'
+STATUS_FAILED = 'failed'
+
+_executor = None
+_executor_pid = None
+_slots = None
+_lock = threading.Lock()
+
+
+def _get_executor():
+    """Return this process's upload pool, rebuilding it after a fork"""
+    global _executor, _executor_pid, _slots
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                _executor = ThreadPoolExecutor(
+                    max_workers=Config.RECEIPT_UPLOAD_WORKERS,
+                    thread_name_prefix='receipt-upload',
+                )
+                _slots = threading.BoundedSemaphore(
+                    Config.RECEIPT_UPLOAD_WORKERS + Config.RECEIPT_UPLOAD_QUEUE_SIZE
+                )
+                _executor_pid = pid
+    return _executor, _slots
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def spool(file, filename):
+    """Write an uploaded file to the spool directory and return its spool name"""
+    os.makedirs(Config.RECEIPT_SPOOL_DIR, exist_ok=True)
+    file.save(os.path.join(Config.RECEIPT_SPOOL_DIR, filename))
+    return filename
+
+
+def discard(filename):
+    """Remove a spooled receipt that will not be uploaded"""
+    try:
+        os.remove(os.path.join(Config.RECEIPT_SPOOL_DIR, filename))
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Could not remove spooled receipt {filename}: {e}")
+
+
+class SpooledReceipt:
+    """A spooled file opened for upload, with the attributes backends expect"""
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+        self.stream = open(os.path.join(Config.RECEIPT_SPOOL_DIR, filename), 'rb')
+        self.size = os.fstat(self.stream.fileno()).st_size
+
+    def close(self):
+        self.stream.close()
+
+
+def _upload(receipt, filename):
+    """
+    Process and upload a spooled receipt, retrying with backoff
+
+    Args:
+        receipt: The open SpooledReceipt
+        filename: The content-addressed name to store it as
+
+    Returns:
+        ``(storage, stored_filename, path, thumbnail_path, content_type, size)``
+    """
+    # Processed once; only the upload itself is retried
+    processed = receipt_images.process_receipt(receipt, filename)
+    stored = processed.image if processed else receipt
+    stored_filename = processed.filename if processed else filename
+
+    backend = cloud_storage.get_backend()
+    delay = Config.RECEIPT_UPLOAD_BACKOFF
+    for attempt in range(1, Config.RECEIPT_UPLOAD_RETRIES + 1):
+        try:
+            path, thumbnail_path = cloud_storage.store_receipt(backend, receipt, filename, processed)
+            return backend.name, stored_filename, path, thumbnail_path, stored.mimetype, stored.size
+        except Exception as e:
+            logger.warning(f"Receipt upload of {filename} failed (attempt {attempt}): {e}")
+            if attempt == Config.RECEIPT_UPLOAD_RETRIES:
+                break
+            time.sleep(delay)
+            delay *= 2
+
+    # Keep the receipt rather than lose it if the store stays unavailable
+    logger.error(f"Giving up on uploading {filename}, falling back to local storage")
+    local = cloud_storage.LocalStorage()
+    path, thumbnail_path = cloud_storage.store_receipt(local, receipt, filename, processed)
+    return local.name, stored_filename, path, thumbnail_path, stored.mimetype, stored.size
+
+
+def _store(filename):
+    """
+    Store a spooled receipt, or reuse the stored copy of identical content
+
+    Returns:
+        ``(digest, path, thumbnail_path)``
+    """
+    receipt = SpooledReceipt(filename)
+    try:
+        digest = receipt_store.content_digest(receipt)
+        with db.connection() as conn:
+            stored = receipt_store.acquire(conn, digest)
+            conn.commit()
+        if stored is not None:
+            return (digest,) + stored
+
+        try:
+            storage, stored_filename, path, thumbnail_path, content_type, size = _upload(
+                receipt, receipt_store.content_filename(digest, filename)
+            )
+        except Exception:
+            # Nothing was stored, so there are no files to delete
+            with db.connection() as conn:
+                receipt_store.release(conn, digest)
+                conn.commit()
+            raise
+        with db.connection() as conn:
+            receipt_store.record(conn, digest, storage, stored_filename, path, thumbnail_path, content_type, size)
+            conn.commit()
+        return digest, path, thumbnail_path
+    finally:
+        receipt.close()
+
+
+def process(expense_id, filename):
+    """
+    Upload one pending receipt and record the result on its expense
+
+    The row is claimed first, so a receipt is only uploaded once even when
+    several workers try to resume the same pending rows.
+    """
+    claimed_at = _now()
+    with db.connection() as conn:
+        claimed = conn.query(
+            'claim_pending_receipt', (STATUS_UPLOADING, claimed_at, expense_id, STATUS_PENDING)
+        ).rowcount
+        if not claimed:
+            deleted = conn.query('expense_exists', (expense_id,)).fetchone() is None
+        conn.commit()
+    if not claimed:
+        if deleted:
+            # The expense was deleted before its upload started
+            discard(filename)
+        return None
+
+    digest = receipt_path = thumbnail_path = None
+    try:
+        digest, receipt_path, thumbnail_path = _store(filename)
+    except Exception as e:
+        logger.error(f"Error uploading receipt for expense {expense_id}: {e}")
+
+    released = None
+    superseded = False
+    with db.connection() as conn:
+        if receipt_path:
+            finished = conn.query(
+                'finish_receipt_upload',
+                (receipt_path, thumbnail_path, digest, STATUS_STORED, expense_id, claimed_at)
+            ).rowcount
+            if not finished:
+                # The expense was deleted while its receipt was uploading, or
+                # the upload took so long that it was requeued; the latest
+                # claim records its own reference
+                released = receipt_store.release(conn, digest)
+                superseded = conn.query('expense_exists', (expense_id,)).fetchone() is not None
+        else:
+            conn.query('fail_receipt_upload', (STATUS_FAILED, expense_id, claimed_at))
+        # The expense list shows the receipt and its upload state
+        conn.query('bump_data_version_for_expense', (expense_id,))
+        conn.commit()
+    receipt_store.delete_files(released)
+
+    # A requeued upload still needs the spool file
+    if receipt_path and not superseded:
+        discard(filename)
+    return receipt_path
+
+
+def _run(slots, expense_id, filename):
+    try:
+        process(expense_id, filename)
+    except Exception as e:
+        logger.error(f"Receipt upload task for expense {expense_id} crashed: {e}")
+    finally:
+        slots.release()
+
+
+def enqueue(expense_id, filename):
+    """
+    Schedule the upload of a spooled receipt for a committed expense
+
+    Returns True if it was queued, False if the queue stayed full and the
+    upload ran in the calling thread instead.
+    """
+    executor, slots = _get_executor()
+    if slots.acquire(timeout=Config.RECEIPT_UPLOAD_QUEUE_TIMEOUT):
+        executor.submit(_run, slots, expense_id, filename)
+        return True
+
+    logger.warning(f"Receipt upload queue is full, uploading receipt for expense {expense_id} inline")
+    process(expense_id, filename)
+    return False
+
+
+def resume_pending(limit=1000):
+    """Requeue uploads lost with their worker, then queue every pending receipt still spooled"""
+    stale = (datetime.now() - timedelta(seconds=Config.RECEIPT_UPLOAD_TIMEOUT)).strftime('%Y-%m-%d %H:%M:%S.%f')
+    with db.connection() as conn:
+        conn.query('requeue_stale_receipt_uploads', (STATUS_PENDING, STATUS_UPLOADING, stale))
+        conn.commit()
+        rows = conn.query('pending_receipts', (STATUS_PENDING, limit)).fetchall()
+    queued = 0
+    for expense_id, filename in rows:
+        if filename and os.path.exists(os.path.join(Config.RECEIPT_SPOOL_DIR, filename)):
+            enqueue(expense_id, filename)
+            queued += 1
+    return queued
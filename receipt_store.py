@@ -0,0 +1,166 @@
+"""
+Content-addressed receipt store
+
+Receipts are stored once per distinct content, named by the SHA-256 digest
+of the uploaded bytes (``receipts/<digest>.<ext>``), and ``receipt_blobs``
+counts the expenses that point at each one through ``receipt_digest``.
+Uploading the same receipt again only bumps the count; the stored files are
+deleted when the last expense using them is deleted.
+
+The digest is taken before image processing (see receipt_images.py), so a
+duplicate skips processing as well as the upload. Stored bytes never change
+for a digest, which lets ``serve`` answer with a strong ETag and an
+immutable Cache-Control.
+
+Receipts are stored as private files (see cloud_storage.py) and only reach
+the expense's owner through ``serve``.
+"""
+import os
+import hashlib
+import logging
+from flask import current_app, redirect, request, send_file, Response
+import cloud_storage
+import metrics
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+def content_digest(file):
+    """Return the hex SHA-256 digest of a file object, leaving it rewound"""
+    stream = getattr(file, 'stream', file)
+    stream.seek(0)
+    digest = hashlib.sha256()
+    for chunk in iter(lambda: stream.read(HASH_CHUNK_SIZE), b''):
+        digest.update(chunk)
+    stream.seek(0)
+    return digest.hexdigest()
+
+
+def content_filename(digest, filename):
+    """Return the storage name for a receipt: its digest plus the original extension"""
+    return digest + os.path.splitext(filename)[1].lower()
+
+
+def acquire(conn, digest):
+    """
+    Take a reference to the blob for ``digest``, creating its row if needed
+
+    Returns:
+        ``(receipt_path, thumb_path)`` if the blob is already stored, or
+        None if the caller must store it and then call ``record``
+    """
+    row = conn.query('acquire_receipt_blob', (digest,)).fetchone()
+    if row[0] is None:
+        return None
+    return row[0], row[1]
+
+
+def record(conn, digest, storage, filename, receipt_path, thumb_path, content_type, size):
+    """Record where a newly stored blob lives"""
+    conn.query('record_receipt_blob', (storage, filename, receipt_path, thumb_path, content_type, size, digest))
+
+
+def release(conn, digest):
+    """
+    Drop a reference to a blob, forgetting the blob when none remain
+
+    The caller commits and then passes the result to ``delete_files``, so
+    the files outlive the rows that point at them.
+
+    Returns:
+        The deleted blob row, or None if it is still referenced
+    """
+    if not digest:
+        return None
+    conn.query('release_receipt_blob', (digest,))
+    return conn.query('delete_receipt_blob', (digest,)).fetchone()
+
+
+def delete_files(blob):
+    """Delete the stored files of a blob returned by ``release``"""
+    if blob is None or not blob['filename']:
+        return
+    backend = cloud_storage.backend_for(blob['storage'])
+    if backend is None:
+        logger.warning(f"Cannot delete receipt {blob['filename']} from {blob['storage']}: "
+                       f"storage backend is not configured")
+        return
+    for path, directory in ((blob['receipt_path'], 'receipts'), (blob['thumb_path'], 'receipts/thumbs')):
+        if not path:
+            continue
+        try:
+            with metrics.timed(backend.name, 'delete'):
+                backend.delete(blob['filename'], directory, private=True)
+                if isinstance(backend, cloud_storage.LocalStorage):
+                    # Stored before receipts were private
+                    backend.delete(blob['filename'], directory)
+        except Exception as e:
+            logger.error(f"Error deleting receipt {directory}/{blob['filename']}: {e}")
+
+
+def serve(blob, thumbnail=False):
+    """
+    Build the response for a stored receipt blob
+
+    Local files are sent with Range and conditional request support, or
+    handed to the front-end server with X-Sendfile (USE_X_SENDFILE) or
+    X-Accel-Redirect (RECEIPT_ACCEL_REDIRECT_PREFIX). Cloud-stored receipts
+    redirect to a signed URL valid for RECEIPT_URL_EXPIRY seconds, or are
+    streamed by the app when the backend cannot sign one.
+    """
+    path = blob['thumb_path'] if thumbnail else blob['receipt_path']
+    if not path:
+        return None
+    etag = f"{blob['digest']}-thumb" if thumbnail else blob['digest']
+
+    if path.startswith(('http://', 'https://')):
+        return _serve_cloud(blob, thumbnail, etag)
+    if Config.RECEIPT_ACCEL_REDIRECT_PREFIX:
+        response = Response(mimetype=blob['content_type'])
+        response.headers['X-Accel-Redirect'] = Config.RECEIPT_ACCEL_REDIRECT_PREFIX.rstrip('/') + '/' + path
+        response.set_etag(etag)
+        response = response.make_conditional(request)
+    else:
+        backend = cloud_storage.backend_for('local')
+        file_path = backend.file_path(path, private=True)
+        if not os.path.isfile(file_path):
+            # Stored before receipts were private
+            file_path = backend.file_path(path)
+        if not os.path.isfile(file_path):
+            current_app.logger.error(f"Stored receipt {path} is missing")
+            return None
+        response = send_file(file_path, mimetype=blob['content_type'], conditional=True, etag=etag)
+
+    response.headers['Cache-Control'] = Config.RECEIPT_CACHE_CONTROL
+    return response
+
+
+def _serve_cloud(blob, thumbnail, etag):
+    backend = cloud_storage.backend_for(blob['storage'])
+    if backend is None:
+        current_app.logger.error(f"Receipt {blob['filename']} is in {blob['storage']} storage, "
+                                 f"which is not configured")
+        return None
+    directory = 'receipts/thumbs' if thumbnail else 'receipts'
+    try:
+        url = backend.signed_url(blob['filename'], directory, Config.RECEIPT_URL_EXPIRY,
+                                 content_type=blob['content_type'])
+    except Exception as e:
+        current_app.logger.warning(f"Cannot sign a URL for receipt {blob['filename']}: {e}")
+        url = None
+    if url:
+        response = redirect(url)
+        # The signed URL expires, so the redirect must not be reused
+        response.headers['Cache-Control'] = cloud_storage.PRIVATE_CACHE_CONTROL
+        return response
+
+    with metrics.timed(backend.name, 'read'):
+        content = backend.read(blob['filename'], directory, private=True)
+    response = Response(content, mimetype=blob['content_type'])
+    response.set_etag(etag)
+    response = response.make_conditional(request)
+    response.headers['Cache-Control'] = Config.RECEIPT_CACHE_CONTROL
+    return response
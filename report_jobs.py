@@ -0,0 +1,284 @@
+"""
+Background report jobs
+
+Reports too large to stream within a request, and every XLSX or PDF report,
+are generated as jobs. ``enqueue`` records a ``report_jobs`` row and hands
+its id to a pool of REPORT_WORKERS separate processes, which run at a lower
+CPU priority (REPORT_WORKER_NICE) so heavy reports do not slow interactive
+requests. A worker claims the job, writes the report to a temporary file,
+stores it through cloud_storage under ``reports/`` as a private file and
+records where it went; the user polls ``/api/reports/<id>`` or the Reports
+page until it is done and downloads it from ``/reports/<id>/download``,
+which checks that the job is theirs.
+
+No broker is involved: the table is the queue. Jobs are claimed with a
+conditional UPDATE, so when several web workers resume the same queued
+jobs after a restart each one still runs once. Jobs left running by a
+worker that died are queued again after REPORT_JOB_TIMEOUT, and finished
+jobs are deleted with their files after REPORT_RETENTION_DAYS.
+"""
+import os
+import secrets
+import tempfile
+import threading
+import logging
+from datetime import date, datetime, timedelta
+from flask import Response, redirect, send_file, url_for
+from werkzeug.datastructures import FileStorage
+import cloud_storage
+import reports
+import metrics
+import db
+from config import Config
+
+logger = logging.getLogger(__name__)
+
+STATUS_QUEUED = 'queued'
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+
+DIRECTORY = 'reports'
+
+_executor = None
+_executor_pid = None
+_lock = threading.Lock()
+
+
+class ReportJobError(Exception):
+    """Raised when a report job cannot be queued"""
+
+
+def _now():
+    return datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+
+
+def _init_worker():
+    try:
+        os.nice(Config.REPORT_WORKER_NICE)
+    except (AttributeError, OSError):
+        pass
+
+
+def _get_executor():
+    """Return this process's report pool, rebuilding it after a fork"""
+    global _executor, _executor_pid
+    pid = os.getpid()
+    if _executor is None or _executor_pid != pid:
+        with _lock:
+            if _executor is None or _executor_pid != pid:
+                # Imported here so starting the app does not load them
+                import multiprocessing
+                from concurrent.futures import ProcessPoolExecutor
+
+                # Spawned rather than forked, as in receipt_images.py
+                _executor = ProcessPoolExecutor(
+                    max_workers=Config.REPORT_WORKERS,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                )
+                _executor_pid = pid
+    return _executor
+
+
+def _reset_executor():
+    global _executor
+    with _lock:
+        _executor = None
+
+
+def _log_result(job_id):
+    def callback(future):
+        error = future.exception()
+        if error is not None:
+            logger.error(f"Report job {job_id} crashed: {error}")
+    return callback
+
+
+def submit(job_id):
+    """Hand a queued job to the pool; it stays queued for ``resume_pending`` if that fails"""
+    for _ in range(2):
+        try:
+            future = _get_executor().submit(run_job, job_id)
+        except RuntimeError as e:
+            # BrokenProcessPool: a worker process died and took the pool with it
+            logger.warning(f"Report pool unavailable ({e}), restarting it")
+            _reset_executor()
+            continue
+        future.add_done_callback(_log_result(job_id))
+        return True
+    logger.error(f"Could not start report job {job_id}; it will be resumed later")
+    return False
+
+
+def enqueue(conn, user_id, report_range, report_format):
+    """
+    Queue a report and start it in the background
+
+    Args:
+        conn: A pooled connection; the job is committed on it
+        user_id: The requesting user
+        report_range: A reports.ReportRange
+        report_format: One of ``reports.available_formats()``
+
+    Returns:
+        The job id
+    """
+    if report_format not in reports.available_formats():
+        raise ReportJobError(f"{report_format.upper()} reports are not available")
+    active = conn.query('active_report_job_count', (user_id, STATUS_QUEUED, STATUS_RUNNING)).fetchone()[0]
+    if active >= Config.REPORT_MAX_ACTIVE_JOBS:
+        raise ReportJobError(f"You already have {active} reports being prepared; please wait for them to finish")
+
+    job_id = conn.query('insert_report_job', (
+        user_id, STATUS_QUEUED, report_format, report_range.start.isoformat(), report_range.end.isoformat(),
+        report_range.title, report_range.label, report_range.month, _now(),
+    )).fetchone()[0]
+    conn.commit()
+    submit(job_id)
+    return job_id
+
+
+def _generate(conn, job):
+    """Write and store the report for a claimed job; returns the finish_report_job values"""
+    extension, content_type, write, _ = reports.FORMATS[job['format']]
+    report_range = reports.ReportRange(
+        date.fromisoformat(job['range_start']), date.fromisoformat(job['range_end']),
+        job['title'], job['label'], job['month'],
+    )
+    stored_name = f"{secrets.token_hex(16)}{extension}"
+
+    with tempfile.TemporaryFile() as output:
+        write(output, conn, job['user_id'], report_range)
+        size = output.tell()
+        output.seek(0)
+        backend = cloud_storage.get_backend()
+        upload = FileStorage(stream=output, filename=stored_name, content_type=content_type)
+        try:
+            with metrics.timed(backend.name, 'save'):
+                path = backend.save(upload, stored_name, DIRECTORY, private=True)
+        except Exception as e:
+            if isinstance(backend, cloud_storage.LocalStorage):
+                raise
+            logger.error(f"Error uploading report to {backend.name}: {e}, falling back to local storage")
+            backend = cloud_storage.LocalStorage()
+            output.seek(0)
+            path = backend.save(upload, stored_name, DIRECTORY, private=True)
+    return backend.name, path, stored_name, content_type, size
+
+
+def run_job(job_id):
+    """
+    Generate one queued report; runs in a report worker process
+
+    Returns:
+        The job's final status, or None if another worker claimed it first
+    """
+    with db.connection() as conn:
+        claimed = conn.query('claim_report_job', (STATUS_RUNNING, _now(), job_id, STATUS_QUEUED)).rowcount
+        conn.commit()
+        if not claimed:
+            return None
+        job = conn.query('report_job', (job_id,)).fetchone()
+        try:
+            storage, path, stored_name, content_type, size = _generate(conn, job)
+        except Exception as e:
+            conn.rollback()
+            logger.error(f"Error generating report job {job_id}: {e}")
+            conn.query('fail_report_job', (STATUS_FAILED, str(e)[:500], _now(), job_id))
+            conn.commit()
+            return STATUS_FAILED
+        conn.query('finish_report_job', (STATUS_DONE, storage, path, stored_name, content_type, size, _now(), job_id))
+        conn.commit()
+        logger.info(f"Report job {job_id} finished: {download_name(job)}, {size} bytes")
+    return STATUS_DONE
+
+
+def resume_pending(limit=1000):
+    """Requeue jobs lost with their worker and start every queued job"""
+    stale = (datetime.now() - timedelta(seconds=Config.REPORT_JOB_TIMEOUT)).strftime('%Y-%m-%d %H:%M:%S')
+    with db.connection() as conn:
+        conn.query('requeue_stale_report_jobs', (STATUS_QUEUED, STATUS_RUNNING, stale))
+        conn.commit()
+        rows = conn.query('queued_report_jobs', (STATUS_QUEUED, limit)).fetchall()
+    for row in rows:
+        submit(row[0])
+    return len(rows)
+
+
+def purge_expired(limit=1000):
+    """Delete jobs finished more than REPORT_RETENTION_DAYS ago, with their files"""
+    cutoff = (datetime.now() - timedelta(days=Config.REPORT_RETENTION_DAYS)).strftime('%Y-%m-%d %H:%M:%S')
+    with db.connection() as conn:
+        rows = conn.query('expired_report_jobs', (cutoff, limit)).fetchall()
+        for job_id, storage, stored_name in rows:
+            backend = cloud_storage.backend_for(storage) if stored_name else None
+            if backend is not None:
+                try:
+                    with metrics.timed(backend.name, 'delete'):
+                        backend.delete(stored_name, DIRECTORY, private=True)
+                except Exception as e:
+                    logger.error(f"Error deleting report {stored_name}: {e}")
+                    continue
+            conn.query('delete_report_job', (job_id,))
+            conn.commit()
+    return len(rows)
+
+
+def download_name(job):
+    return f"expense_report_{job['label']}{reports.FORMATS[job['format']][0]}"
+
+
+def job_json(job):
+    """Serialise a report_jobs row for the status API"""
+    return {
+        'id': job['id'],
+        'status': job['status'],
+        'format': job['format'],
+        'title': job['title'],
+        'created_at': job['created_at'],
+        'finished_at': job['finished_at'],
+        'size': job['size'],
+        'error': job['error'],
+        'download_url': url_for('main.download_report_job', job_id=job['id']) if job['status'] == STATUS_DONE else None,
+    }
+
+
+def serve(job):
+    """
+    Build the download response for a finished job, or None if its file is gone
+
+    Local reports are sent by this worker. Reports in the cloud redirect to
+    a URL signed for REPORT_DOWNLOAD_URL_EXPIRY seconds, or are streamed
+    through this worker when the backend cannot sign one.
+    """
+    name = download_name(job)
+    backend = cloud_storage.backend_for(job['storage'])
+    if backend is None:
+        logger.error(f"Report {job['filename']} is in {job['storage']} storage, which is not configured")
+        return None
+
+    if isinstance(backend, cloud_storage.LocalStorage):
+        file_path = backend.file_path(job['path'], private=True)
+        if not os.path.isfile(file_path):
+            logger.error(f"Stored report {job['path']} is missing")
+            return None
+        response = send_file(file_path, mimetype=job['content_type'], as_attachment=True,
+                             download_name=name, conditional=True)
+    else:
+        try:
+            url = backend.signed_url(
+                job['filename'], DIRECTORY, Config.REPORT_DOWNLOAD_URL_EXPIRY, name, job['content_type']
+            )
+        except Exception as e:
+            logger.warning(f"Could not sign a download URL for report {job['filename']}: {e}")
+            url = None
+        if url:
+            response = redirect(url)
+        else:
+            with metrics.timed(backend.name, 'read'):
+                content = backend.read(job['filename'], DIRECTORY, private=True)
+            response = Response(content, mimetype=job['content_type'])
+            response.headers['Content-Disposition'] = f'attachment; filename="{name}"'
+    response.headers['Cache-Control'] = cloud_storage.PRIVATE_CACHE_CONTROL
+    return response
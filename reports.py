@@ -0,0 +1,308 @@
+"""
+Expense report generation
+
+Reports cover an inclusive date range and are produced as a stream of CSV
+chunks: expense rows are read in batches through a server-side cursor and
+written out as they arrive, so memory use does not grow with the range. The
+category summary at the end comes from an aggregate query.
+
+The same report can be written to a file as CSV, XLSX (needs ``openpyxl``)
+or PDF (needs ``reportlab``); report_jobs.py does that in the background for
+large ranges.
+
+Ranges reaching back past the archive horizon include the archived expenses
+(see archive.py), merged in by date.
+"""
+import csv
+import importlib.util
+import io
+from datetime import date, datetime, timedelta
+from functools import lru_cache
+from config import Config
+import archive
+import money
+import rollups
+
+# Open ends of an all-time range
+MIN_DATE = date(1, 1, 1)
+MAX_DATE = date(9999, 12, 31)
+
+
+class ReportRangeError(ValueError):
+    """Raised for report parameters that do not describe a valid date range"""
+
+
+class ReportRange:
+    """An inclusive [start, end] range of dates with a title and download name"""
+
+    def __init__(self, start, end, title, label, month=None):
+        self.start = start
+        self.end = end
+        self.title = title
+        self.label = label
+        # Set for single-month reports, which compare spending with budgets
+        self.month = month
+
+    @property
+    def filename(self):
+        return f"expense_report_{self.label}.csv"
+
+    def days(self, today=None):
+        """Number of days covered, counting open ends as far as they can go"""
+        end = min(self.end, today or date.today())
+        if end < self.start:
+            return 0
+        return (end - self.start).days + 1
+
+
+def _parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ReportRangeError(f"Invalid date: {value}")
+
+
+def parse_report_range(args, today=None):
+    """
+    Build a ReportRange from request arguments
+
+    Args:
+        args: Mapping with either ``month`` (YYYY-MM), or ``from`` and/or
+            ``to`` (YYYY-MM-DD, inclusive; a missing side is open-ended)
+        today: Used for the default current-month report
+
+    Returns:
+        A ReportRange
+    """
+    date_from = args.get('from')
+    date_to = args.get('to')
+
+    if date_from or date_to:
+        start = _parse_date(date_from) if date_from else MIN_DATE
+        end = _parse_date(date_to) if date_to else MAX_DATE
+        if start > end:
+            raise ReportRangeError("The start date must not be after the end date")
+        label = f"{date_from or 'start'}_to_{date_to or 'today'}"
+        title = f"{date_from or 'All time'} to {date_to or 'today'}"
+        return ReportRange(start, end, title, label)
+
+    if args.get('all'):
+        return ReportRange(MIN_DATE, MAX_DATE, 'All time', 'all_time')
+
+    month = args.get('month') or (today or datetime.now()).strftime('%Y-%m')
+    try:
+        first = datetime.strptime(month, '%Y-%m').date()
+    except ValueError:
+        raise ReportRangeError(f"Invalid month: {month}")
+    next_month = (first.replace(day=28) + timedelta(days=4)).replace(day=1)
+    last = next_month - timedelta(days=1)
+    return ReportRange(
+        first,
+        last,
+        first.strftime('%Y-%m'),
+        first.strftime('%B_%Y'),
+        month=first.strftime('%Y-%m'),
+    )
+
+
+def _is_month_aligned(report_range):
+    start_aligned = report_range.start == MIN_DATE or report_range.start.day == 1
+    if report_range.end == MAX_DATE:
+        return start_aligned
+    return start_aligned and (report_range.end + timedelta(days=1)).day == 1
+
+
+def category_totals(conn, user_id, report_range):
+    """
+    Return ``[(category, spent_cents), ...]`` for the range, ordered by category
+
+    Ranges made of whole months are answered from the monthly rollups;
+    anything else is aggregated from the expenses table and the archives.
+    """
+    if _is_month_aligned(report_range):
+        return conn.query(
+            'rollup_categories_between',
+            (user_id, rollups.expense_month(report_range.start), rollups.expense_month(report_range.end))
+        ).fetchall()
+    totals = conn.query(
+        'report_category_totals',
+        (user_id, report_range.start, report_range.end)
+    ).fetchall()
+    archived = archive.category_totals(conn, user_id, report_range.start, report_range.end)
+    if not archived:
+        return totals
+    archived.update(dict(totals))
+    return sorted(archived.items())
+
+
+def report_title(report_range):
+    if report_range.month:
+        return ['Monthly Expense Report', report_range.month]
+    return ['Expense Report', report_range.title]
+
+
+def summary_rows(conn, user_id, report_range):
+    """
+    Return ``(header, rows, total)`` for the category summary
+
+    Single-month reports include each category's monthly budget and what is
+    left of it. Amounts are in cents.
+    """
+    totals = category_totals(conn, user_id, report_range)
+    total_amount = sum(spent for _, spent in totals)
+    if not report_range.month:
+        return ['Category', 'Spent'], [(category, spent) for category, spent in totals], total_amount
+
+    budgets = conn.query('monthly_budgets', (user_id,)).fetchall()
+    budget_dict = {budget[0]: budget[1] for budget in budgets}
+    rows = []
+    for category, spent in totals:
+        budget = budget_dict.get(category, 0)
+        remaining = budget - spent if budget > 0 else 0
+        rows.append((category, spent, budget, remaining))
+    return ['Category', 'Spent', 'Budget', 'Remaining'], rows, total_amount
+
+
+def iter_csv(conn, user_id, report_range, batch_size=None):
+    """
+    Yield the CSV report for ``report_range`` in chunks
+
+    Single-month reports include each category's monthly budget and what is
+    left of it, as the original monthly report did.
+    """
+    batch_size = batch_size or Config.REPORT_BATCH_SIZE
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+
+    def flush():
+        chunk = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate(0)
+        return chunk
+
+    # Write header
+    writer.writerow(report_title(report_range))
+    writer.writerow([])
+    writer.writerow(['Date', 'Category', 'Amount', 'Description'])
+    yield flush()
+
+    # Write expense data batch by batch
+    for rows in archive.stream_expenses(conn, user_id, report_range.start, report_range.end, batch_size):
+        for expense in rows:
+            writer.writerow([expense[0], expense[1], money.format_money(expense[2]), expense[3]])
+        yield flush()
+
+    # Write summary
+    header, rows, total_amount = summary_rows(conn, user_id, report_range)
+    writer.writerow([])
+    writer.writerow(['Category Summary'])
+    writer.writerow(header)
+    for category, *amounts in rows:
+        writer.writerow([category] + [money.format_money(amount) for amount in amounts])
+
+    writer.writerow([])
+    writer.writerow(['Total Expenses', money.format_money(total_amount)])
+    yield flush()
+
+
+def write_csv(file, conn, user_id, report_range, batch_size=None):
+    """Write the CSV report to a binary file"""
+    for chunk in iter_csv(conn, user_id, report_range, batch_size):
+        file.write(chunk.encode('utf-8'))
+
+
+def write_xlsx(file, conn, user_id, report_range, batch_size=None):
+    """
+    Write the report as an Excel workbook with Expenses and Summary sheets
+
+    The workbook is written in openpyxl's write-only mode, which keeps
+    finished rows on disk rather than in memory.
+    """
+    from openpyxl import Workbook
+
+    batch_size = batch_size or Config.REPORT_BATCH_SIZE
+    workbook = Workbook(write_only=True)
+    sheet = workbook.create_sheet('Expenses')
+    sheet.append(report_title(report_range))
+    sheet.append([])
+    sheet.append(['Date', 'Category', 'Amount', 'Description'])
+    for rows in archive.stream_expenses(conn, user_id, report_range.start, report_range.end, batch_size):
+        for expense in rows:
+            sheet.append([expense[0], expense[1], money.to_float(expense[2]), expense[3]])
+
+    header, rows, total_amount = summary_rows(conn, user_id, report_range)
+    summary = workbook.create_sheet('Summary')
+    summary.append(header)
+    for category, *amounts in rows:
+        summary.append([category] + [money.to_float(amount) for amount in amounts])
+    summary.append([])
+    summary.append(['Total Expenses', money.to_float(total_amount)])
+    workbook.save(file)
+
+
+# Left edge of each PDF column, in points
+PDF_COLUMNS = (40, 110, 220, 300)
+PDF_DESCRIPTION_CHARS = 50
+
+
+def write_pdf(file, conn, user_id, report_range, batch_size=None):
+    """Write the report as a paginated PDF table"""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfgen import canvas
+
+    batch_size = batch_size or Config.REPORT_BATCH_SIZE
+    width, height = A4
+    top, bottom, leading = height - 50, 40, 13
+    pdf = canvas.Canvas(file, pagesize=A4)
+    pdf.setTitle(' '.join(report_title(report_range)))
+    y = top
+
+    def line(cells, bold=False):
+        nonlocal y
+        if y < bottom:
+            pdf.showPage()
+            y = top
+        pdf.setFont('Helvetica-Bold' if bold else 'Helvetica', 9)
+        for x, cell in zip(PDF_COLUMNS, cells):
+            pdf.drawString(x, y, str(cell))
+        y -= leading
+
+    pdf.setFont('Helvetica-Bold', 14)
+    pdf.drawString(PDF_COLUMNS[0], y, ' - '.join(report_title(report_range)))
+    y -= leading * 2
+    line(['Date', 'Category', 'Amount', 'Description'], bold=True)
+    for rows in archive.stream_expenses(conn, user_id, report_range.start, report_range.end, batch_size):
+        for expense in rows:
+            line([expense[0], expense[1], money.format_money(expense[2]), (expense[3] or '')[:PDF_DESCRIPTION_CHARS]])
+
+    header, rows, total_amount = summary_rows(conn, user_id, report_range)
+    y -= leading
+    line(['Category Summary'], bold=True)
+    line(header, bold=True)
+    for category, *amounts in rows:
+        line([category] + [money.format_money(amount) for amount in amounts])
+    y -= leading
+    line(['Total Expenses', money.format_money(total_amount)], bold=True)
+    pdf.save()
+
+
+# format: (extension, content type, writer, module it needs)
+FORMATS = {
+    'csv': ('.csv', 'text/csv', write_csv, None),
+    'xlsx': ('.xlsx', 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet', write_xlsx, 'openpyxl'),
+    'pdf': ('.pdf', 'application/pdf', write_pdf, 'reportlab'),
+}
+
+
+@lru_cache(maxsize=None)
+def available_formats():
+    """
+    Return the report formats whose optional dependency is installed
+
+    Checked once per process without importing the modules; installing one
+    takes a restart to show up.
+    """
+    return tuple(
+        name for name, (_, _, _, module) in FORMATS.items()
+        if module is None or importlib.util.find_spec(module) is not None
+    )
@@ -0,0 +1,235 @@
+"""
+Per-user response cache
+
+Read-heavy pages are cached per user under a key that includes the user's
+data version (see dashboard.py). Every write route bumps that version in the
+same transaction as the write, so a cached page is never served after the
+data under it changed; entries for older versions are simply never asked
+for again and age out.
+
+Backends:
+    memory  An LRU in each worker, bounded by RESPONSE_CACHE_MAX_BYTES (default)
+    redis   Shared by all workers and hosts at REDIS_URL; needs ``redis``
+    none    Caching disabled
+
+Hit, miss and eviction counts are returned by ``stats()``.
+"""
+import os
+import pickle
+import threading
+import logging
+from functools import wraps
+from flask import Response, request, make_response
+from flask_login import current_user
+from cache import LRUCache
+from config import Config
+import dashboard
+import db
+
+logger = logging.getLogger(__name__)
+
+
+class CachedResponse:
+    """The parts of a response needed to replay it"""
+
+    def __init__(self, status, headers, body):
+        self.status = status
+        self.headers = headers
+        self.body = body
+
+    def to_response(self):
+        response = Response(self.body, status=self.status, headers=self.headers)
+        response.headers['X-Cache'] = 'HIT'
+        return response
+
+
+class MemoryBackend:
+    name = 'memory'
+
+    def __init__(self, maxbytes, ttl):
+        self.cache = LRUCache(
+            maxsize=Config.RESPONSE_CACHE_MAX_ENTRIES,
+            ttl=ttl,
+            maxbytes=maxbytes,
+            weigh=lambda entry: len(entry.body),
+        )
+
+    def get(self, key):
+        return self.cache.get(key)
+
+    def set(self, key, entry):
+        self.cache.set(key, entry)
+
+    def stats(self):
+        return self.cache.stats()
+
+
+class RedisBackend:
+    """
+    Shares cached responses between workers through Redis
+
+    Evictions are made by Redis under its ``maxmemory`` policy and are
+    reported from its INFO stats.
+    """
+    name = 'redis'
+
+    def __init__(self, url, ttl):
+        import redis
+
+        self.client = redis.Redis.from_url(url)
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._lock = threading.Lock()
+
+    def _count(self, attribute):
+        with self._lock:
+            setattr(self, attribute, getattr(self, attribute) + 1)
+
+    def get(self, key):
+        try:
+            data = self.client.get(f"response:{key}")
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Response cache read failed: {e}")
+            return None
+        if data is None:
+            self._count('misses')
+            return None
+        self._count('hits')
+        status, headers, body = pickle.loads(data)
+        return CachedResponse(status, headers, body)
+
+    def set(self, key, entry):
+        try:
+            self.client.set(
+                f"response:{key}",
+                pickle.dumps((entry.status, entry.headers, entry.body)),
+                ex=self.ttl,
+            )
+        except Exception as e:
+            self._count('errors')
+            logger.warning(f"Response cache write failed: {e}")
+
+    def stats(self):
+        stats = {'hits': self.hits, 'misses': self.misses, 'errors': self.errors}
+        try:
+            stats['evictions'] = self.client.info('stats').get('evicted_keys', 0)
+        except Exception:
+            pass
+        return stats
+
+
+def create_backend(backend=None):
+    """Build the configured backend, falling back to memory if Redis is unavailable"""
+    backend = backend or Config.RESPONSE_CACHE_BACKEND
+    if backend == 'none':
+        return None
+    if backend == 'redis':
+        if not Config.REDIS_URL:
+            logger.error("RESPONSE_CACHE_BACKEND is redis but REDIS_URL is not set, using memory")
+        else:
+            try:
+                return RedisBackend(Config.REDIS_URL, Config.RESPONSE_CACHE_TTL)
+            except ImportError:
+                logger.error("redis is not installed, using the in-memory response cache")
+    elif backend != 'memory':
+        logger.warning(f"Unknown response cache backend: {backend}, using memory")
+    return MemoryBackend(Config.RESPONSE_CACHE_MAX_BYTES, Config.RESPONSE_CACHE_TTL)
+
+
+_backend = None
+_backend_pid = None
+_backend_lock = threading.Lock()
+
+
+def get_backend():
+    """Return this process's cache backend, rebuilding it after a fork"""
+    global _backend, _backend_pid
+    pid = os.getpid()
+    if _backend_pid != pid:
+        with _backend_lock:
+            if _backend_pid != pid:
+                _backend = create_backend()
+                _backend_pid = pid
+    return _backend
+
+
+def set_backend(backend):
+    """Replace the process's backend, e.g. to disable caching in tests"""
+    global _backend, _backend_pid
+    with _backend_lock:
+        _backend = backend
+        _backend_pid = os.getpid()
+
+
+def stats():
+    backend = get_backend()
+    if backend is None:
+        return {'backend': 'none'}
+    return dict(backend.stats(), backend=backend.name)
+
+
+def _tee(chunks, backend, key, status, headers):
+    """Pass a streamed body through, caching it if it stays small enough"""
+    body = []
+    size = 0
+    try:
+        for chunk in chunks:
+            if body is not None:
+                data = chunk.encode() if isinstance(chunk, str) else chunk
+                size += len(data)
+                if size > Config.RESPONSE_CACHE_MAX_ITEM_BYTES:
+                    body = None
+                else:
+                    body.append(data)
+            yield chunk
+    finally:
+        # Let the wrapped stream release its request context and connection
+        if hasattr(chunks, 'close'):
+            chunks.close()
+    if body is not None:
+        backend.set(key, CachedResponse(status, headers, b''.join(body)))
+
+
+def cached(*key_parts):
+    """
+    Cache a login-required GET view per user and data version
+
+    Only for views whose output depends on nothing but the user's data, the
+    query string and ``key_parts``; in particular not for pages that show
+    flashed messages.
+
+    Args:
+        key_parts: Callables returning anything else the response depends
+            on, such as today's date; the query string is always included
+    """
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            backend = get_backend()
+            if backend is None or request.method != 'GET':
+                return view(*args, **kwargs)
+
+            version = dashboard.data_version(db.get_db_connection(), current_user.id)
+            parts = [view.__name__, current_user.id, version, request.query_string.decode()]
+            parts.extend(part() for part in key_parts)
+            key = ':'.join(str(part) for part in parts)
+
+            entry = backend.get(key)
+            if entry is not None:
+                return entry.to_response()
+
+            response = make_response(view(*args, **kwargs))
+            if response.status_code != 200:
+                return response
+            headers = [(name, value) for name, value in response.headers if name.lower() != 'content-length']
+            if response.is_streamed:
+                response.response = _tee(response.response, backend, key, response.status_code, headers)
+            elif response.content_length is None or response.content_length <= Config.RESPONSE_CACHE_MAX_ITEM_BYTES:
+                backend.set(key, CachedResponse(response.status_code, headers, response.get_data()))
+            response.headers['X-Cache'] = 'MISS'
+            return response
+        return wrapper
+    return decorator
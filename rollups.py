@@ -0,0 +1,59 @@
+"""
+Per-user monthly category rollups
+
+``expense_rollups`` holds one row per (user_id, month, category) with the sum
+in cents and the count of the matching expenses. The helpers here are called
+with the same connection, and therefore inside the same transaction, as the
+expense INSERT or DELETE they account for, so the rollups never drift from
+the ledger. ``rebuild_rollups`` recomputes them from scratch for existing data.
+
+Archived expenses (see archive.py) keep counting towards the rollups.
+"""
+
+
+def expense_month(date):
+    """Return the YYYY-MM rollup key for an expense date"""
+    return f"{date.year:04d}-{date.month:02d}"
+
+
+def add_expense(conn, user_id, date, category, amount_cents):
+    """Account for a newly inserted expense"""
+    conn.query('rollup_add', (user_id, expense_month(date), category, amount_cents))
+
+
+def add_expenses(conn, user_id, month, category, total_cents, count):
+    """Account for ``count`` inserted expenses of one month and category, e.g. from an import"""
+    conn.query('rollup_add_many', (user_id, month, category, total_cents, count))
+
+
+def remove_expense(conn, user_id, date, category, amount_cents):
+    """Account for a deleted expense, dropping rollup rows that become empty"""
+    key = (user_id, expense_month(date), category)
+    conn.query('rollup_subtract', (amount_cents,) + key)
+    conn.query('rollup_prune', key)
+
+
+def rebuild_rollups(conn, user_id=None):
+    """
+    Recompute rollups from the expenses table and the expense archives
+
+    Args:
+        conn: A pooled connection; the caller commits
+        user_id: Only rebuild this user's rollups when given
+
+    Returns:
+        The number of rollup rows written
+    """
+    # Imported here since archive.py imports this module
+    import archive
+
+    if user_id is None:
+        conn.query('rollup_clear_all')
+        conn.query('rollup_rebuild_all')
+        archive.add_rollups(conn)
+        return conn.query('rollup_count_all').fetchone()[0]
+
+    conn.query('rollup_clear_user', (user_id,))
+    conn.query('rollup_rebuild_user', (user_id,))
+    archive.add_rollups(conn, user_id)
+    return conn.query('rollup_count_user', (user_id,)).fetchone()[0]
@@ -0,0 +1,246 @@
+"""
+Expense search
+
+Searches a user's expenses by description words, with optional category,
+amount and date filters. Words are matched as prefixes ("gro" finds
+"Grocery") and all of them must match. Text searches run on the full-text
+index from migration 8 (FTS5 on SQLite, a GIN-indexed tsvector on
+PostgreSQL) and are ordered by relevance; searches without words are
+ordered newest first like the dashboard.
+
+Every search also returns how many matching expenses fall in each category,
+counted without the category filter so the other categories stay
+selectable.
+
+Archived expenses (see archive.py) are matched in Python against the same
+words and filters when the searched dates reach back into an archive; they
+follow the matches from the expenses table, newest first.
+"""
+import re
+import hashlib
+from collections import Counter
+from datetime import datetime
+from config import Config
+import archive
+import money
+
+# Words beyond this are ignored
+MAX_TERMS = 8
+
+WORD = re.compile(r'\w+', re.UNICODE)
+
+RESULT_COLUMNS = (
+    'e.id, e.date, e.category, e.amount_cents, e.description, e.receipt_path, e.receipt_status, '
+    'e.receipt_thumb_path, e.receipt_digest'
+)
+
+
+class SearchError(ValueError):
+    """Raised for search parameters that cannot be used"""
+
+
+class SearchQuery:
+    """Parsed search parameters"""
+
+    def __init__(self, terms=(), categories=(), min_cents=None, max_cents=None,
+                 date_from=None, date_to=None, page=1, limit=None):
+        self.terms = list(terms)
+        self.categories = list(categories)
+        self.min_cents = min_cents
+        self.max_cents = max_cents
+        self.date_from = date_from
+        self.date_to = date_to
+        self.page = page
+        self.limit = limit or Config.EXPENSES_PAGE_SIZE
+
+    @property
+    def offset(self):
+        return (self.page - 1) * self.limit
+
+    def digest(self):
+        """A short key identifying the search, for ETags and cache keys"""
+        text = repr((self.terms, sorted(self.categories), self.min_cents, self.max_cents,
+                     self.date_from, self.date_to, self.page, self.limit))
+        return hashlib.blake2b(text.encode(), digest_size=8).hexdigest()
+
+
+class SearchResult:
+    def __init__(self, query, rows, facets):
+        self.query = query
+        self.rows = rows
+        # [(category, count), ...], largest first
+        self.facets = facets
+
+    @property
+    def total(self):
+        if self.query.categories:
+            return sum(count for category, count in self.facets if category in self.query.categories)
+        return sum(count for _, count in self.facets)
+
+    @property
+    def has_next(self):
+        return self.query.offset + len(self.rows) < self.total
+
+
+def _amount(value, name):
+    if value in (None, ''):
+        return None
+    try:
+        return money.to_cents(value)
+    except ValueError:
+        raise SearchError(f"Invalid {name}: {value}")
+
+
+def _date(value, name):
+    if not value:
+        return None
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise SearchError(f"Invalid {name}: {value}")
+
+
+def parse_search(args, max_limit=None):
+    """
+    Build a SearchQuery from request arguments
+
+    Args:
+        args: A MultiDict with ``q``, ``category`` (repeatable),
+            ``min_amount``, ``max_amount``, ``from``, ``to`` (YYYY-MM-DD,
+            inclusive), ``page`` and ``limit``
+        max_limit: Largest page size allowed
+    """
+    terms = [word.lower() for word in WORD.findall(args.get('q', ''))][:MAX_TERMS]
+    limit = args.get('limit', Config.EXPENSES_PAGE_SIZE, type=int) or Config.EXPENSES_PAGE_SIZE
+    limit = max(min(limit, max_limit or Config.API_MAX_PAGE_SIZE), 1)
+    page = max(args.get('page', 1, type=int) or 1, 1)
+    query = SearchQuery(
+        terms=terms,
+        categories=[category for category in args.getlist('category') if category],
+        min_cents=_amount(args.get('min_amount'), 'minimum amount'),
+        max_cents=_amount(args.get('max_amount'), 'maximum amount'),
+        date_from=_date(args.get('from'), 'start date'),
+        date_to=_date(args.get('to'), 'end date'),
+        page=page,
+        limit=limit,
+    )
+    if query.date_from and query.date_to and query.date_from > query.date_to:
+        raise SearchError("The start date must not be after the end date")
+    return query
+
+
+def _match(conn, terms):
+    """Return ``(from_sql, where_sql, params, score_sql)`` for the text part of a search"""
+    if conn.dialect == 'postgresql':
+        # Words are \w+ only, so they cannot carry tsquery operators
+        tsquery = ' & '.join(f"{term}:*" for term in terms)
+        return (
+            "expenses e, to_tsquery('simple', ?) q",
+            'e.description_tsv @@ q',
+            [tsquery],
+            'ts_rank(e.description_tsv, q)',
+        )
+    match = ' '.join(f'"{term}"*' for term in terms)
+    return (
+        # CROSS JOIN keeps SQLite from running the MATCH once per expense
+        'expenses_fts CROSS JOIN expenses e ON e.id = expenses_fts.rowid',
+        'expenses_fts MATCH ?',
+        [match],
+        # FTS5's bm25 rank is lower for better matches
+        '-expenses_fts.rank',
+    )
+
+
+def _filters(query, with_categories=True):
+    where = []
+    params = []
+    if with_categories and query.categories:
+        where.append(f"e.category IN ({', '.join('?' * len(query.categories))})")
+        params.extend(query.categories)
+    if query.min_cents is not None:
+        where.append('e.amount_cents >= ?')
+        params.append(query.min_cents)
+    if query.max_cents is not None:
+        where.append('e.amount_cents <= ?')
+        params.append(query.max_cents)
+    if query.date_from:
+        where.append('e.date >= ?')
+        params.append(query.date_from)
+    if query.date_to:
+        where.append('e.date <= ?')
+        params.append(query.date_to)
+    return where, params
+
+
+def _archived_matches(archives, query):
+    """
+    Return ``(rows, facets)`` for the archived part of a search
+
+    ``rows`` are the matches newest first, with the category filter applied;
+    ``facets`` counts matches per category without it.
+    """
+    terms = [archive.fold(term) for term in query.terms]
+    rows = []
+    facets = Counter()
+    for row in archive.iter_expenses(archives, query.date_from, query.date_to, newest_first=True, terms=terms):
+        if query.min_cents is not None and row[2] < query.min_cents:
+            continue
+        if query.max_cents is not None and row[2] > query.max_cents:
+            continue
+        facets[row[1]] += 1
+        if not query.categories or row[1] in query.categories:
+            rows.append(row)
+    return rows, facets
+
+
+def search(conn, user_id, query):
+    """
+    Run a search for one user
+
+    Args:
+        conn: A pooled connection
+        user_id: Whose expenses to search
+        query: A SearchQuery
+
+    Returns:
+        A SearchResult with one page of rows, best matches first
+    """
+    if query.terms:
+        from_sql, match_sql, match_params, score_sql = _match(conn, query.terms)
+        where, params = [match_sql, 'e.user_id = ?'], match_params + [user_id]
+        order = 'score DESC, e.date DESC, e.id DESC'
+    else:
+        from_sql, score_sql = 'expenses e', '0'
+        where, params = ['e.user_id = ?'], [user_id]
+        order = 'e.date DESC, e.id DESC'
+
+    filters, filter_params = _filters(query)
+    rows = conn.execute(
+        f"SELECT {RESULT_COLUMNS}, {score_sql} AS score FROM {from_sql} "
+        f"WHERE {' AND '.join(where + filters)} ORDER BY {order} LIMIT ? OFFSET ?",
+        params + filter_params + [query.limit, query.offset],
+    ).fetchall()
+
+    archives = archive.archives_between(conn, user_id, query.date_from, query.date_to)
+    facet_filters, facet_params = _filters(query, with_categories=False)
+    if not query.terms and not facet_filters and not archives:
+        # Nothing narrows the search, so the rollups already hold the counts
+        facets = conn.query('rollup_category_counts', (user_id,)).fetchall()
+        return SearchResult(query, rows, [(row[0], row[1]) for row in facets])
+    facets = conn.execute(
+        f"SELECT e.category, COUNT(*) AS matches FROM {from_sql} "
+        f"WHERE {' AND '.join(where + facet_filters)} GROUP BY e.category ORDER BY matches DESC, e.category",
+        params + facet_params,
+    ).fetchall()
+    facets = [(row[0], row[1]) for row in facets]
+    if not archives:
+        return SearchResult(query, rows, facets)
+
+    # Archived matches continue where the table's run out
+    table_total = SearchResult(query, rows, facets).total
+    archived_rows, archived_facets = _archived_matches(archives, query)
+    skip = max(query.offset - table_total, 0)
+    rows = list(rows) + archived_rows[skip:skip + query.limit - len(rows)]
+    counts = Counter(dict(facets)) + archived_facets
+    facets = sorted(counts.items(), key=lambda item: (-item[1], item[0]))
+    return SearchResult(query, rows, facets)
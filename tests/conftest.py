@@ -0,0 +1,95 @@
+import os
+import sys
+
+import pytest
+
+# The app's modules live at the repository root rather than in a package
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cloud_storage  # noqa: E402
+import db  # noqa: E402
+import migrations  # noqa: E402
+
+
+class FakeStorage(cloud_storage.StorageBackend):
+    """Keeps stored files in memory, as a cloud backend would keep objects"""
+    name = 'fake'
+
+    def __init__(self, fail=False):
+        self.objects = {}
+        self.private = set()
+        self.fail = fail
+
+    def save(self, file, filename, directory='receipts', private=False):
+        if self.fail:
+            raise ConnectionError('store unavailable')
+        key = f'{directory}/{filename}'
+        self.objects[key] = cloud_storage._stream(file).read()
+        if private:
+            self.private.add(key)
+        return f'https://fake.example/{key}'
+
+    def read(self, filename, directory='receipts', private=False):
+        return self.objects[f'{directory}/{filename}']
+
+    def delete(self, filename, directory='receipts', private=False):
+        self.objects.pop(f'{directory}/{filename}', None)
+
+    def signed_url(self, filename, directory, expires, download_name=None, content_type=None):
+        return f'https://fake.example/{directory}/{filename}?expires={expires}'
+
+
+@pytest.fixture
+def database(tmp_path, monkeypatch):
+    """Point the process's pool at a fresh, fully migrated SQLite database"""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'test.db'}")
+    monkeypatch.setattr(db, '_pool', None)
+    with db.connection() as conn:
+        migrations.upgrade(conn)
+    yield db.get_pool()
+    db.get_pool().dispose()
+
+
+@pytest.fixture
+def user_id(database):
+    with db.connection() as conn:
+        conn.query('insert_user', ('tester', 'not-a-password-hash'))
+        user_id = conn.query('user_id_by_username', ('tester',)).fetchone()[0]
+        conn.commit()
+    return user_id
+
+
+@pytest.fixture
+def client(user_id, monkeypatch):
+    """A test client signed in as ``user_id``, with response caching off"""
+    import app as app_module
+    import receipt_queue
+    import report_jobs
+    import response_cache
+
+    # Resuming leftover background work is not part of any request under test
+    monkeypatch.setattr(receipt_queue, 'resume_pending', lambda limit=1000: 0)
+    monkeypatch.setattr(report_jobs, 'resume_pending', lambda limit=1000: 0)
+    monkeypatch.setattr(report_jobs, 'purge_expired', lambda limit=1000: 0)
+    monkeypatch.setattr(response_cache, '_backend', None)
+    monkeypatch.setattr(response_cache, '_backend_pid', None)
+    response_cache.set_backend(None)
+    app_module.user_cache.clear()
+
+    flask_app = app_module.create_app()
+    flask_app.config['TESTING'] = True
+    client = flask_app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+        session['_user_identity'] = [str(user_id), 'tester']
+    return client
+
+
+@pytest.fixture
+def fake_backend(monkeypatch):
+    """Install a FakeStorage as the process's storage backend"""
+    backend = FakeStorage()
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(backend)
+    return backend
@@ -0,0 +1,76 @@
+import io
+import os
+from datetime import date
+
+import pytest
+
+import db
+import receipt_queue
+import rollups
+from config import Config
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'spool'
+    monkeypatch.setattr(Config, 'RECEIPT_SPOOL_DIR', str(path))
+    return path
+
+
+def expense_form(**overrides):
+    form = {'date': '2024-03-01', 'category': 'Food', 'amount': '3.50', 'description': 'coffee'}
+    form.update(overrides)
+    return form
+
+
+def test_failed_expense_insert_removes_the_spooled_receipt(client, spool_dir, monkeypatch):
+    def broken(*args):
+        raise RuntimeError('database went away')
+
+    monkeypatch.setattr(rollups, 'add_expense', broken)
+    enqueued = []
+    monkeypatch.setattr(receipt_queue, 'enqueue', lambda *args: enqueued.append(args))
+
+    response = client.post(
+        '/add_expense',
+        data=expense_form(receipt=(io.BytesIO(b'receipt'), 'coffee.pdf')),
+        content_type='multipart/form-data',
+    )
+
+    assert response.status_code == 302
+    assert enqueued == []
+    assert os.listdir(spool_dir) == []
+    with db.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM expenses').fetchone()[0] == 0
+
+
+def test_deleting_a_pending_expense_removes_the_spooled_receipt(client, user_id, spool_dir):
+    spool_dir.mkdir()
+    (spool_dir / 'coffee.pdf').write_bytes(b'receipt')
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, 'coffee.pdf')
+        ).fetchone()[0]
+        conn.commit()
+
+    client.post('/delete_expense', data={'expense_id': expense_id})
+
+    assert not (spool_dir / 'coffee.pdf').exists()
+    # The worker finds the expense gone and has nothing left to clean up
+    assert receipt_queue.process(expense_id, 'coffee.pdf') is None
+
+
+@pytest.mark.parametrize('field, value', [('amount', 'lots'), ('start_date', '2024-13-40')])
+def test_invalid_budget_is_rejected_with_a_message(client, field, value):
+    form = {'category': 'Food', 'amount': '100', 'period': 'monthly', 'start_date': '2024-03-01'}
+    form[field] = value
+
+    response = client.post('/add_budget', data=form)
+
+    assert response.status_code == 302
+    assert response.headers['Location'].endswith('/budget')
+    with client.session_transaction() as session:
+        assert ('message', 'Invalid date or amount') in session['_flashes']
+    with db.connection() as conn:
+        assert conn.execute('SELECT COUNT(*) FROM budgets').fetchone()[0] == 0
@@ -0,0 +1,63 @@
+import os
+from datetime import date
+
+import pytest
+
+import archive
+import cloud_storage
+import db
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    """Store files with LocalStorage under a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(cloud_storage.LocalStorage())
+    return tmp_path
+
+
+@pytest.fixture
+def archived_2020(user_id, local_storage):
+    with db.connection() as conn:
+        for month in range(1, 13):
+            conn.query(
+                'insert_expense', (user_id, date(2020, month, 1), 'Rent', 50000, f'rent {month}', None, None, None)
+            )
+        conn.commit()
+        assert archive.archive_year(conn, user_id, 2020, date(2021, 1, 1)) == 12
+        return conn.query('expense_archive', (user_id, 2020)).fetchone()
+
+
+def test_archives_are_stored_outside_the_served_root(archived_2020, local_storage):
+    private_dir = local_storage / cloud_storage.LOCAL_PRIVATE_STORAGE_ROOT / archive.DIRECTORY
+
+    assert os.listdir(private_dir) == [archived_2020['filename']]
+    assert not (local_storage / cloud_storage.LOCAL_STORAGE_ROOT / archive.DIRECTORY).exists()
+
+
+def test_archives_left_under_the_served_root_are_still_read_and_deleted(archived_2020, local_storage, user_id):
+    filename = archived_2020['filename']
+    public_dir = local_storage / cloud_storage.LOCAL_STORAGE_ROOT / archive.DIRECTORY
+    public_dir.mkdir(parents=True)
+    os.replace(local_storage / cloud_storage.LOCAL_PRIVATE_STORAGE_ROOT / archive.DIRECTORY / filename,
+               public_dir / filename)
+    archive._cache.clear()
+
+    with db.connection() as conn:
+        assert archive.restore_year(conn, user_id, 2020) == 12
+
+    assert not (public_dir / filename).exists()
+
+
+def test_archived_expenses_cannot_be_deleted(client, archived_2020, user_id):
+    expense_id = archive.read(archived_2020)[0]['id']
+
+    response = client.post('/delete_expense', data={'expense_id': str(expense_id)})
+
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert ('message', 'Archived expenses are read-only and cannot be deleted') in session['_flashes']
+    with db.connection() as conn:
+        assert archive.find_expense(conn, user_id, expense_id) is not None
+        assert conn.query('expense_archive', (user_id, 2020)).fetchone()['row_count'] == 12
@@ -0,0 +1,68 @@
+from datetime import date, timedelta
+
+import pytest
+
+import app as app_module
+import archive
+import cloud_storage
+import db
+from migrations import BUDGET_PERIOD_DAYS
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(cloud_storage.LocalStorage())
+
+
+def per_budget_spending(expenses, budgets, today):
+    """Spending per budget the way /budget worked it out before, one budget at a time"""
+    spent = {}
+    for budget_id, category, period, start in budgets:
+        end = min(start + timedelta(days=BUDGET_PERIOD_DAYS[period]), today)
+        spent[budget_id] = sum(
+            amount for day, expense_category, amount in expenses
+            if expense_category == category and start <= day <= end
+        )
+    return spent
+
+
+def test_budget_totals_match_the_per_budget_computation(client, user_id, local_storage, monkeypatch):
+    today = date.today()
+    expenses = [
+        # Archived below, and inside the first two windows
+        (date(2021, 1, 1), 'Food', 1000), (date(2021, 1, 31), 'Food', 200), (date(2021, 2, 1), 'Food', 30),
+        (date(2021, 3, 15), 'Rent', 50000), (date(2021, 12, 31), 'Rent', 40000),
+        # The open windows end today
+        (today - timedelta(days=2), 'Food', 7), (today, 'Food', 11), (today + timedelta(days=1), 'Food', 13),
+        (today, 'Fun', 17),
+    ]
+    budgets = [
+        ('Food', 'monthly', date(2021, 1, 1)),
+        ('Rent', 'yearly', date(2021, 1, 1)),
+        ('Food', 'monthly', today - timedelta(days=5)),
+        ('Food', 'quarterly', date(2021, 1, 15)),
+        ('Travel', 'monthly', today),
+    ]
+    with db.connection() as conn:
+        for day, category, amount in expenses:
+            conn.query('insert_expense', (user_id, day, category, amount, '', None, None, None))
+        for category, period, start in budgets:
+            conn.query('insert_budget', (
+                user_id, category, 100000, period, start, start + timedelta(days=BUDGET_PERIOD_DAYS[period])
+            ))
+        conn.commit()
+        assert archive.archive_year(conn, user_id, 2021, date(2022, 1, 1)) == 5
+        budget_rows = [
+            tuple(row) for row in conn.execute('SELECT id, category, period, start_date FROM budgets ORDER BY id')
+        ]
+
+    rendered = {}
+    monkeypatch.setattr(app_module, 'render_template', lambda template, **context: rendered.update(context) or '')
+    assert client.get('/budget').status_code == 200
+
+    expected = per_budget_spending(expenses, budget_rows, today)
+    assert {budget['id']: budget['spent'] for budget in rendered['budgets']} == expected
+    assert list(expected.values()) == [1200, 90000, 18, 230, 0]
+    assert [budget['remaining'] for budget in rendered['budgets']] == [100000 - spent for spent in expected.values()]
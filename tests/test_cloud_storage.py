@@ -0,0 +1,84 @@
+import io
+import os
+from datetime import date
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import cloud_storage
+import db
+import receipt_queue
+from config import Config
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'spool'
+    monkeypatch.setattr(Config, 'RECEIPT_SPOOL_DIR', str(path))
+    monkeypatch.setattr(Config, 'RECEIPT_UPLOAD_BACKOFF', 0)
+    return path
+
+
+RECEIPT = b'%PDF-1.4 receipt for one coffee'
+
+
+def test_get_backend_returns_the_backend_set_for_tests(fake_backend):
+    assert cloud_storage.get_backend() is fake_backend
+    assert cloud_storage.backend_for('fake') is fake_backend
+
+
+def test_save_file_uploads_to_the_backend(fake_backend):
+    upload = FileStorage(io.BytesIO(b'statement'), filename='statement.csv', content_type='text/csv')
+
+    path = cloud_storage.save_file(upload, 'statement.csv', 'imports')
+
+    assert path == 'https://fake.example/imports/statement.csv'
+    assert fake_backend.read('statement.csv', 'imports') == b'statement'
+
+
+def test_spooled_receipt_is_uploaded_to_the_backend(fake_backend, spool_dir, user_id):
+    filename = receipt_queue.spool(
+        FileStorage(io.BytesIO(RECEIPT), filename='coffee.pdf', content_type='application/pdf'), 'coffee.pdf'
+    )
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, filename)
+        ).fetchone()[0]
+        conn.commit()
+
+    path = receipt_queue.process(expense_id, filename)
+
+    assert path.startswith('https://fake.example/receipts/')
+    assert fake_backend.read(path.rsplit('/', 1)[1]) == RECEIPT
+    assert not os.path.exists(spool_dir / filename)
+    with db.connection() as conn:
+        row = conn.execute(
+            'SELECT receipt_path, receipt_status, receipt_spool FROM expenses WHERE id = ?', (expense_id,)
+        ).fetchone()
+        storage = conn.execute('SELECT storage FROM receipt_blobs').fetchone()[0]
+    assert tuple(row) == (path, receipt_queue.STATUS_STORED, None)
+    assert storage == 'fake'
+
+
+def test_receipt_falls_back_to_local_storage_when_the_backend_fails(
+    fake_backend, spool_dir, user_id, tmp_path, monkeypatch
+):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(Config, 'RECEIPT_UPLOAD_RETRIES', 2)
+    fake_backend.fail = True
+    filename = receipt_queue.spool(
+        FileStorage(io.BytesIO(RECEIPT), filename='coffee.pdf', content_type='application/pdf'), 'coffee.pdf'
+    )
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, filename)
+        ).fetchone()[0]
+        conn.commit()
+
+    path = receipt_queue.process(expense_id, filename)
+
+    assert fake_backend.objects == {}
+    with open(tmp_path / cloud_storage.LOCAL_PRIVATE_STORAGE_ROOT / path, 'rb') as f:
+        assert f.read() == RECEIPT
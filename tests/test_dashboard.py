@@ -0,0 +1,42 @@
+import dashboard
+
+
+def add_expense(client, description):
+    response = client.post('/add_expense', data={
+        'date': '2024-03-01', 'category': 'Food', 'amount': '3.50', 'description': description,
+    })
+    assert response.status_code == 302
+
+
+def test_unchanged_data_is_answered_with_304_without_building_it(client, monkeypatch):
+    built = []
+    summary = dashboard.summary
+    monkeypatch.setattr(dashboard, 'summary', lambda *args: built.append(args) or summary(*args))
+    first = client.get('/api/dashboard/summary')
+    assert first.status_code == 200
+
+    again = client.get('/api/dashboard/summary', headers={'If-None-Match': first.headers['ETag']})
+
+    assert again.status_code == 304
+    assert again.get_data() == b''
+    assert again.headers['ETag'] == first.headers['ETag']
+    assert len(built) == 1
+
+
+def test_a_write_changes_the_etag(client):
+    etag = client.get('/api/expenses').headers['ETag']
+    add_expense(client, 'coffee')
+
+    after_add = client.get('/api/expenses', headers={'If-None-Match': etag})
+
+    assert after_add.status_code == 200
+    assert after_add.headers['ETag'] != etag
+    (expense,) = after_add.get_json()['expenses']
+    assert expense['description'] == 'coffee'
+
+    client.post('/delete_expense', data={'expense_id': expense['id']})
+    after_delete = client.get('/api/expenses', headers={'If-None-Match': after_add.headers['ETag']})
+
+    assert after_delete.status_code == 200
+    assert after_delete.headers['ETag'] not in (etag, after_add.headers['ETag'])
+    assert after_delete.get_json()['expenses'] == []
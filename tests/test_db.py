@@ -0,0 +1,91 @@
+import sqlite3
+from datetime import date
+
+import psycopg2
+import pytest
+
+import db
+from config import Config
+
+
+def snapshot(source, target):
+    """Copy the SQLite database at ``source`` to ``target``"""
+    with sqlite3.connect(source) as src, sqlite3.connect(target) as dst:
+        src.backup(dst)
+
+
+@pytest.fixture
+def replica(tmp_path, monkeypatch, client):
+    """
+    Configure one read replica holding a copy of the primary as it is now
+
+    Nothing is copied across afterwards, so the replica lags behind every
+    later write, which is how a test tells which database a read went to.
+    """
+    path = tmp_path / 'replica.db'
+    snapshot(tmp_path / 'test.db', path)
+    monkeypatch.setattr(Config, 'DATABASE_REPLICA_URLS', [f"sqlite:///{path}"])
+    monkeypatch.setattr(db, '_replicas', None)
+    yield path
+    for pool in db._replicas or ():
+        pool.dispose()
+
+
+def add_expense_on_primary(user_id, description):
+    with db.connection() as conn:
+        conn.query('insert_expense', (user_id, date(2024, 3, 1), 'Food', 350, description, None, None, None))
+        conn.commit()
+
+
+def test_read_only_views_read_from_the_replica(client, replica, user_id):
+    add_expense_on_primary(user_id, 'written behind the replica')
+
+    page = client.get('/').get_data(as_text=True)
+
+    assert 'written behind the replica' not in page
+    assert db.replica_stats()['replica_reads'] >= 1
+
+
+def test_reads_after_a_write_stay_on_the_primary(client, replica):
+    sticky_reads = db.replica_stats()['sticky_reads']
+
+    response = client.post('/add_expense', data={
+        'date': '2024-03-01', 'category': 'Food', 'amount': '3.50', 'description': 'just written',
+    })
+    assert response.status_code == 302
+    with client.session_transaction() as session:
+        assert db.STICKY_KEY in session
+
+    page = client.get('/').get_data(as_text=True)
+
+    assert 'just written' in page
+    assert db.replica_stats()['sticky_reads'] == sticky_reads + 1
+
+
+def test_unreachable_replica_falls_back_to_the_primary(client, tmp_path, monkeypatch, user_id):
+    missing = tmp_path / 'missing' / 'replica.db'
+    monkeypatch.setattr(Config, 'DATABASE_REPLICA_URLS', [f"sqlite:///{missing}"])
+    monkeypatch.setattr(db, '_replicas', None)
+    before = db.replica_stats()
+    add_expense_on_primary(user_id, 'only on the primary')
+
+    page = client.get('/').get_data(as_text=True)
+
+    assert 'only on the primary' in page
+    stats = db.replica_stats()
+    assert stats['replica_errors'] == before['replica_errors'] + 1
+    assert stats['fallback_reads'] == before['fallback_reads'] + 1
+    assert stats['replicas_down'] == 1
+
+
+@pytest.mark.parametrize('url, sslmode', [
+    ('postgresql://db.example/spendizo', 'require'),
+    ('postgresql://db.example/spendizo?sslmode=disable', None),
+])
+def test_postgresql_connections_require_ssl_unless_the_url_says_otherwise(monkeypatch, url, sslmode):
+    calls = []
+    monkeypatch.setattr(psycopg2, 'connect', lambda dsn, **options: calls.append((dsn, options)))
+
+    db.ConnectionPool(url)._connect()
+
+    assert calls == [(url, {'sslmode': sslmode} if sslmode else {})]
@@ -0,0 +1,88 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import google_oauth
+from config import Config
+
+
+class DiscoveryHandler(BaseHTTPRequestHandler):
+    """Serves a discovery document like Google's and counts the requests"""
+
+    def do_GET(self):
+        self.server.hits += 1
+        base = f'http://127.0.0.1:{self.server.server_port}'
+        body = json.dumps({
+            'authorization_endpoint': f'{base}/auth',
+            'token_endpoint': f'{base}/token',
+            'userinfo_endpoint': f'{base}/userinfo',
+        }).encode()
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        if self.server.cache_control is not None:
+            self.send_header('Cache-Control', self.server.cache_control)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def discovery_server(monkeypatch):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), DiscoveryHandler)
+    server.hits = 0
+    server.cache_control = 'public, max-age=3600'
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    monkeypatch.setattr(
+        Config, 'GOOGLE_DISCOVERY_URL', f'http://127.0.0.1:{server.server_port}/.well-known/openid-configuration'
+    )
+    google_oauth.clear_provider_config()
+    yield server
+    server.shutdown()
+    server.server_close()
+    google_oauth.clear_provider_config()
+
+
+def test_discovery_document_is_fetched_once_and_cached(discovery_server):
+    first = google_oauth.get_provider_config()
+    second = google_oauth.get_provider_config()
+
+    assert first['token_endpoint'] == f'http://127.0.0.1:{discovery_server.server_port}/token'
+    assert second == first
+    assert discovery_server.hits == 1
+
+
+@pytest.mark.parametrize('cache_control', ['no-cache', 'no-store', 'max-age=0'])
+def test_discovery_document_is_refetched_when_it_may_not_be_reused(discovery_server, cache_control):
+    discovery_server.cache_control = cache_control
+    google_oauth.get_provider_config()
+    google_oauth.get_provider_config()
+    assert discovery_server.hits == 2
+
+
+def test_discovery_document_without_cache_control_is_kept_for_the_configured_ttl(discovery_server, monkeypatch):
+    monkeypatch.setattr(Config, 'OAUTH_DISCOVERY_TTL', 3600)
+    discovery_server.cache_control = None
+    google_oauth.get_provider_config()
+    google_oauth.get_provider_config()
+    assert discovery_server.hits == 1
+
+    monkeypatch.setattr(Config, 'OAUTH_DISCOVERY_TTL', 0)
+    google_oauth.clear_provider_config()
+    google_oauth.get_provider_config()
+    google_oauth.get_provider_config()
+    assert discovery_server.hits == 3
+
+
+def test_stale_discovery_document_is_served_when_refresh_fails(discovery_server):
+    discovery_server.cache_control = 'max-age=0'
+    document = google_oauth.get_provider_config()
+    discovery_server.shutdown()
+    discovery_server.server_close()
+
+    assert google_oauth.get_provider_config() == document
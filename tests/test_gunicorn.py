@@ -0,0 +1,86 @@
+"""
+Smoke test of the default gunicorn setup
+
+Runs the app in one gevent worker, as gunicorn.conf.py configures it, and
+checks that the spawn-based process pools of receipt_images.py and
+report_jobs.py work inside the monkey-patched worker.
+"""
+import io
+import os
+import subprocess
+import sys
+import time
+
+import pytest
+
+pytest.importorskip('gevent')
+pytest.importorskip('gunicorn')
+pytest.importorskip('PIL')
+requests = pytest.importorskip('requests')
+
+from PIL import Image  # noqa: E402
+
+from benchmarks.concurrency import ROOT, start_gunicorn  # noqa: E402
+
+
+@pytest.fixture
+def gevent_server(tmp_path):
+    env = dict(
+        os.environ,
+        DATABASE_URL=f"sqlite:///{tmp_path / 'app.db'}",
+        LOCAL_STORAGE_ROOT=str(tmp_path / 'static'),
+        LOCAL_PRIVATE_STORAGE_ROOT=str(tmp_path / 'private'),
+        RECEIPT_SPOOL_DIR=str(tmp_path / 'spool'),
+        METRICS_ENABLED='false',
+    )
+    subprocess.run([sys.executable, 'migrations.py', 'upgrade'], cwd=ROOT, env=env, check=True, capture_output=True)
+    process, base_url = start_gunicorn('gevent', env)
+    yield base_url
+    process.terminate()
+    process.wait(30)
+
+
+def wait_for(check, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        result = check()
+        if result:
+            return result
+        time.sleep(0.2)
+    raise AssertionError('timed out')
+
+
+def test_image_and_report_jobs_run_under_the_gevent_worker(gevent_server):
+    session = requests.Session()
+    session.post(f"{gevent_server}/register", data={'username': 'smoke', 'password': 'smoke'})
+    session.post(f"{gevent_server}/login", data={'username': 'smoke', 'password': 'smoke'})
+    image = io.BytesIO()
+    Image.new('RGB', (3000, 2000), (10, 200, 10)).save(image, 'PNG')
+    image.seek(0)
+
+    response = session.post(
+        f"{gevent_server}/add_expense",
+        data={'date': '2024-03-01', 'category': 'Food', 'amount': '3', 'description': 'photo'},
+        files={'receipt': ('photo.png', image, 'image/png')},
+    )
+    assert response.status_code == 200
+    response = session.get(f"{gevent_server}/download_report?all=1&format=xlsx", allow_redirects=False)
+    assert response.status_code == 302
+
+    def stored_expense():
+        expense = session.get(f"{gevent_server}/api/expenses").json()['expenses'][0]
+        return expense if expense['receipt_status'] == 'stored' else None
+
+    def finished_report():
+        job = session.get(f"{gevent_server}/api/reports/1").json()
+        return job if job['status'] in ('done', 'failed') else None
+
+    expense = wait_for(stored_expense)
+    # Processed in the image pool: re-encoded as JPEG, with a thumbnail
+    assert expense['thumbnail_url']
+    receipt = session.get(gevent_server + expense['receipt_url'])
+    assert receipt.headers['Content-Type'] == 'image/jpeg'
+
+    job = wait_for(finished_report)
+    assert job['status'] == 'done', job['error']
+    assert session.get(gevent_server + job['download_url']).content.startswith(b'PK')
@@ -0,0 +1,105 @@
+import io
+from datetime import date
+
+import pytest
+
+import db
+import importer
+
+
+@pytest.mark.parametrize('value, cents', [
+    ('50', 5000),
+    ('Rs. 50', 5000),
+    ('Rs.50', 5000),
+    ('INR 1,234.50', 123450),
+    ('1,00,000', 10000000),
+    ('-12', -1200),
+    ('-Rs. 12', -1200),
+    ('(12.00)', -1200),
+    ('(Rs. 1,200.75)', -120075),
+    ('.5', 50),
+    ('', None),
+    ('n/a', None),
+])
+def test_parse_amount(value, cents):
+    assert importer.parse_amount(value) == cents
+
+
+def parsed(rows):
+    return [(importer.parse_date(d), importer.parse_amount(a), text, category) for d, a, text, category in rows]
+
+
+def test_parse_csv_detects_columns():
+    statement = io.BytesIO(
+        'Txn Date,Narration,Withdrawal Amt.,Category\n'
+        '05/03/2024,Grocer,"Rs. 1,234.50",Food\n'
+        '\n'
+        '06/03/2024,Refund,(50.00),\n'.encode()
+    )
+
+    assert parsed(importer.parse_csv(statement)) == [
+        (date(2024, 3, 5), 123450, 'Grocer', 'Food'),
+        (date(2024, 3, 6), -5000, 'Refund', ''),
+    ]
+
+
+def test_parse_ofx_reads_transactions():
+    statement = io.BytesIO(b"""OFXHEADER:100
+<OFX><BANKMSGSRSV1><STMTTRNRS><STMTRS><BANKTRANLIST>
+<STMTTRN>
+<TRNTYPE>DEBIT
+<DTPOSTED>20240305120000
+<TRNAMT>-1,234.50
+<NAME>Grocer
+<MEMO>Card 1234
+</STMTTRN>
+<STMTTRN>
+<TRNTYPE>CREDIT
+<DTPOSTED>20240306
+<TRNAMT>50.00
+<NAME>Refund
+</STMTTRN>
+</BANKTRANLIST></STMTRS></STMTTRNRS></BANKMSGSRSV1></OFX>
+""")
+
+    assert parsed(importer.parse_ofx(statement)) == [
+        (date(2024, 3, 5), -123450, 'Grocer Card 1234', ''),
+        (date(2024, 3, 6), 5000, 'Refund', ''),
+    ]
+
+
+def test_parse_qif_reads_records():
+    statement = io.BytesIO(b"""!Type:Bank
+D2024-03-05
+T-1,234.50
+PGrocer
+LFood
+^
+D06/03'24
+U(Rs.50.00)
+PCafe
+MCoffee
+^
+""")
+
+    assert parsed(importer.parse_qif(statement)) == [
+        (date(2024, 3, 5), -123450, 'Grocer', 'Food'),
+        (date(2024, 3, 6), -5000, 'Cafe Coffee', ''),
+    ]
+
+
+def test_import_statement_skips_income_and_duplicates(user_id):
+    statement = (
+        'Date,Description,Amount\n'
+        '2024-03-05,Grocer,-Rs. 1234.50\n'
+        '2024-03-06,Salary,"50,000.00"\n'
+    ).encode()
+
+    with db.connection() as conn:
+        first = importer.import_statement(conn, user_id, io.BytesIO(statement), sign=importer.SIGN_NEGATIVE)
+        second = importer.import_statement(conn, user_id, io.BytesIO(statement), sign=importer.SIGN_NEGATIVE)
+        rows = conn.execute('SELECT date, amount_cents, description, category FROM expenses').fetchall()
+
+    assert (first.inserted, first.skipped) == (1, 1)
+    assert (second.inserted, second.duplicates) == (0, 1)
+    assert [tuple(row) for row in rows] == [(date(2024, 3, 5), 123450, 'Grocer', importer.DEFAULT_CATEGORY)]
@@ -0,0 +1,48 @@
+import pytest
+
+import app as app_module
+import db
+import metrics
+from config import Config
+
+
+def statement_count(name):
+    key = ('db_query_duration_seconds', (('statement', name),))
+    series = metrics.get_registry().values.get(key)
+    return series[-1] if series else 0
+
+
+def test_each_statement_is_counted_once_however_many_apps_exist(user_id):
+    app_module.create_app()
+    app_module.create_app()
+    before = statement_count('user_id_by_username')
+
+    with db.connection() as conn:
+        conn.query('user_id_by_username', ('tester',))
+
+    assert statement_count('user_id_by_username') == before + 1
+
+
+def test_metrics_without_a_token_are_only_served_to_localhost(client, monkeypatch):
+    monkeypatch.setattr(Config, 'METRICS_TOKEN', None)
+
+    assert client.get('/metrics').status_code == 200
+    assert client.get('/metrics', environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 404
+
+
+def test_metrics_token_is_required_when_set(client, monkeypatch):
+    monkeypatch.setattr(Config, 'METRICS_TOKEN', 'secret')
+
+    assert client.get('/metrics').status_code == 401
+    assert client.get('/metrics', headers={'Authorization': 'Bearer secret'},
+                      environ_base={'REMOTE_ADDR': '203.0.113.7'}).status_code == 200
+
+
+def test_exited_worker_files_are_removed(tmp_path, monkeypatch):
+    monkeypatch.setattr(Config, 'METRICS_DIR', str(tmp_path))
+    (tmp_path / 'metrics-4242.json').write_text('{}')
+
+    metrics.remove_process(4242)
+    metrics.remove_process(4242)
+
+    assert list(tmp_path.iterdir()) == []
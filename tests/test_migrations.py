@@ -0,0 +1,46 @@
+from datetime import date
+
+import pytest
+
+import db
+import migrations
+
+
+@pytest.fixture
+def version_8(tmp_path, monkeypatch):
+    """A database migrated up to version 8, still storing REAL amounts and TEXT dates"""
+    monkeypatch.setenv('DATABASE_URL', f"sqlite:///{tmp_path / 'old.db'}")
+    monkeypatch.setattr(db, '_pool', None)
+    with db.connection() as conn:
+        migrations.upgrade(conn, 8)
+        conn.execute("INSERT INTO users (username, password) VALUES ('old', 'x')")
+        conn.commit()
+    yield
+    db.get_pool().dispose()
+
+
+def test_amounts_become_cents_and_dates_become_dates(version_8):
+    with db.connection() as conn:
+        user_id = conn.execute("SELECT id FROM users WHERE username = 'old'").fetchone()[0]
+        for day, amount in (('2024-03-05', 12.34), ('2024-03-20', 0.1 + 0.2), ('2024-04-01', 98765432.1)):
+            conn.execute(
+                'INSERT INTO expenses (user_id, date, category, amount, description) VALUES (?, ?, ?, ?, ?)',
+                (user_id, day, 'Food', amount, 'lunch')
+            )
+        conn.execute(
+            'INSERT INTO budgets (user_id, category, amount, period, start_date, end_date) VALUES (?, ?, ?, ?, ?, ?)',
+            (user_id, 'Food', 1500.5, 'monthly', '2024-03-01', '2024-03-31')
+        )
+        conn.commit()
+
+        assert migrations.upgrade(conn) == [m.version for m in migrations.MIGRATIONS if m.version > 8]
+
+        expenses = conn.execute('SELECT date, amount_cents FROM expenses ORDER BY date').fetchall()
+        budget = conn.execute('SELECT amount_cents, start_date, end_date FROM budgets').fetchone()
+        rollups = conn.execute('SELECT month, total_cents, expense_count FROM expense_rollups ORDER BY month').fetchall()
+
+    assert [tuple(row) for row in expenses] == [
+        (date(2024, 3, 5), 1234), (date(2024, 3, 20), 30), (date(2024, 4, 1), 9876543210),
+    ]
+    assert tuple(budget) == (150050, date(2024, 3, 1), date(2024, 3, 31))
+    assert [tuple(row) for row in rollups] == [('2024-03', 1264, 2), ('2024-04', 9876543210, 1)]
@@ -0,0 +1,14 @@
+import pytest
+
+import money
+
+
+@pytest.mark.parametrize('value, cents', [('12.5', 1250), ('0.005', 1), ('-3', -300), ('50000000', 5000000000)])
+def test_to_cents(value, cents):
+    assert money.to_cents(value) == cents
+
+
+@pytest.mark.parametrize('value', ['', 'abc', 'nan', 'inf', '1e30', str(money.MAX_CENTS)])
+def test_to_cents_rejects_what_an_amount_column_cannot_hold(value):
+    with pytest.raises(ValueError):
+        money.to_cents(value)
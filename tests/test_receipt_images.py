@@ -0,0 +1,44 @@
+import io
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import receipt_images
+from config import Config
+
+Image = pytest.importorskip('PIL.Image')
+
+
+def png_upload(size=(1200, 800)):
+    data = io.BytesIO()
+    Image.new('RGB', size, 'white').save(data, 'PNG')
+    data.seek(0)
+    return FileStorage(data, filename='receipt.png', content_type='image/png')
+
+
+@pytest.fixture
+def small_images(monkeypatch):
+    monkeypatch.setattr(Config, 'RECEIPT_IMAGE_MAX_DIMENSION', 600)
+    monkeypatch.setattr(Config, 'RECEIPT_THUMBNAIL_SIZE', 100)
+
+
+def test_receipt_image_is_scaled_and_thumbnailed(small_images):
+    processed = receipt_images.process_receipt(png_upload(), 'receipt.png')
+
+    assert processed.filename == 'receipt.jpg'
+    assert processed.image.mimetype == 'image/jpeg'
+    with Image.open(processed.image.stream) as image:
+        assert image.format == 'JPEG'
+        assert max(image.size) == 600
+    with Image.open(processed.thumbnail.stream) as thumbnail:
+        assert max(thumbnail.size) == 100
+
+
+def test_unsupported_image_format_falls_back_to_jpeg(small_images, monkeypatch):
+    monkeypatch.setattr(Config, 'RECEIPT_IMAGE_FORMAT', 'PNG')
+
+    processed = receipt_images.process_receipt(png_upload(), 'receipt.png')
+
+    assert processed.filename == 'receipt.jpg'
+    with Image.open(processed.image.stream) as image:
+        assert image.format == 'JPEG'
@@ -0,0 +1,104 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+import db
+import receipt_queue
+from config import Config
+
+
+@pytest.fixture
+def queued(monkeypatch):
+    """Record enqueued uploads instead of running them"""
+    calls = []
+    monkeypatch.setattr(receipt_queue, 'enqueue', lambda expense_id, filename: calls.append((expense_id, filename)))
+    return calls
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'spool'
+    path.mkdir()
+    monkeypatch.setattr(Config, 'RECEIPT_SPOOL_DIR', str(path))
+    return path
+
+
+def add_uploading_expense(user_id, filename, claimed_at):
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_UPLOADING, filename)
+        ).fetchone()[0]
+        conn.execute(
+            'UPDATE expenses SET receipt_claimed_at = ? WHERE id = ?',
+            (claimed_at.strftime('%Y-%m-%d %H:%M:%S.%f'), expense_id)
+        )
+        conn.commit()
+    return expense_id
+
+
+def receipt_status(expense_id):
+    with db.connection() as conn:
+        return conn.execute('SELECT receipt_status FROM expenses WHERE id = ?', (expense_id,)).fetchone()[0]
+
+
+def test_uploads_lost_with_their_worker_are_requeued(user_id, spool_dir, queued):
+    (spool_dir / 'lost.pdf').write_bytes(b'receipt')
+    lost = datetime.now() - timedelta(seconds=Config.RECEIPT_UPLOAD_TIMEOUT + 60)
+    expense_id = add_uploading_expense(user_id, 'lost.pdf', lost)
+
+    assert receipt_queue.resume_pending() == 1
+
+    assert queued == [(expense_id, 'lost.pdf')]
+    assert receipt_status(expense_id) == receipt_queue.STATUS_PENDING
+
+
+def test_running_uploads_are_not_requeued(user_id, spool_dir, queued):
+    (spool_dir / 'running.pdf').write_bytes(b'receipt')
+    expense_id = add_uploading_expense(user_id, 'running.pdf', datetime.now())
+
+    assert receipt_queue.resume_pending() == 0
+
+    assert queued == []
+    assert receipt_status(expense_id) == receipt_queue.STATUS_UPLOADING
+
+
+def test_superseded_upload_does_not_record_its_result(user_id, spool_dir, monkeypatch):
+    (spool_dir / 'slow.pdf').write_bytes(b'receipt')
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, 'slow.pdf')
+        ).fetchone()[0]
+        conn.commit()
+    released = []
+    monkeypatch.setattr(receipt_queue.receipt_store, 'release', lambda conn, digest: released.append(digest))
+
+    def slow_store(filename):
+        # Meanwhile the upload is requeued and claimed again by another worker
+        with db.connection() as conn:
+            conn.execute('UPDATE expenses SET receipt_claimed_at = ? WHERE id = ?', ('later', expense_id))
+            conn.commit()
+        return 'digest', 'receipts/digest.pdf', None
+
+    monkeypatch.setattr(receipt_queue, '_store', slow_store)
+
+    receipt_queue.process(expense_id, 'slow.pdf')
+
+    assert released == ['digest']
+    assert receipt_status(expense_id) == receipt_queue.STATUS_UPLOADING
+    assert (spool_dir / 'slow.pdf').exists()
+
+
+def test_upload_of_a_deleted_expense_removes_the_spooled_receipt(user_id, spool_dir):
+    (spool_dir / 'gone.pdf').write_bytes(b'receipt')
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, 'gone.pdf')
+        ).fetchone()[0]
+        conn.query('delete_expense', (expense_id, user_id))
+        conn.commit()
+
+    assert receipt_queue.process(expense_id, 'gone.pdf') is None
+    assert not (spool_dir / 'gone.pdf').exists()
@@ -0,0 +1,79 @@
+import io
+from datetime import date
+
+import pytest
+from werkzeug.datastructures import FileStorage
+
+import cloud_storage
+import db
+import receipt_queue
+from config import Config
+
+RECEIPT = b'%PDF-1.4 receipt for one coffee'
+
+
+@pytest.fixture
+def spool_dir(tmp_path, monkeypatch):
+    path = tmp_path / 'spool'
+    monkeypatch.setattr(Config, 'RECEIPT_SPOOL_DIR', str(path))
+    return path
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    """Store files with LocalStorage under a temporary directory"""
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(cloud_storage.LocalStorage())
+    return tmp_path
+
+
+def stored_receipt(user_id):
+    """Add an expense with a receipt and upload it; returns the receipt digest"""
+    filename = receipt_queue.spool(
+        FileStorage(io.BytesIO(RECEIPT), filename='coffee.pdf', content_type='application/pdf'), 'coffee.pdf'
+    )
+    with db.connection() as conn:
+        expense_id = conn.query(
+            'insert_expense',
+            (user_id, date(2024, 3, 1), 'Food', 350, 'coffee', None, receipt_queue.STATUS_PENDING, filename)
+        ).fetchone()[0]
+        conn.commit()
+    receipt_queue.process(expense_id, filename)
+    with db.connection() as conn:
+        return conn.execute('SELECT receipt_digest FROM expenses WHERE id = ?', (expense_id,)).fetchone()[0]
+
+
+def test_local_receipt_is_private_and_sent_by_the_app(client, user_id, spool_dir, local_storage):
+    digest = stored_receipt(user_id)
+
+    assert not (local_storage / cloud_storage.LOCAL_STORAGE_ROOT / 'receipts').exists()
+    assert (local_storage / cloud_storage.LOCAL_PRIVATE_STORAGE_ROOT / 'receipts' / f'{digest}.pdf').exists()
+
+    response = client.get(f'/receipts/{digest}')
+
+    assert response.status_code == 200
+    assert response.get_data() == RECEIPT
+    assert response.headers['Cache-Control'].startswith('private')
+
+
+def test_cloud_receipt_redirects_to_a_signed_url(client, user_id, spool_dir, fake_backend):
+    digest = stored_receipt(user_id)
+    key = f'receipts/{digest}.pdf'
+    assert key in fake_backend.private
+
+    response = client.get(f'/receipts/{digest}')
+
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith(f'https://fake.example/{key}?expires=')
+    assert response.headers['Cache-Control'] == cloud_storage.PRIVATE_CACHE_CONTROL
+
+
+def test_receipt_is_not_served_to_other_users(client, user_id, spool_dir, local_storage):
+    digest = stored_receipt(user_id)
+    with db.connection() as conn:
+        conn.execute('UPDATE expenses SET user_id = user_id + 1')
+        conn.commit()
+
+    assert client.get(f'/receipts/{digest}').status_code == 404
+    assert client.get(f'/static/receipts/{digest}.pdf').status_code == 404
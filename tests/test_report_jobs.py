@@ -0,0 +1,71 @@
+from datetime import date
+
+import pytest
+
+import cloud_storage
+import db
+import report_jobs
+
+
+@pytest.fixture
+def storage_dir(tmp_path, monkeypatch):
+    """Run from a temporary directory, where local storage keeps its files"""
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def expenses(user_id):
+    with db.connection() as conn:
+        for day in range(1, 29):
+            conn.query(
+                'insert_expense', (user_id, date(2024, 2, day), 'Food', 100 * day, f'lunch {day}', None, None, None)
+            )
+        conn.commit()
+
+
+def finished_report(client, monkeypatch):
+    """Request a background report and run its job in this process"""
+    submitted = []
+    monkeypatch.setattr(report_jobs, 'submit', submitted.append)
+    response = client.get('/download_report?from=2024-01-01&to=2024-12-31')
+    assert response.status_code == 302
+    assert report_jobs.run_job(submitted[0]) == report_jobs.STATUS_DONE
+    return submitted[0]
+
+
+def test_local_report_is_private_and_sent_by_the_app(client, expenses, storage_dir, monkeypatch):
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(cloud_storage.LocalStorage())
+    job_id = finished_report(client, monkeypatch)
+
+    assert not (storage_dir / cloud_storage.LOCAL_STORAGE_ROOT / report_jobs.DIRECTORY).exists()
+    assert len(list((storage_dir / cloud_storage.LOCAL_PRIVATE_STORAGE_ROOT / report_jobs.DIRECTORY).iterdir())) == 1
+
+    response = client.get(f'/reports/{job_id}/download')
+
+    assert response.status_code == 200
+    assert response.headers['Cache-Control'] == cloud_storage.PRIVATE_CACHE_CONTROL
+    assert 'attachment' in response.headers['Content-Disposition']
+    assert b'lunch 28' in response.get_data()
+
+
+def test_cloud_report_redirects_to_a_signed_url(client, expenses, fake_backend, monkeypatch):
+    job_id = finished_report(client, monkeypatch)
+    (key,) = fake_backend.objects
+    assert key in fake_backend.private
+
+    response = client.get(f'/reports/{job_id}/download')
+
+    assert response.status_code == 302
+    assert response.headers['Location'].startswith(f'https://fake.example/{key}?expires=')
+    assert response.headers['Cache-Control'] == cloud_storage.PRIVATE_CACHE_CONTROL
+
+
+def test_report_is_not_served_to_other_users(client, expenses, fake_backend, monkeypatch):
+    job_id = finished_report(client, monkeypatch)
+    with db.connection() as conn:
+        conn.execute('UPDATE report_jobs SET user_id = user_id + 1 WHERE id = ?', (job_id,))
+        conn.commit()
+
+    assert client.get(f'/reports/{job_id}/download').status_code == 404
@@ -0,0 +1,26 @@
+import importlib.util
+
+import pytest
+
+import reports
+
+
+@pytest.fixture
+def fresh_formats():
+    reports.available_formats.cache_clear()
+    yield
+    reports.available_formats.cache_clear()
+
+
+def test_formats_without_their_module_are_left_out_and_looked_up_once(fresh_formats, monkeypatch):
+    lookups = []
+
+    def find_spec(name):
+        lookups.append(name)
+        return None if name == 'reportlab' else object()
+
+    monkeypatch.setattr(importlib.util, 'find_spec', find_spec)
+
+    assert reports.available_formats() == ('csv', 'xlsx')
+    assert reports.available_formats() == ('csv', 'xlsx')
+    assert sorted(lookups) == ['openpyxl', 'reportlab']
@@ -0,0 +1,57 @@
+import pytest
+
+import db
+import response_cache
+from config import Config
+
+
+@pytest.fixture
+def memory_cache(client):
+    """Turn the in-memory response cache back on for ``client``'s app"""
+    response_cache.set_backend(response_cache.MemoryBackend(Config.RESPONSE_CACHE_MAX_BYTES, 60))
+
+
+def sign_in(client, username):
+    with db.connection() as conn:
+        conn.query('insert_user', (username, 'not-a-password-hash'))
+        user_id = conn.query('user_id_by_username', (username,)).fetchone()[0]
+        conn.commit()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+        session['_user_identity'] = [str(user_id), username]
+
+
+def add_expense(client, description):
+    client.post('/add_expense', data={
+        'date': '2024-03-01', 'category': 'Food', 'amount': '3.50', 'description': description,
+    })
+
+
+def test_cached_page_is_replaced_after_add_and_delete(client, memory_cache):
+    assert client.get('/').headers['X-Cache'] == 'MISS'
+    assert client.get('/').headers['X-Cache'] == 'HIT'
+
+    add_expense(client, 'coffee beans')
+    page = client.get('/')
+    assert page.headers['X-Cache'] == 'MISS'
+    assert 'coffee beans' in page.get_data(as_text=True)
+
+    expense_id = client.get('/api/expenses').get_json()['expenses'][0]['id']
+    client.post('/delete_expense', data={'expense_id': expense_id})
+    page = client.get('/')
+    assert page.headers['X-Cache'] == 'MISS'
+    assert 'coffee beans' not in page.get_data(as_text=True)
+
+
+def test_cached_page_is_never_served_to_another_user(client, memory_cache):
+    add_expense(client, 'private lunch')
+    client.get('/')
+    assert client.get('/').headers['X-Cache'] == 'HIT'
+
+    other = client.application.test_client()
+    sign_in(other, 'someone-else')
+    page = other.get('/')
+
+    assert page.headers['X-Cache'] == 'MISS'
+    assert 'private lunch' not in page.get_data(as_text=True)
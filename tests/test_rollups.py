@@ -0,0 +1,78 @@
+from collections import Counter
+from datetime import date
+
+import pytest
+
+import app as app_module
+import archive
+import cloud_storage
+import db
+import rollups
+
+
+@pytest.fixture
+def local_storage(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(cloud_storage, '_backend', None)
+    cloud_storage.set_backend(cloud_storage.LocalStorage())
+
+
+def stored_rollups(conn):
+    return {
+        (month, category): (total, count)
+        for month, category, total, count in conn.execute(
+            'SELECT month, category, total_cents, expense_count FROM expense_rollups'
+        ).fetchall()
+    }
+
+
+def ledger(conn, user_id):
+    """SUM and COUNT per month and category over the table and the archives"""
+    rows = [tuple(row) for row in conn.execute('SELECT date, category, amount_cents FROM expenses').fetchall()]
+    rows += [(row[0], row[1], row[2]) for row in archive.expenses_between(conn, user_id)]
+    totals, counts = Counter(), Counter()
+    for day, category, amount_cents in rows:
+        key = (rollups.expense_month(day), category)
+        totals[key] += amount_cents
+        counts[key] += 1
+    return {key: (totals[key], counts[key]) for key in totals}
+
+
+def add(client, day, category, amount):
+    response = client.post('/add_expense', data={
+        'date': day, 'category': category, 'amount': amount, 'description': f'{category} on {day}',
+    })
+    assert response.status_code == 302
+
+
+def test_rollups_match_the_expenses_through_every_change(client, user_id, local_storage):
+    for day, category, amount in (
+        ('2021-05-01', 'Food', '10.25'), ('2021-05-20', 'Food', '4.75'), ('2021-06-02', 'Rent', '500'),
+        ('2024-03-01', 'Food', '3.50'), ('2024-03-02', 'Fun', '20'), ('2024-03-03', 'Fun', '5'),
+    ):
+        add(client, day, category, amount)
+    with db.connection() as conn:
+        assert stored_rollups(conn) == ledger(conn, user_id)
+        fun_id = conn.execute("SELECT id FROM expenses WHERE description = 'Fun on 2024-03-03'").fetchone()[0]
+        rent_id = conn.execute("SELECT id FROM expenses WHERE category = 'Rent'").fetchone()[0]
+
+    # Deleting the only expense of a month and category drops its row
+    client.post('/delete_expense', data={'expense_id': fun_id})
+    client.post('/delete_expense', data={'expense_id': rent_id})
+    with db.connection() as conn:
+        assert stored_rollups(conn) == ledger(conn, user_id)
+        assert ('2021-06', 'Rent') not in stored_rollups(conn)
+
+        before = stored_rollups(conn)
+        assert archive.archive_year(conn, user_id, 2021, date(2022, 1, 1)) == 2
+        assert stored_rollups(conn) == before == ledger(conn, user_id)
+
+        conn.execute('DELETE FROM expense_rollups')
+        conn.commit()
+    result = app_module.app.test_cli_runner().invoke(args=['rebuild-rollups'])
+    assert result.exit_code == 0, result.output
+    with db.connection() as conn:
+        assert stored_rollups(conn) == before
+
+        assert archive.restore_year(conn, user_id, 2021) == 2
+        assert stored_rollups(conn) == before == ledger(conn, user_id)
@@ -0,0 +1,66 @@
+from datetime import date
+
+import db
+
+
+def add_expense(client, description, category='Food', amount='3.50', day='2024-03-01'):
+    response = client.post('/add_expense', data={
+        'date': day, 'category': category, 'amount': amount, 'description': description,
+    })
+    assert response.status_code == 302
+
+
+def search(client, **args):
+    response = client.get('/api/search', query_string=args)
+    assert response.status_code == 200
+    return response.get_json()
+
+
+def descriptions(result):
+    return sorted(expense['description'] for expense in result['expenses'])
+
+
+def test_added_expenses_are_found_by_word_prefixes(client):
+    add_expense(client, 'Weekly groceries at the market')
+    add_expense(client, 'Café au lait', category='Coffee')
+    add_expense(client, 'Market stall rent', category='Business')
+
+    assert descriptions(search(client, q='gro')) == ['Weekly groceries at the market']
+    assert descriptions(search(client, q='market')) == ['Market stall rent', 'Weekly groceries at the market']
+    assert descriptions(search(client, q='market gro')) == ['Weekly groceries at the market']
+    assert descriptions(search(client, q='cafe')) == ['Café au lait']
+    assert search(client, q='bakery')['total'] == 0
+
+
+def test_deleted_expenses_are_no_longer_found(client):
+    add_expense(client, 'Groceries')
+    add_expense(client, 'More groceries')
+    (expense,) = search(client, q='more')['expenses']
+
+    client.post('/delete_expense', data={'expense_id': expense['id']})
+
+    assert descriptions(search(client, q='groceries')) == ['Groceries']
+
+
+def test_other_users_expenses_are_not_found(client, user_id):
+    with db.connection() as conn:
+        conn.query('insert_user', ('someone-else', 'x'))
+        other = conn.query('user_id_by_username', ('someone-else',)).fetchone()[0]
+        conn.query('insert_expense', (other, date(2024, 3, 1), 'Food', 100, 'groceries', None, None, None))
+        conn.commit()
+
+    assert search(client, q='groceries')['total'] == 0
+
+
+def test_facets_count_matches_per_category_ignoring_the_category_filter(client):
+    add_expense(client, 'Lunch with team', category='Food')
+    add_expense(client, 'Lunch alone', category='Food')
+    add_expense(client, 'Team lunch taxi', category='Travel', amount='12')
+    add_expense(client, 'Dinner', category='Food')
+
+    result = search(client, q='lunch', category='Travel')
+
+    assert result['facets'] == [{'category': 'Food', 'count': 2}, {'category': 'Travel', 'count': 1}]
+    assert result['total'] == 1
+    assert descriptions(result) == ['Team lunch taxi']
+    assert search(client, q='lunch', min_amount='10')['facets'] == [{'category': 'Travel', 'count': 1}]